@@ -0,0 +1,119 @@
+"""Асинхронная обёртка над db.py для async-обработчиков FastAPI.
+
+Каждый вызов выполняется в ограниченном пуле потоков, поэтому запросы к
+SQLite и commit не блокируют event loop uvicorn. Соединения берутся из
+пула db.py (по одному на поток пула).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from . import db
+
+
+DB_WORKERS = int(os.getenv("CERT_DB_WORKERS", "4"))
+# Отдельный пул для публичной проверки (QR): всплеск сканов не занимает
+# потоки, которые обслуживают сотрудников.
+PUBLIC_DB_WORKERS = int(os.getenv("CERT_PUBLIC_DB_WORKERS", "2"))
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_public_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, DB_WORKERS), thread_name_prefix="cert-db")
+    return _executor
+
+
+def _get_public_executor() -> ThreadPoolExecutor:
+    global _public_executor
+    if _public_executor is None:
+        _public_executor = ThreadPoolExecutor(
+            max_workers=max(1, PUBLIC_DB_WORKERS), thread_name_prefix="cert-db-public"
+        )
+    return _public_executor
+
+
+async def run(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить синхронную функцию доступа к БД в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_public(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """То же, что run(), но в отдельном пуле публичной проверки."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_public_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown() -> None:
+    """Останавливает пулы и закрывает соединения БД."""
+    global _executor, _public_executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    if _public_executor is not None:
+        _public_executor.shutdown(wait=True)
+        _public_executor = None
+    db.close_connections()
+
+
+def _async(fn: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        return await run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+# --- то же API, что и в db.py ---
+
+init_db = _async(db.init_db)
+
+get_user_profile = _async(db.get_user_profile)
+get_user_profiles = _async(db.get_user_profiles)
+list_user_profiles = _async(db.list_user_profiles)
+upsert_user_profile = _async(db.upsert_user_profile)
+refresh_org_index = _async(db.refresh_org_index)
+
+get_certificate = _async(db.get_certificate)
+list_certificates = _async(db.list_certificates)
+list_certificates_for_owners = _async(db.list_certificates_for_owners)
+list_certificates_by_module = _async(db.list_certificates_by_module)
+list_exam_requests = _async(db.list_exam_requests)
+list_team_certificates = _async(db.list_team_certificates)
+count_team_certificates = _async(db.count_team_certificates)
+team_facets = _async(db.team_facets)
+certificate_stats = _async(db.certificate_stats)
+search_certificates = _async(db.search_certificates)
+list_expiring_soon = _async(db.list_expiring_soon)
+refresh_expiring_soon = _async(db.refresh_expiring_soon)
+
+add_certificate = _async(db.add_certificate)
+add_certificates_bulk = _async(db.add_certificates_bulk)
+set_exam_result = _async(db.set_exam_result)
+revoke_certificate = _async(db.revoke_certificate)
+unrevoke_certificate = _async(db.unrevoke_certificate)
+update_certificate = _async(db.update_certificate)
+delete_certificate = _async(db.delete_certificate)
+
+revoke_certificates = _async(db.revoke_certificates)
+unrevoke_certificates = _async(db.unrevoke_certificates)
+set_exam_results = _async(db.set_exam_results)
+
+
+async def get_public_certificate(cert_id: int) -> Optional[dict]:
+    return await run_public(db.get_public_certificate, cert_id)
+
+
+async def get_public_statuses(cert_ids: list) -> dict:
+    return await run_public(db.get_public_statuses, cert_ids)
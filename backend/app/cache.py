@@ -0,0 +1,207 @@
+"""Простые in-process кэши (LRU + TTL) со счётчиками попаданий."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+
+_MISSING = object()
+
+_REGISTRY: List["TTLCache"] = []
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш ограниченного размера с временем жизни записей.
+
+    ttl=None — записи живут, пока их не вытеснят или не инвалидируют.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = float(ttl) if ttl else None
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        _REGISTRY.append(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                expires, value = item
+                if expires and expires < time.monotonic():
+                    del self._data[key]
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize == 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0.0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+            }
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Статистика всех кэшей процесса (для диагностики)."""
+    return {c.name: c.stats() for c in _REGISTRY}
+
+
+# --- Профили пользователей ---
+
+PROFILE_CACHE_SIZE = int(os.getenv("CERT_PROFILE_CACHE_SIZE", "1024"))
+PROFILE_CACHE_TTL = float(os.getenv("CERT_PROFILE_CACHE_TTL", "60"))
+
+# user_id -> строка user_profiles (или None, если профиля нет)
+PROFILE_CACHE = TTLCache("profiles", PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+# user_id -> DisplayUser (для current_user())
+DISPLAY_USER_CACHE = TTLCache("display_users", PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def invalidate_user(user_id: int) -> None:
+    """Сбросить кэшированные данные пользователя (после изменения профиля)."""
+    PROFILE_CACHE.invalidate(int(user_id))
+    DISPLAY_USER_CACHE.invalidate(int(user_id))
+
+
+# --- Отрисовка сертификатов (PDF и т.п.) ---
+
+
+def render_fingerprint(cert: Dict[str, Any], fields: Iterable[str], salt: str = "") -> str:
+    """Хэш полей, от которых зависит отрисовка (ключ кэша и ETag)."""
+    data = json.dumps([salt] + [cert.get(f) for f in fields], ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+class RenderCache:
+    """Кэш результатов отрисовки по ключу-отпечатку: LRU в памяти + (опционально) файлы на диске.
+
+    Ключ содержит отпечаток полей сертификата, поэтому устаревшая запись просто
+    перестаёт совпадать; invalidate(cert_id) дополнительно освобождает её сразу.
+    """
+
+    def __init__(self, name: str, maxsize: int, disk_dir: Optional[str] = None, suffix: str = "") -> None:
+        self.memory = TTLCache(name, maxsize)
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._key_by_cert: Dict[int, str] = {}
+        _CERT_CACHES.append(self)
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key)
+        if value is not None or self.disk_dir is None:
+            return value
+        try:
+            value = (self.disk_dir / (key + self.suffix)).read_bytes()
+        except OSError:
+            return None
+        self.memory.set(key, value)
+        return value
+
+    def set(self, cert_id: int, key: str, value: Any) -> None:
+        with self._lock:
+            old = self._key_by_cert.get(int(cert_id))
+            self._key_by_cert[int(cert_id)] = key
+        if old and old != key:
+            self._drop(old)
+        self.memory.set(key, value)
+        if self.disk_dir is not None and isinstance(value, bytes):
+            try:
+                self.disk_dir.mkdir(parents=True, exist_ok=True)
+                tmp = self.disk_dir / f".{key}{self.suffix}.tmp"
+                tmp.write_bytes(value)
+                tmp.replace(self.disk_dir / (key + self.suffix))
+            except OSError:
+                pass
+
+    def invalidate(self, cert_id: int) -> None:
+        with self._lock:
+            key = self._key_by_cert.pop(int(cert_id), None)
+        if key:
+            self._drop(key)
+
+    def _drop(self, key: str) -> None:
+        self.memory.invalidate(key)
+        if self.disk_dir is not None:
+            try:
+                (self.disk_dir / (key + self.suffix)).unlink()
+            except OSError:
+                pass
+
+
+_CERT_CACHES: List[RenderCache] = []
+
+
+def invalidate_certificate(cert_id: int) -> None:
+    """Сбросить всё закэшированное для сертификата (вызывается из записей в db.py)."""
+    for c in _CERT_CACHES:
+        c.invalidate(int(cert_id))
+    PUBLIC_STATUS_CACHE.invalidate(int(cert_id))
+
+
+PDF_CACHE_SIZE = int(os.getenv("CERT_PDF_CACHE_SIZE", "256"))
+# Например /app/data/pdf_cache; пусто — только память
+PDF_CACHE_DIR = os.getenv("CERT_PDF_CACHE_DIR", "")
+
+PDF_CACHE = RenderCache("pdf", PDF_CACHE_SIZE, PDF_CACHE_DIR or None, suffix=".pdf")
+
+SVG_CACHE_SIZE = int(os.getenv("CERT_SVG_CACHE_SIZE", "1024"))
+# Хранить рядом со SVG сжатый gzip-вариант (отдаётся при Accept-Encoding: gzip)
+SVG_CACHE_GZIP = os.getenv("CERT_SVG_CACHE_GZIP", "1") not in ("0", "false", "no")
+
+# ключ -> (svg, gzip(svg) или None)
+SVG_CACHE = RenderCache("svg", SVG_CACHE_SIZE)
+
+QR_CACHE_SIZE = int(os.getenv("CERT_QR_CACHE_SIZE", "2048"))
+
+# (url, box_size, border) -> SVG QR-кода; результат зависит только от ключа
+QR_CACHE = TTLCache("qr", QR_CACHE_SIZE)
+
+# --- Публичная проверка (QR) ---
+
+PUBLIC_CACHE_SIZE = int(os.getenv("CERT_PUBLIC_CACHE_SIZE", "10000"))
+# Короткий TTL: статус «просрочен» меняется с датой, а не только при записи
+PUBLIC_CACHE_TTL = float(os.getenv("CERT_PUBLIC_CACHE_TTL", "30"))
+
+# cert_id -> публичное представление (статус, ФИО, даты)
+PUBLIC_STATUS_CACHE = TTLCache("public_status", PUBLIC_CACHE_SIZE, PUBLIC_CACHE_TTL)
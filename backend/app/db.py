@@ -1,27 +1,116 @@
 from __future__ import annotations
 
+import json
 import os
+import re
 import sqlite3
-from datetime import date
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+from .cache import PROFILE_CACHE, invalidate_certificate, invalidate_user
+from .hierarchy import ORG_INDEX
 
 
 DB_PATH = os.getenv("CERT_DB_PATH", "/app/data/cert_registry.db")
 
+# Профиль соединения SQLite (можно переопределить через окружение)
+DB_JOURNAL_MODE = os.getenv("CERT_DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("CERT_DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.getenv("CERT_DB_CACHE_SIZE", "-20000"))  # < 0 — размер в KiB
+DB_MMAP_SIZE = int(os.getenv("CERT_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("CERT_DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("CERT_DB_STATEMENT_CACHE", "256"))
+
 
 MODULE_CERTIFICATION = "Модуль Сертификации"
 MODULES = [MODULE_CERTIFICATION]
 
 
-def _connect() -> sqlite3.Connection:
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+# -------------------------
+# Connections
+# -------------------------
+
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool: List[sqlite3.Connection] = []
+_pool_generation = 0
+_dirs_ready: set = set()
+
+
+def _open_connection(path: str, readonly: bool = False) -> sqlite3.Connection:
+    """Открывает новое соединение и применяет профиль PRAGMA.
+
+    readonly=True — соединение только для чтения (mode=ro + query_only),
+    для публичной проверки сертификатов.
+    """
+    if path not in _dirs_ready:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        _dirs_ready.add(path)
+
+    # check_same_thread=False — только чтобы close_connections() могла
+    # закрыть соединения из другого потока; в работе соединение принадлежит
+    # одному потоку.
+    conn = sqlite3.connect(
+        f"file:{quote(path)}?mode=ro" if readonly else path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+        uri=readonly,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+    if readonly:
+        conn.execute("PRAGMA query_only = 1")
+    else:
+        conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {int(DB_CACHE_SIZE)}")
+    conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
 
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    """Соединение текущего потока (создаётся один раз и переиспользуется).
+
+    Используется как `with _connect() as conn:` — контекстный менеджер
+    sqlite3 делает commit/rollback, но не закрывает соединение.
+    readonly=True — отдельное соединение потока только для чтения.
+    """
+    attr = "ro_conn" if readonly else "conn"
+    conn = getattr(_local, attr, None)
+    if conn is not None and getattr(_local, attr + "_key", None) == (DB_PATH, _pool_generation):
+        return conn
+
+    conn = _open_connection(DB_PATH, readonly=readonly)
+    with _pool_lock:
+        _pool.append(conn)
+        key = (DB_PATH, _pool_generation)
+    setattr(_local, attr, conn)
+    setattr(_local, attr + "_key", key)
+    return conn
+
+
+def close_connections() -> None:
+    """Закрывает все соединения пула (при остановке приложения или смене DB_PATH)."""
+    global _pool_generation
+    with _pool_lock:
+        conns = list(_pool)
+        _pool.clear()
+        _pool_generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    # table_xinfo (а не table_info) — чтобы видеть и генерируемые колонки
+    rows = conn.execute(f"PRAGMA table_xinfo({table})").fetchall()
     return [str(r[1]) for r in rows]
 
 
@@ -32,84 +121,418 @@ def _ensure_column(conn: sqlite3.Connection, table: str, col: str, ddl: str) ->
     conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}")
 
 
-def init_db() -> None:
-    """Создаёт БД и выполняет простую миграцию схемы."""
-    with _connect() as conn:
-        # --- certificates ---
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS certificates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                owner_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                issued_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
+# -------------------------
+# Schema migrations
+# -------------------------
+#
+# Версия схемы хранится в PRAGMA user_version. Каждый шаг идемпотентен
+# (старые базы могли получить часть колонок ещё через _ensure_column), шаги
+# применяются по порядку в одной транзакции BEGIN IMMEDIATE. Если версия
+# актуальна, init_db() схему не разглядывает вовсе.
+
+# Мигрировать при старте приложения; при 0 — только `python -m app.migrate`
+DB_AUTO_MIGRATE = os.getenv("CERT_DB_AUTO_MIGRATE", "1") not in ("0", "false", "no")
+
+
+def _migration_base(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS certificates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            issued_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """
+    )
+
+    # Поля, добавлявшиеся по мере развития прототипа
+    _ensure_column(conn, "certificates", "cert_type", "TEXT NOT NULL DEFAULT 'external'")
+    _ensure_column(conn, "certificates", "topic", "TEXT")
+    _ensure_column(conn, "certificates", "workflow_status", "TEXT NOT NULL DEFAULT 'active'")
+    _ensure_column(conn, "certificates", "required_examiner_id", "INTEGER")
+    _ensure_column(conn, "certificates", "required_examiner_name", "TEXT")
+    _ensure_column(conn, "certificates", "exam_grade", "TEXT")
+    _ensure_column(conn, "certificates", "exam_date", "TEXT")
+    _ensure_column(conn, "certificates", "snapshot_full_name", "TEXT")
+    _ensure_column(conn, "certificates", "snapshot_position", "TEXT")
+    _ensure_column(conn, "certificates", "snapshot_module", "TEXT")
+    _ensure_column(conn, "certificates", "snapshot_manager_id", "INTEGER")
+    _ensure_column(conn, "certificates", "snapshot_manager_name", "TEXT")
+
+    # HR: отзыв сертификата
+    _ensure_column(conn, "certificates", "revoked_by_id", "INTEGER")
+    _ensure_column(conn, "certificates", "revoked_by_name", "TEXT")
+    _ensure_column(conn, "certificates", "revoked_reason", "TEXT")
+    _ensure_column(conn, "certificates", "revoked_at", "TEXT")
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id INTEGER PRIMARY KEY,
+            full_name TEXT NOT NULL,
+            position TEXT NOT NULL,
+            module TEXT NOT NULL,
+            manager_id INTEGER,
+            controlled_module TEXT
+        )
+        """
+    )
+
+
+def _migration_effective_module(conn: sqlite3.Connection) -> None:
+    # Модуль сертификата для фильтрации: пустой снапшот = модуль по умолчанию
+    # (как в can_view_certificate / revoke). Генерируемая колонка индексируется.
+    _ensure_column(
+        conn,
+        "certificates",
+        "effective_module",
+        "TEXT GENERATED ALWAYS AS "
+        f"(COALESCE(NULLIF(snapshot_module, ''), '{MODULE_CERTIFICATION}')) VIRTUAL",
+    )
+    _ensure_indexes(conn, "idx_certificates_owner", "idx_certificates_module", "idx_certificates_exam_requests")
+
+
+def _migration_row_version(conn: sqlite3.Connection) -> None:
+    # Оптимистическая блокировка: увеличивается при каждом изменении строки
+    _ensure_column(conn, "certificates", "row_version", "INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_status_columns(conn: sqlite3.Connection) -> None:
+    # Поля, которые раньше вычислялись при каждом чтении: код награды,
+    # статус по workflow и нормализованная дата окончания
+    _ensure_column(conn, "certificates", "award_code", "TEXT")
+    _ensure_column(conn, "certificates", "status_base", "TEXT NOT NULL DEFAULT 'dated'")
+    _ensure_column(conn, "certificates", "expires_on", "TEXT")
+    rows = conn.execute(
+        "SELECT id, cert_type, workflow_status, expires_at, exam_grade FROM certificates"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE certificates SET award_code = ?, status_base = ?, expires_on = ? WHERE id = ?",
+        [
+            (
+                normalize_award(r["exam_grade"]),
+                status_base(r["cert_type"], r["workflow_status"]),
+                expires_on(r["expires_at"]),
+                int(r["id"]),
             )
-            """
+            for r in rows
+        ],
+    )
+    _ensure_indexes(conn, "idx_certificates_module_status")
+
+
+def _migration_expiring_soon(conn: sqlite3.Connection) -> None:
+    # Сертификаты, истекающие в ближайшие EXPIRY_WINDOWS дней (пересобирается refresh_expiring_soon)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS expiring_soon (
+            cert_id INTEGER PRIMARY KEY,
+            owner_id INTEGER NOT NULL,
+            module TEXT NOT NULL,
+            expires_on TEXT NOT NULL,
+            window_days INTEGER NOT NULL,
+            refreshed_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expiring_soon_module ON expiring_soon (module, expires_on)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expiring_soon_owner ON expiring_soon (owner_id, expires_on)")
+    _ensure_indexes(conn, "idx_certificates_expires_on")
+
+
+# Ключ агрегата для строки certificates (NEW/OLD в триггерах). NULL заменяем на '',
+# чтобы ключ работал как первичный.
+def _rollup_key(row: str) -> str:
+    return (
+        f"{row}.effective_module, {row}.cert_type, "
+        f"CASE WHEN {row}.workflow_status = 'passed' THEN COALESCE({row}.award_code, '') ELSE '' END, "
+        f"{row}.status_base, COALESCE({row}.expires_on, '')"
+    )
+
+
+def _migration_cert_rollup(conn: sqlite3.Connection) -> None:
+    # Счётчики сертификатов по (модуль, тип, награда, статус по workflow, дата окончания).
+    # Поддерживаются триггерами, поэтому актуальны после любой записи, включая массовые.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cert_rollup (
+            module TEXT NOT NULL,
+            cert_type TEXT NOT NULL,
+            award TEXT NOT NULL,
+            state TEXT NOT NULL,
+            expires_on TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (module, cert_type, award, state, expires_on)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("DELETE FROM cert_rollup")
+    conn.execute(
+        f"""
+        INSERT INTO cert_rollup (module, cert_type, award, state, expires_on, n)
+        SELECT {_rollup_key("c")}, COUNT(*)
+        FROM certificates c
+        GROUP BY 1, 2, 3, 4, 5
+        """
+    )
+    inc = f"""
+        INSERT INTO cert_rollup (module, cert_type, award, state, expires_on, n)
+        VALUES ({_rollup_key("NEW")}, 1)
+        ON CONFLICT (module, cert_type, award, state, expires_on) DO UPDATE SET n = n + 1;
+    """
+    dec = f"""
+        UPDATE cert_rollup SET n = n - 1
+        WHERE (module, cert_type, award, state, expires_on) = ({_rollup_key("OLD")});
+        DELETE FROM cert_rollup
+        WHERE (module, cert_type, award, state, expires_on) = ({_rollup_key("OLD")}) AND n <= 0;
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_cert_rollup_insert AFTER INSERT ON certificates BEGIN {inc} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_cert_rollup_delete AFTER DELETE ON certificates BEGIN {dec} END")
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_cert_rollup_update
+        AFTER UPDATE OF snapshot_module, cert_type, workflow_status, award_code, status_base, expires_on
+        ON certificates
+        WHEN ({_rollup_key("OLD")}) IS NOT ({_rollup_key("NEW")})
+        BEGIN {dec} {inc} END
+        """
+    )
+
+
+# Поля полнотекстового поиска и их веса bm25: название важнее темы, тема важнее ФИО и т.д.
+_FTS_COLUMNS = ("name", "topic", "snapshot_full_name", "snapshot_position", "revoked_reason")
+_FTS_WEIGHTS = (10.0, 5.0, 3.0, 1.0, 1.0)
+
+
+def _fts_text(expr: str) -> str:
+    # unicode61 не считает «ё» вариантом «е»; длина текста не меняется, поэтому
+    # snippet() по исходному тексту из certificates подсвечивает верные позиции
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _migration_certificates_fts(conn: sqlite3.Connection) -> None:
+    # FTS5 с внешним содержимым (тексты хранятся только в certificates).
+    # unicode61 приводит кириллицу к нижнему регистру; prefix='2 3' — отдельные
+    # индексы для коротких префиксов («ku*», «сер*»).
+    cols = ", ".join(_FTS_COLUMNS)
+    new_vals = ", ".join(_fts_text(f"NEW.{c}") for c in _FTS_COLUMNS)
+    old_vals = ", ".join(_fts_text(f"OLD.{c}") for c in _FTS_COLUMNS)
+    conn.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS certificates_fts USING fts5(
+            {cols},
+            content='certificates', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        """
+    )
+    # вместо 'rebuild': индексируем тот же нормализованный текст, что и триггеры
+    conn.execute("INSERT INTO certificates_fts (certificates_fts) VALUES ('delete-all')")
+    conn.execute(
+        f"""
+        INSERT INTO certificates_fts (rowid, {cols})
+        SELECT id, {", ".join(_fts_text(c) for c in _FTS_COLUMNS)} FROM certificates
+        """
+    )
+
+    insert = f"INSERT INTO certificates_fts (rowid, {cols}) VALUES (NEW.id, {new_vals});"
+    delete = f"INSERT INTO certificates_fts (certificates_fts, rowid, {cols}) VALUES ('delete', OLD.id, {old_vals});"
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_certificates_fts_insert AFTER INSERT ON certificates BEGIN {insert} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_certificates_fts_delete AFTER DELETE ON certificates BEGIN {delete} END")
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_certificates_fts_update
+        AFTER UPDATE OF {cols} ON certificates
+        BEGIN {delete} {insert} END
+        """
+    )
+
+
+def _migration_revocation_log(conn: sqlite3.Connection) -> None:
+    # Журнал изменений публичной действительности (без учёта дат): отзыв,
+    # возврат, результат экзамена, удаление, правка полей из подписанного QR.
+    # invalid — состояние после изменения. Проверка подписанных токенов держит
+    # его в памяти и догоняет по seq.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS revocation_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            cert_id INTEGER NOT NULL,
+            invalid INTEGER NOT NULL,
+            changed_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_revocation_log_cert ON revocation_log (cert_id, seq)")
+    conn.execute(
+        """
+        INSERT INTO revocation_log (cert_id, invalid)
+        SELECT id, 1 FROM certificates WHERE status_base != 'dated' ORDER BY id
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_revocation_log_insert
+        AFTER INSERT ON certificates WHEN NEW.status_base != 'dated'
+        BEGIN INSERT INTO revocation_log (cert_id, invalid) VALUES (NEW.id, 1); END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_revocation_log_update
+        AFTER UPDATE OF status_base, snapshot_full_name, issued_at, expires_on ON certificates
+        WHEN (OLD.status_base = 'dated') != (NEW.status_base = 'dated')
+          OR OLD.snapshot_full_name IS NOT NEW.snapshot_full_name
+          OR OLD.issued_at IS NOT NEW.issued_at
+          OR OLD.expires_on IS NOT NEW.expires_on
+        BEGIN
+            INSERT INTO revocation_log (cert_id, invalid) VALUES (NEW.id, NEW.status_base != 'dated');
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_revocation_log_delete
+        AFTER DELETE ON certificates
+        BEGIN INSERT INTO revocation_log (cert_id, invalid) VALUES (OLD.id, 1); END
+        """
+    )
+
+
+def _migration_fts_rank(conn: sqlite3.Connection) -> None:
+    # Веса bm25 хранятся в самой FTS-таблице: ORDER BY rank ранжирует с ними
+    weights = ", ".join(str(w) for w in _FTS_WEIGHTS)
+    conn.execute(
+        "INSERT INTO certificates_fts (certificates_fts, rank) VALUES ('rank', ?)",
+        (f"bm25({weights})",),
+    )
+
+
+def _migration_revocation_log_issuance(conn: sqlite3.Connection) -> None:
+    # Каждая выдача пишется в журнал: id без записи не считается существующим
+    # (иначе подписанный токен на невыданный id проходил бы проверку).
+    # Недостающие записи — для сертификатов, выданных действительными до этого шага.
+    conn.execute(
+        """
+        INSERT INTO revocation_log (cert_id, invalid)
+        SELECT id, status_base != 'dated' FROM certificates c
+        WHERE NOT EXISTS (SELECT 1 FROM revocation_log l WHERE l.cert_id = c.id)
+        ORDER BY id
+        """
+    )
+    conn.execute("DROP TRIGGER IF EXISTS trg_revocation_log_insert")
+    conn.execute(
+        """
+        CREATE TRIGGER trg_revocation_log_insert AFTER INSERT ON certificates
+        BEGIN INSERT INTO revocation_log (cert_id, invalid) VALUES (NEW.id, NEW.status_base != 'dated'); END
+        """
+    )
+
+
+# (номер, описание, шаг); номера идут подряд, уже выпущенные шаги не меняются
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "certificates and user_profiles tables", _migration_base),
+    (2, "effective_module column and certificate indexes", _migration_effective_module),
+    (3, "certificates.row_version", _migration_row_version),
+    (4, "persisted award_code, status_base, expires_on", _migration_status_columns),
+    (5, "expiring_soon table and expiry index", _migration_expiring_soon),
+    (6, "cert_rollup counters with triggers", _migration_cert_rollup),
+    (7, "certificates_fts full-text index", _migration_certificates_fts),
+    (8, "revocation_log with triggers", _migration_revocation_log),
+    (9, "bm25 column weights as certificates_fts rank", _migration_fts_rank),
+    (10, "revocation_log records every issued certificate", _migration_revocation_log_issuance),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version() -> int:
+    with _connect() as conn:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0])
 
-        # Новые поля (эволюция схемы)
-        _ensure_column(conn, "certificates", "cert_type", "TEXT NOT NULL DEFAULT 'external'")
-        _ensure_column(conn, "certificates", "topic", "TEXT")
-        _ensure_column(conn, "certificates", "workflow_status", "TEXT NOT NULL DEFAULT 'active'")
-        _ensure_column(conn, "certificates", "required_examiner_id", "INTEGER")
-        _ensure_column(conn, "certificates", "required_examiner_name", "TEXT")
-        _ensure_column(conn, "certificates", "exam_grade", "TEXT")
-        _ensure_column(conn, "certificates", "exam_date", "TEXT")
-        _ensure_column(conn, "certificates", "snapshot_full_name", "TEXT")
-        _ensure_column(conn, "certificates", "snapshot_position", "TEXT")
-        _ensure_column(conn, "certificates", "snapshot_module", "TEXT")
-        _ensure_column(conn, "certificates", "snapshot_manager_id", "INTEGER")
-        _ensure_column(conn, "certificates", "snapshot_manager_name", "TEXT")
-
-        # HR: отзыв сертификата
-        _ensure_column(conn, "certificates", "revoked_by_id", "INTEGER")
-        _ensure_column(conn, "certificates", "revoked_by_name", "TEXT")
-        _ensure_column(conn, "certificates", "revoked_reason", "TEXT")
-        _ensure_column(conn, "certificates", "revoked_at", "TEXT")
-
-        # --- user_profiles ---
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_profiles (
-                user_id INTEGER PRIMARY KEY,
-                full_name TEXT NOT NULL,
-                position TEXT NOT NULL,
-                module TEXT NOT NULL,
-                manager_id INTEGER,
-                controlled_module TEXT
-            )
+
+def migrate(target: Optional[int] = None) -> List[int]:
+    """Применить недостающие миграции до target (по умолчанию — до последней).
+
+    Версия перечитывается под BEGIN IMMEDIATE, поэтому несколько процессов,
+    стартующих одновременно, не выполнят один и тот же шаг дважды.
+    Возвращает номера применённых шагов.
+    """
+    target = SCHEMA_VERSION if target is None else int(target)
+    applied: List[int] = []
+    with _connect() as conn:
+        if int(conn.execute("PRAGMA user_version").fetchone()[0]) >= target:
+            return applied
+        conn.execute("BEGIN IMMEDIATE")
+        current = int(conn.execute("PRAGMA user_version").fetchone()[0])
+        for number, _title, step in MIGRATIONS:
+            if current < number <= target:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {int(number)}")
+                applied.append(number)
+        conn.commit()
+    if applied:
+        assert_indexed_queries()
+    return applied
+
+
+def seed_user_profiles() -> None:
+    """Профили для предопределённых пользователей (существующие не трогаем)."""
+    from .users import USERS, ROLE_LABELS
+
+    rows = [
+        (
+            u.id,
+            u.full_name,
+            # по умолчанию должность = подпись роли
+            ROLE_LABELS.get(u.role, u.role),
+            MODULE_CERTIFICATION,
+            u.manager_id,
+            MODULE_CERTIFICATION if u.role == "hr" else None,
+        )
+        for u in USERS
+    ]
+    with _connect() as conn:
+        conn.executemany(
             """
+            INSERT OR IGNORE INTO user_profiles (user_id, full_name, position, module, manager_id, controlled_module)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows,
         )
+        conn.commit()
 
-        # Seed профилей для предопределённых пользователей (если их ещё нет)
-        from .users import USERS, ROLE_LABELS
 
-        existing = conn.execute("SELECT user_id FROM user_profiles").fetchall()
-        existing_ids = {int(r[0]) for r in existing}
-        for u in USERS:
-            if u.id in existing_ids:
-                continue
-            # по умолчанию должность = подпись роли
-            position = ROLE_LABELS.get(u.role, u.role)
-            controlled_module = MODULE_CERTIFICATION if u.role == "hr" else None
-            conn.execute(
-                """
-                INSERT INTO user_profiles (user_id, full_name, position, module, manager_id, controlled_module)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    u.id,
-                    u.full_name,
-                    position,
-                    MODULE_CERTIFICATION,
-                    u.manager_id,
-                    controlled_module,
-                ),
+def init_db() -> None:
+    """Проверяет версию схемы (при CERT_DB_AUTO_MIGRATE — мигрирует) и засевает профили."""
+    version = schema_version()
+    if version < SCHEMA_VERSION:
+        if not DB_AUTO_MIGRATE:
+            raise RuntimeError(
+                f"database schema is at version {version}, expected {SCHEMA_VERSION}; "
+                "run `python -m app.migrate`"
             )
+        migrate()
+    seed_user_profiles()
 
-        conn.commit()
+
+# Индексы под каждый путь доступа к certificates (все выборки сортируются по id DESC)
+_CERT_INDEXES = {
+    "idx_certificates_owner": "certificates (owner_id, id DESC)",
+    "idx_certificates_module": "certificates (effective_module, id DESC)",
+    "idx_certificates_exam_requests": "certificates (required_examiner_id, cert_type, workflow_status, id DESC)",
+    "idx_certificates_module_status": "certificates (effective_module, status_base, id DESC)",
+    "idx_certificates_expires_on": "certificates (status_base, expires_on)",
+}
+
+
+def _ensure_indexes(conn: sqlite3.Connection, *names: str) -> None:
+    for name in names:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {_CERT_INDEXES[name]}")
 
 
 # -------------------------
@@ -117,13 +540,50 @@ def init_db() -> None:
 # -------------------------
 
 
+_NOT_CACHED = object()
+
+
 def get_user_profile(user_id: int) -> Optional[Dict[str, Any]]:
+    """Профиль пользователя (через PROFILE_CACHE; сбрасывается в upsert_user_profile)."""
+    cached = PROFILE_CACHE.get(int(user_id), _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return dict(cached) if cached is not None else None
+
     with _connect() as conn:
         row = conn.execute(
             "SELECT user_id, full_name, position, module, manager_id, controlled_module FROM user_profiles WHERE user_id = ?",
             (int(user_id),),
         ).fetchone()
-    return dict(row) if row else None
+    profile = dict(row) if row else None
+    PROFILE_CACHE.set(int(user_id), profile)
+    return dict(profile) if profile is not None else None
+
+
+def get_user_profiles(user_ids: List[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Профили пачкой: {user_id: профиль или None}. Промахи кэша — одним запросом IN (...)."""
+    out: Dict[int, Optional[Dict[str, Any]]] = {}
+    missing: List[int] = []
+    for uid in {int(x) for x in user_ids}:
+        cached = PROFILE_CACHE.get(uid, _NOT_CACHED)
+        if cached is _NOT_CACHED:
+            missing.append(uid)
+        else:
+            out[uid] = dict(cached) if cached is not None else None
+
+    if missing:
+        placeholders = ",".join(["?"] * len(missing))
+        with _connect() as conn:
+            rows = conn.execute(
+                "SELECT user_id, full_name, position, module, manager_id, controlled_module FROM user_profiles"
+                f" WHERE user_id IN ({placeholders})",
+                missing,
+            ).fetchall()
+        found = {int(r["user_id"]): dict(r) for r in rows}
+        for uid in missing:
+            profile = found.get(uid)
+            PROFILE_CACHE.set(uid, profile)
+            out[uid] = dict(profile) if profile is not None else None
+    return out
 
 
 def list_user_profiles() -> List[Dict[str, Any]]:
@@ -164,6 +624,13 @@ def upsert_user_profile(
             ),
         )
         conn.commit()
+    invalidate_user(int(user_id))
+    ORG_INDEX.set_manager(int(user_id), manager_id)
+
+
+def refresh_org_index() -> None:
+    """Полностью перестроить индекс иерархии по текущим профилям."""
+    ORG_INDEX.load(list_user_profiles())
 
 
 # -------------------------
@@ -171,35 +638,286 @@ def upsert_user_profile(
 # -------------------------
 
 
-_CERT_SELECT = """
-    SELECT
+_CERT_PLAIN_COLUMNS = """
         id, owner_id, name, cert_type, topic,
         issued_at, expires_at, created_at,
         workflow_status, required_examiner_id, required_examiner_name,
         exam_grade, exam_date,
         snapshot_full_name, snapshot_position, snapshot_module,
         snapshot_manager_id, snapshot_manager_name,
-        revoked_by_id, revoked_by_name, revoked_reason, revoked_at
+        revoked_by_id, revoked_by_name, revoked_reason, revoked_at,
+        row_version, award_code
+"""
+
+# Итоговый статус: status_base, а для dated — по expires_on относительно сегодняшней даты
+_SQL_CERT_STATUS = """
+        CASE status_base
+            WHEN 'dated' THEN CASE
+                WHEN expires_on IS NULL THEN 'unknown'
+                WHEN expires_on >= date('now', 'localtime') THEN 'valid'
+                ELSE 'expired'
+            END
+            ELSE status_base
+        END"""
+
+_CERT_COLUMNS = f"""{_CERT_PLAIN_COLUMNS.rstrip()},{_SQL_CERT_STATUS} AS status
+"""
+
+_CERT_SELECT = f"""
+    SELECT {_CERT_COLUMNS}
     FROM certificates
 """
 
 
+_SQL_CERT_BY_ID = _CERT_SELECT + """
+    WHERE id = ?
+"""
+
+_SQL_CERTS_BY_OWNER = _CERT_SELECT + """
+    WHERE owner_id = ?
+    ORDER BY id DESC
+"""
+
+_SQL_CERTS_BY_MODULE = _CERT_SELECT + """
+    WHERE effective_module = ?
+    ORDER BY id DESC
+"""
+
+_SQL_EXAM_REQUESTS = _CERT_SELECT + """
+    WHERE required_examiner_id = ?
+      AND cert_type = 'internal'
+      AND workflow_status = 'pending_exam'
+    ORDER BY id DESC
+"""
+
+
+def _sql_certs_for_owners(count: int) -> str:
+    placeholders = ",".join(["?"] * count)
+    return _CERT_SELECT + f"""
+    WHERE owner_id IN ({placeholders})
+    ORDER BY id DESC
+"""
+
+
 def get_certificate(cert_id: int) -> Optional[Dict[str, Any]]:
     with _connect() as conn:
-        row = conn.execute(_CERT_SELECT + "\n            WHERE id = ?\n            ", (int(cert_id),)).fetchone()
+        row = conn.execute(_SQL_CERT_BY_ID, (int(cert_id),)).fetchone()
     return dict(row) if row else None
 
 
-def list_certificates(owner_id: int) -> List[Dict[str, Any]]:
-    with _connect() as conn:
+_SQL_PUBLIC_CERT = f"""
+    SELECT id, owner_id, cert_type, workflow_status, issued_at, expires_at,
+           snapshot_full_name, {_SQL_CERT_STATUS} AS status
+    FROM certificates
+    WHERE id = ?
+"""
+
+
+def get_public_certificate(cert_id: int) -> Optional[Dict[str, Any]]:
+    """Минимум полей для публичной проверки; читается через соединение только для чтения."""
+    with _connect(readonly=True) as conn:
+        row = conn.execute(_SQL_PUBLIC_CERT, (int(cert_id),)).fetchone()
+    return dict(row) if row else None
+
+
+VERIFY_MAX_IDS = int(os.getenv("CERT_VERIFY_MAX_IDS", "5000"))
+
+_SQL_PUBLIC_STATUS_BATCH = f"""
+    SELECT id, cert_type, workflow_status, expires_at, {_SQL_CERT_STATUS} AS status
+    FROM certificates
+    WHERE id IN (SELECT value FROM json_each(?))
+"""
+
+
+def get_public_statuses(cert_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Поля для публичного статуса по набору id — один запрос по первичному ключу.
+
+    id передаются одним JSON-параметром (json_each), поэтому размер пакета не
+    упирается в лимит числа параметров SQLite.
+    """
+    ids = list(dict.fromkeys(int(x) for x in cert_ids))
+    if len(ids) > VERIFY_MAX_IDS:
+        raise ValueError("too_many_ids")
+    if not ids:
+        return {}
+    with _connect(readonly=True) as conn:
+        rows = conn.execute(_SQL_PUBLIC_STATUS_BATCH, (json.dumps(ids),)).fetchall()
+    return {int(r["id"]): dict(r) for r in rows}
+
+
+def revocation_epoch(cert_id: int) -> int:
+    """seq последней записи revocation_log по сертификату (0 — изменений не было)."""
+    with _connect(readonly=True) as conn:
+        row = conn.execute(
+            "SELECT MAX(seq) FROM revocation_log WHERE cert_id = ?", (int(cert_id),)
+        ).fetchone()
+    return int(row[0] or 0)
+
+
+def revocation_changes(after_seq: int = 0, limit: int = 10000) -> List[Tuple[int, int, bool]]:
+    """Записи revocation_log после after_seq: [(seq, cert_id, invalid), ...] по возрастанию seq."""
+    with _connect(readonly=True) as conn:
         rows = conn.execute(
-            _CERT_SELECT
-            + """
-            WHERE owner_id = ?
-            ORDER BY id DESC
-            """,
-            (int(owner_id),),
+            "SELECT seq, cert_id, invalid FROM revocation_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (int(after_seq), int(limit)),
         ).fetchall()
+    return [(int(r[0]), int(r[1]), bool(r[2])) for r in rows]
+
+
+# id, чья последняя запись журнала до seq — «недействителен» (idx_revocation_log_cert)
+_SQL_REVOCATION_INVALID_IDS = """
+    SELECT l.cert_id FROM revocation_log l
+    WHERE l.invalid = 1 AND l.seq <= ?
+      AND l.seq = (SELECT MAX(seq) FROM revocation_log WHERE cert_id = l.cert_id AND seq <= ?)
+"""
+
+
+def revocation_invalid_ids() -> Tuple[int, List[int]]:
+    """(seq, ids): последний seq журнала и id, недействительные на этот seq
+    (начальное состояние RevocationState вместо проигрывания всего журнала)."""
+    with _connect(readonly=True) as conn:
+        conn.execute("BEGIN")
+        try:
+            seq = _revocation_head(conn)
+            rows = conn.execute(_SQL_REVOCATION_INVALID_IDS, (seq, seq)).fetchall()
+        finally:
+            conn.execute("COMMIT")
+    return seq, [int(r[0]) for r in rows]
+
+
+# --- Список недействительных для внешних проверяющих (снимок + дельты по seq) ---
+
+# Больше изменений в одной дельте — потребителю отвечаем «нужен снимок»
+REVOCATION_DELTA_MAX = int(os.getenv("CERT_REVOCATION_DELTA_MAX", "50000"))
+
+# Недействительные сейчас: отозван / ждёт экзамен / не сдан, просрочен.
+# Обе ветки идут по idx_certificates_expires_on (status_base, expires_on).
+_SQL_REVOCATION_SNAPSHOT = """
+    SELECT id FROM certificates WHERE status_base IN ('revoked', 'pending', 'invalid')
+    UNION
+    SELECT id FROM certificates WHERE status_base = 'dated' AND expires_on < ?
+"""
+
+# Текущее состояние сертификатов, менявшихся в (after, to]: выдача, отзыв, правка,
+# удаление (c.id IS NULL). Выдача уже просроченного тоже попадает сюда — через запись о выдаче.
+_SQL_REVOCATION_DELTA = """
+    SELECT DISTINCT l.cert_id, c.id IS NULL AS missing,
+           c.status_base != 'dated' OR COALESCE(c.expires_on < ?, 0) AS invalid
+    FROM revocation_log l
+    LEFT JOIN certificates c ON c.id = l.cert_id
+    WHERE l.seq > ? AND l.seq <= ?
+    LIMIT ?
+"""
+
+# Истёкшие по дате в [as_of, today): изменение без записи в журнал
+_SQL_REVOCATION_EXPIRED = """
+    SELECT id FROM certificates
+    WHERE status_base = 'dated' AND expires_on >= ? AND expires_on < ?
+"""
+
+
+class RevocationSnapshot(NamedTuple):
+    seq: int
+    as_of: str
+    max_id: int  # наибольший выданный id: всё, что больше, — не найдено
+    invalid: List[int]
+    missing: List[int]  # удалённые id из 1..max_id
+
+
+class RevocationDelta(NamedTuple):
+    from_seq: int
+    seq: int
+    as_of: str
+    max_id: int
+    invalid: List[int]
+    valid: List[int]
+    missing: List[int]
+
+
+def _revocation_head(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM revocation_log").fetchone()[0])
+
+
+def _max_issued_id(conn: sqlite3.Connection) -> int:
+    # AUTOINCREMENT: id не переиспользуются, sqlite_sequence помнит и удалённый максимум
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'certificates'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _read_revocation_snapshot(conn: sqlite3.Connection, seq: int, as_of: str) -> RevocationSnapshot:
+    max_id = _max_issued_id(conn)
+    invalid = sorted(int(r[0]) for r in conn.execute(_SQL_REVOCATION_SNAPSHOT, (as_of,)))
+    missing: List[int] = []
+    expected = 1
+    for (cid,) in conn.execute("SELECT id FROM certificates ORDER BY id"):
+        missing.extend(range(expected, cid))
+        expected = cid + 1
+    missing.extend(range(expected, max_id + 1))
+    return RevocationSnapshot(seq, as_of, max_id, invalid, missing)
+
+
+def _read_revocation_delta(
+    conn: sqlite3.Connection, seq: int, after_seq: int, as_of: str, today_iso: str
+) -> Optional[RevocationDelta]:
+    if after_seq > seq:
+        return None
+    rows = conn.execute(_SQL_REVOCATION_DELTA, (today_iso, after_seq, seq, REVOCATION_DELTA_MAX + 1)).fetchall()
+    expired = [int(r[0]) for r in conn.execute(_SQL_REVOCATION_EXPIRED, (as_of, today_iso))]
+    if len(rows) + len(expired) > REVOCATION_DELTA_MAX:
+        return None
+    missing = sorted(int(r[0]) for r in rows if r[1])
+    invalid = set(expired)
+    invalid.update(int(r[0]) for r in rows if not r[1] and r[2])
+    valid = sorted(int(r[0]) for r in rows if not r[1] and not r[2])
+    return RevocationDelta(after_seq, seq, today_iso, _max_issued_id(conn), sorted(invalid), valid, missing)
+
+
+def revocation_head() -> int:
+    """Последний seq журнала revocation_log (версия списка недействительных)."""
+    with _connect(readonly=True) as conn:
+        return _revocation_head(conn)
+
+
+def revocation_snapshot(
+    today: Optional[date] = None, *, delta_from: Optional[Tuple[int, str]] = None
+) -> Tuple[RevocationSnapshot, Optional[RevocationDelta]]:
+    """Согласованный снимок недействительных на текущий seq.
+
+    delta_from=(seq, as_of) — в той же транзакции и до того же seq построить
+    дельту от предыдущей публикации (None, если она не строится).
+    """
+    as_of = (today or date.today()).isoformat()
+    with _connect(readonly=True) as conn:
+        conn.execute("BEGIN")
+        try:
+            seq = _revocation_head(conn)
+            snapshot = _read_revocation_snapshot(conn, seq, as_of)
+            delta = None
+            if delta_from is not None:
+                delta = _read_revocation_delta(conn, seq, int(delta_from[0]), delta_from[1], as_of)
+        finally:
+            conn.execute("COMMIT")
+    return snapshot, delta
+
+
+def revocation_delta(after_seq: int, as_of: str, today: Optional[date] = None) -> Optional[RevocationDelta]:
+    """Изменения после (after_seq, as_of) потребителя: стали недействительны / действительны / удалены.
+
+    None — дельта не строится (seq из будущего или изменений больше
+    REVOCATION_DELTA_MAX): потребителю нужен новый снимок.
+    """
+    today_iso = (today or date.today()).isoformat()
+    with _connect(readonly=True) as conn:
+        conn.execute("BEGIN")
+        try:
+            return _read_revocation_delta(conn, _revocation_head(conn), int(after_seq), as_of, today_iso)
+        finally:
+            conn.execute("COMMIT")
+
+
+def list_certificates(owner_id: int) -> List[Dict[str, Any]]:
+    with _connect() as conn:
+        rows = conn.execute(_SQL_CERTS_BY_OWNER, (int(owner_id),)).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -208,49 +926,564 @@ def list_certificates_for_owners(owner_ids: List[int]) -> List[Dict[str, Any]]:
     if not owner_ids:
         return []
     ids = [int(x) for x in owner_ids]
-    placeholders = ",".join(["?"] * len(ids))
     with _connect() as conn:
-        rows = conn.execute(
-            _CERT_SELECT
-            + f"""
-            WHERE owner_id IN ({placeholders})
-            ORDER BY id DESC
-            """,
-            ids,
-        ).fetchall()
+        rows = conn.execute(_sql_certs_for_owners(len(ids)), ids).fetchall()
     return [dict(r) for r in rows]
 
 
 def list_certificates_by_module(module: str) -> List[Dict[str, Any]]:
     """Сертификаты в модуле (HR)."""
     with _connect() as conn:
-        rows = conn.execute(
-            _CERT_SELECT
-            + """
-            WHERE COALESCE(snapshot_module, ?) = ?
-            ORDER BY id DESC
-            """,
-            (module, module),
-        ).fetchall()
+        rows = conn.execute(_SQL_CERTS_BY_MODULE, (module,)).fetchall()
     return [dict(r) for r in rows]
 
 
 def list_exam_requests(examiner_id: int) -> List[Dict[str, Any]]:
     """Сертификаты, которые нужно принять (экзаменатор = текущий пользователь)."""
+    with _connect() as conn:
+        rows = conn.execute(_SQL_EXAM_REQUESTS, (int(examiner_id),)).fetchall()
+    return [dict(r) for r in rows]
+
+
+TEAM_PAGE_MAX = 500
+
+TEAM_STATUSES = ("valid", "expired", "revoked", "pending", "invalid", "unknown")
+TEAM_WORKFLOW_STATUSES = ("active", "pending_exam", "passed", "failed", "revoked")
+
+# Условие на итоговый статус по status_base / expires_on (то же, что колонка status в _CERT_COLUMNS)
+_STATUS_WHERE = {
+    "valid": "status_base = 'dated' AND expires_on >= date('now', 'localtime')",
+    "expired": "status_base = 'dated' AND expires_on < date('now', 'localtime')",
+    "unknown": "status_base = 'dated' AND expires_on IS NULL",
+    "revoked": "status_base = 'revoked'",
+    "pending": "status_base = 'pending'",
+    "invalid": "status_base = 'invalid'",
+}
+
+
+def _team_query(
+    *,
+    module: Optional[str],
+    owner_ids: Optional[List[int]],
+    filters: Optional[Dict[str, Any]],
+) -> Tuple[str, List[Any]]:
+    """WHERE для вкладки сотрудников: область (модуль HR или подчинённые) + фильтры.
+
+    Фильтры: status, workflow_status, cert_type, owner_id, award (gold/silver/bronze),
+    expires_from / expires_to (ISO-даты; бессрочные в диапазон не попадают),
+    module, position, expiry (perpetual / dated), q (полнотекстовый, как в поиске).
+    """
+    where: List[str] = []
+    params: List[Any] = []
+
+    if module is not None:
+        where.append("effective_module = ?")
+        params.append(module)
+    else:
+        ids = [int(x) for x in owner_ids or []]
+        where.append(f"owner_id IN ({','.join(['?'] * len(ids)) or 'NULL'})")
+        params.extend(ids)
+
+    f = filters or {}
+    if f.get("owner_id") is not None:
+        where.append("owner_id = ?")
+        params.append(int(f["owner_id"]))
+    if f.get("cert_type"):
+        where.append("cert_type = ?")
+        params.append(f["cert_type"])
+    if f.get("workflow_status"):
+        where.append("workflow_status = ?")
+        params.append(f["workflow_status"])
+    if f.get("status"):
+        where.append(_STATUS_WHERE[f["status"]])
+    if f.get("award"):
+        where.append("workflow_status = 'passed' AND award_code = ?")
+        params.append(f["award"])
+    if f.get("expires_from"):
+        where.append("expires_on >= ? AND expires_on < ?")
+        params.extend([f["expires_from"], PERPETUAL_DATE])
+    if f.get("expires_to"):
+        where.append("expires_on <= ?")
+        params.append(f["expires_to"])
+    if f.get("module"):
+        where.append("effective_module = ?")
+        params.append(f["module"])
+    if f.get("position"):
+        where.append("snapshot_position = ?")
+        params.append(f["position"])
+    if f.get("expiry") == "perpetual":
+        where.append("expires_on = ?")
+        params.append(PERPETUAL_DATE)
+    elif f.get("expiry") == "dated":
+        where.append("expires_on < ?")
+        params.append(PERPETUAL_DATE)
+    if f.get("q"):
+        match = fts_query(f["q"])
+        if match is None:
+            where.append("0")
+        else:
+            where.append("id IN (SELECT rowid FROM certificates_fts WHERE certificates_fts MATCH ?)")
+            params.append(match)
+
+    return " AND ".join(where), params
+
+
+def list_team_certificates(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """Страница сертификатов сотрудников (keyset по id DESC).
+
+    Возвращает (items, next_cursor); next_cursor=None — это последняя страница.
+    Без limit возвращает всё (как раньше).
+    """
+    if module is None and not owner_ids:
+        return [], None
+
+    where, params = _team_query(module=module, owner_ids=owner_ids, filters=filters)
+    if cursor is not None:
+        where += " AND id < ?"
+        params.append(int(cursor))
+    sql = _CERT_SELECT + f"\n    WHERE {where}\n    ORDER BY id DESC\n"
+    if limit is not None:
+        limit = max(1, min(int(limit), TEAM_PAGE_MAX))
+        sql += "    LIMIT ?\n"
+        params.append(limit + 1)
+
+    with _connect() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    items = [dict(r) for r in rows]
+
+    next_cursor = None
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        next_cursor = int(items[-1]["id"])
+    return items, next_cursor
+
+
+STREAM_CHUNK_SIZE = int(os.getenv("CERT_STREAM_CHUNK_SIZE", "500"))
+
+
+def iter_team_certificates(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    cursor: Optional[int] = None,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> Iterator[List[Dict[str, Any]]]:
+    """Потоковая выборка сертификатов сотрудников пачками по chunk_size строк.
+
+    Курсор держит отдельное соединение (не из пула потока), поэтому генератор
+    можно продвигать из любого потока; в WAL долгое чтение не блокирует запись.
+    """
+    if module is None and not owner_ids:
+        return
+
+    where, params = _team_query(module=module, owner_ids=owner_ids, filters=filters)
+    if cursor is not None:
+        where += " AND id < ?"
+        params.append(int(cursor))
+
+    conn = _open_connection(DB_PATH)
+    try:
+        cur = conn.execute(_CERT_SELECT + f"\n    WHERE {where}\n    ORDER BY id DESC\n", params)
+        while True:
+            rows = cur.fetchmany(max(1, int(chunk_size)))
+            if not rows:
+                break
+            yield [dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def count_team_certificates(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+) -> int:
+    if module is None and not owner_ids:
+        return 0
+    where, params = _team_query(module=module, owner_ids=owner_ids, filters=filters)
+    with _connect() as conn:
+        row = conn.execute(f"SELECT COUNT(*) FROM certificates WHERE {where}", params).fetchone()
+    return int(row[0]) if row else 0
+
+
+def team_facets(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+) -> Dict[str, List[str]]:
+    """Значения для фильтров вкладки сотрудников: модули и грейды в области."""
+    if module is None and not owner_ids:
+        return {"modules": [], "positions": []}
+    where, params = _team_query(module=module, owner_ids=owner_ids, filters=None)
+    with _connect() as conn:
+        modules = conn.execute(
+            f"SELECT DISTINCT effective_module FROM certificates WHERE {where} ORDER BY 1", params
+        ).fetchall()
+        positions = conn.execute(
+            f"SELECT DISTINCT snapshot_position FROM certificates WHERE {where} AND snapshot_position != '' ORDER BY 1",
+            params,
+        ).fetchall()
+    return {"modules": [r[0] for r in modules], "positions": [r[0] for r in positions]}
+
+
+# --- Статистика ---
+
+# Итоговый статус для строки агрегата (то же, что колонка status в _CERT_COLUMNS)
+_SQL_ROLLUP_STATUS = """
+    CASE state
+        WHEN 'dated' THEN CASE
+            WHEN expires_on = '' THEN 'unknown'
+            WHEN expires_on >= date('now', 'localtime') THEN 'valid'
+            ELSE 'expired'
+        END
+        ELSE state
+    END
+"""
+
+
+def certificate_stats(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """Счётчики сертификатов области: всего, по статусу, по типу и по награде (для сданных).
+
+    Для модуля (HR) читается cert_rollup — строк там порядка «типы × даты окончания»,
+    а не число сертификатов. Для набора сотрудников считается по индексу owner_id.
+    """
+    if module is not None:
+        sql = f"""
+            SELECT cert_type, award, {_SQL_ROLLUP_STATUS} AS status, SUM(n) AS n
+            FROM cert_rollup
+            WHERE module = ?
+            GROUP BY 1, 2, 3
+            HAVING SUM(n) > 0
+        """
+        params: List[Any] = [module]
+    elif owner_ids:
+        params = [int(x) for x in owner_ids]
+        sql = f"""
+            SELECT cert_type,
+                   CASE WHEN workflow_status = 'passed' THEN COALESCE(award_code, '') ELSE '' END AS award,
+                   {_SQL_CERT_STATUS} AS status,
+                   COUNT(*) AS n
+            FROM certificates
+            WHERE owner_id IN ({','.join(['?'] * len(params))})
+            GROUP BY 1, 2, 3
+        """
+    else:
+        sql, params = "", []
+
+    rows: List[sqlite3.Row] = []
+    if sql:
+        with _connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+    by_status = {s: 0 for s in TEAM_STATUSES}
+    by_type: Dict[str, Dict[str, int]] = {}
+    by_award = {a: 0 for a in AWARD_LABELS}
+    total = 0
+    for r in rows:
+        n = int(r["n"])
+        total += n
+        by_status[r["status"]] = by_status.get(r["status"], 0) + n
+        per_type = by_type.setdefault(r["cert_type"], {})
+        per_type[r["status"]] = per_type.get(r["status"], 0) + n
+        if r["award"]:
+            by_award[r["award"]] = by_award.get(r["award"], 0) + n
+    return {"total": total, "by_status": by_status, "by_cert_type": by_type, "by_award": by_award}
+
+
+# --- Полнотекстовый поиск ---
+
+SEARCH_LIMIT_MAX = 50
+SEARCH_MAX_TERMS = 8
+
+# Маркеры совпадений в snippet (в HTML их подставляет вызывающий код после экранирования)
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
+
+
+def _search_terms(text: str) -> List[str]:
+    text = str(text or "").replace("ё", "е").replace("Ё", "Е")
+    return re.findall(r"\w+", text)[:SEARCH_MAX_TERMS]
+
+
+def fts_query(text: str) -> Optional[str]:
+    """Пользовательский ввод -> запрос FTS5: каждое слово как префикс, все слова обязательны.
+
+    Синтаксис FTS5 (кавычки, NEAR, OR, «:») из ввода не пропускается.
+    """
+    terms = _search_terms(text)
+    if not terms:
+        return None
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def _snippet(item: Dict[str, Any], terms: List[str], size: int = 12) -> str:
+    """Фрагмент первого подходящего поля с подсвеченными словами (как snippet() в FTS5).
+
+    Считается в Python по уже выбранной строке: snippet() для префиксных запросов
+    заново разворачивает префикс по всему индексу на каждую строку.
+    """
+    prefixes = tuple(t.lower() for t in terms)
+    for col in _FTS_COLUMNS:
+        text = str(item.get(col) or "")
+        words = list(re.finditer(r"\w+", text))
+        hits = [i for i, w in enumerate(words) if w.group().lower().replace("ё", "е").startswith(prefixes)]
+        if not hits:
+            continue
+        start = max(0, min(hits[0] - 2, len(words) - size))
+        window = words[start:start + size]
+        out = ["…"] if start > 0 else []
+        pos = window[0].start()
+        for i, w in enumerate(window, start=start):
+            out.append(text[pos:w.start()])
+            out.append(f"{SNIPPET_OPEN}{w.group()}{SNIPPET_CLOSE}" if i in hits else w.group())
+            pos = w.end()
+        if start + size < len(words):
+            out.append("…")
+        else:
+            out.append(text[pos:])
+        return "".join(out).strip()
+    return ""
+
+
+def search_certificates(
+    query: str,
+    *,
+    viewer_id: int,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+    limit: int = 20,
+) -> List[Dict[str, Any]]:
+    """Поиск по сертификатам, видимым пользователю (правила can_view_certificate):
+    свои + модуль (HR) или подчинённые (руководитель). Лучшие по bm25 — первыми,
+    в каждой строке snippet с маркерами SNIPPET_OPEN / SNIPPET_CLOSE.
+    """
+    terms = _search_terms(query)
+    match = fts_query(query)
+    if match is None:
+        return []
+
+    visible = ["c.owner_id = ?"]
+    params: List[Any] = [match, int(viewer_id)]
+    if module is not None:
+        visible.append("c.effective_module = ?")
+        params.append(module)
+    if owner_ids:
+        ids = [int(x) for x in owner_ids]
+        visible.append(f"c.owner_id IN ({','.join(['?'] * len(ids))})")
+        params.extend(ids)
+    limit = max(1, min(int(limit), SEARCH_LIMIT_MAX))
+    params.append(limit)
+
+    # rank — bm25 с весами _FTS_WEIGHTS (задаются опцией rank таблицы, миграция 9);
+    # ранжируются все видимые совпадения, а не только последние
+    with _connect() as conn:
+        ranked = conn.execute(
+            f"""
+            SELECT certificates_fts.rowid AS id, certificates_fts.rank AS score
+            FROM certificates_fts
+            JOIN certificates c ON c.id = certificates_fts.rowid
+            WHERE certificates_fts MATCH ?
+              AND ({' OR '.join(visible)})
+            ORDER BY certificates_fts.rank
+            LIMIT ?
+            """,
+            params,
+        ).fetchall()
+        if not ranked:
+            return []
+        ids = [int(r["id"]) for r in ranked]
+        rows = conn.execute(
+            _CERT_SELECT + f" WHERE id IN ({','.join(['?'] * len(ids))})",
+            ids,
+        ).fetchall()
+
+    by_id = {int(r["id"]): dict(r) for r in rows}
+    out = []
+    for r in ranked:
+        item = by_id.get(int(r["id"]))
+        if item is not None:
+            item["score"] = round(-float(r["score"]), 4)
+            item["snippet"] = _snippet(item, terms)
+            out.append(item)
+    return out
+
+
+# --- Скоро истекающие ---
+
+# Окна (в днях), по которым раскладываются истекающие сертификаты
+EXPIRY_WINDOWS = sorted(
+    {int(x) for x in os.getenv("CERT_EXPIRY_WINDOWS", "7,30,90").split(",") if x.strip()}
+) or [30]
+
+
+def refresh_expiring_soon(today: Optional[date] = None) -> int:
+    """Пересобрать expiring_soon: действующие сертификаты с окончанием в [today, today + max окна].
+
+    Читается только диапазон idx_certificates_expires_on, а не вся таблица.
+    Каждой строке назначается наименьшее окно, в которое она попадает.
+    """
+    today = today or date.today()
+    bounds = [(today + timedelta(days=w)).isoformat() for w in EXPIRY_WINDOWS]
+    window_case = " ".join("WHEN expires_on <= ? THEN ?" for _ in EXPIRY_WINDOWS)
+    window_params = [p for pair in zip(bounds, EXPIRY_WINDOWS) for p in pair]
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM expiring_soon")
+        cur = conn.execute(
+            f"""
+            INSERT INTO expiring_soon (cert_id, owner_id, module, expires_on, window_days, refreshed_at)
+            SELECT id, owner_id, effective_module, expires_on,
+                   CASE {window_case} END,
+                   datetime('now')
+            FROM certificates
+            WHERE status_base = 'dated' AND expires_on >= ? AND expires_on <= ?
+            """,
+            (*window_params, today.isoformat(), bounds[-1]),
+        )
+        count = cur.rowcount
+        conn.commit()
+    return count
+
+
+def list_expiring_soon(
+    *,
+    module: Optional[str] = None,
+    owner_ids: Optional[List[int]] = None,
+    within_days: Optional[int] = None,
+    limit: int = TEAM_PAGE_MAX,
+) -> List[Dict[str, Any]]:
+    """Истекающие сертификаты области (модуль HR или сотрудники), ближайшие первыми.
+
+    Строка сверяется с certificates по первичному ключу, поэтому отозванные
+    или продлённые после последнего refresh_expiring_soon сюда не попадают.
+    """
+    if module is None and not owner_ids:
+        return []
+    where = ["c.status_base = 'dated'", "c.expires_on = e.expires_on", "e.expires_on >= date('now', 'localtime')"]
+    params: List[Any] = []
+    if module is not None:
+        where.append("e.module = ?")
+        params.append(module)
+    else:
+        ids = [int(x) for x in owner_ids or []]
+        where.append(f"e.owner_id IN ({','.join(['?'] * len(ids))})")
+        params.extend(ids)
+    if within_days is not None:
+        where.append("e.window_days <= ?")
+        params.append(int(within_days))
+    params.append(max(1, min(int(limit), TEAM_PAGE_MAX)))
+
+    columns = ", ".join(f"c.{c.strip()}" for c in _CERT_PLAIN_COLUMNS.split(","))
     with _connect() as conn:
         rows = conn.execute(
-            _CERT_SELECT
-            + """
-            WHERE required_examiner_id = ?
-              AND cert_type = 'internal'
-              AND workflow_status = 'pending_exam'
-            ORDER BY id DESC
+            f"""
+            SELECT {columns}, e.window_days, e.refreshed_at,
+                   CAST(julianday(e.expires_on) - julianday(date('now', 'localtime')) AS INTEGER) AS days_left
+            FROM expiring_soon e
+            JOIN certificates c ON c.id = e.cert_id
+            WHERE {' AND '.join(where)}
+            ORDER BY e.expires_on, e.cert_id
+            LIMIT ?
             """,
-            (int(examiner_id),),
+            params,
         ).fetchall()
     return [dict(r) for r in rows]
 
 
+def list_recent_certificate_ids(limit: int) -> List[int]:
+    """id последних сертификатов (для прогрева кэшей)."""
+    with _connect() as conn:
+        rows = conn.execute("SELECT id FROM certificates ORDER BY id DESC LIMIT ?", (int(limit),)).fetchall()
+    return [int(r[0]) for r in rows]
+
+
+def explain_cert_queries() -> Dict[str, List[str]]:
+    """EXPLAIN QUERY PLAN для всех выборок по certificates (имя -> строки плана)."""
+    queries = {
+        "get_certificate": (_SQL_CERT_BY_ID, (1,)),
+        "list_certificates": (_SQL_CERTS_BY_OWNER, (1,)),
+        "list_certificates_for_owners": (_sql_certs_for_owners(3), (1, 2, 3)),
+        "list_certificates_by_module": (_SQL_CERTS_BY_MODULE, (MODULE_CERTIFICATION,)),
+        "list_exam_requests": (_SQL_EXAM_REQUESTS, (1,)),
+    }
+    team_where, team_params = _team_query(
+        module=MODULE_CERTIFICATION,
+        owner_ids=None,
+        filters={"status": "valid", "cert_type": "internal"},
+    )
+    queries["list_team_certificates"] = (
+        _CERT_SELECT + f" WHERE {team_where} AND id < ? ORDER BY id DESC LIMIT ?",
+        tuple(team_params) + (1000, 51),
+    )
+    out: Dict[str, List[str]] = {}
+    with _connect() as conn:
+        for name, (sql, params) in queries.items():
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            out[name] = [str(r[3]) for r in rows]
+    return out
+
+
+def assert_indexed_queries() -> None:
+    """Проверка, что ни одна выборка по certificates не сканирует таблицу целиком."""
+    problems = []
+    for name, plan in explain_cert_queries().items():
+        for detail in plan:
+            # "SCAN certificates" (или "SCAN TABLE certificates" в старых SQLite),
+            # в том числе полный проход по индексу
+            if detail.startswith("SCAN") and "certificates" in detail:
+                problems.append(f"{name}: {detail}")
+    if problems:
+        raise RuntimeError("full table scan in certificate queries: " + "; ".join(problems))
+
+
+_CERT_INSERT = """
+    INSERT INTO certificates (
+        owner_id, name, issued_at, expires_at,
+        cert_type, topic, workflow_status,
+        required_examiner_id, required_examiner_name,
+        snapshot_full_name, snapshot_position, snapshot_module,
+        snapshot_manager_id, snapshot_manager_name,
+        status_base, expires_on
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _cert_insert_params(row: Dict[str, Any]) -> Tuple[Any, ...]:
+    required_examiner_id = row.get("required_examiner_id")
+    snapshot_manager_id = row.get("snapshot_manager_id")
+    return (
+        int(row["owner_id"]),
+        row["name"],
+        row["issued_at"],
+        row["expires_at"],
+        row["cert_type"],
+        row.get("topic"),
+        row["workflow_status"],
+        int(required_examiner_id) if required_examiner_id is not None else None,
+        row.get("required_examiner_name"),
+        row.get("snapshot_full_name"),
+        row.get("snapshot_position"),
+        row.get("snapshot_module"),
+        int(snapshot_manager_id) if snapshot_manager_id is not None else None,
+        row.get("snapshot_manager_name"),
+        status_base(row["cert_type"], row["workflow_status"]),
+        expires_on(row["expires_at"]),
+    )
+
+
 def add_certificate(
     *,
     owner_id: int,
@@ -268,38 +1501,90 @@ def add_certificate(
     snapshot_manager_id: Optional[int],
     snapshot_manager_name: Optional[str],
 ) -> Dict[str, Any]:
+    params = _cert_insert_params(
+        {
+            "owner_id": owner_id,
+            "name": name,
+            "issued_at": issued_at,
+            "expires_at": expires_at,
+            "cert_type": cert_type,
+            "topic": topic,
+            "workflow_status": workflow_status,
+            "required_examiner_id": required_examiner_id,
+            "required_examiner_name": required_examiner_name,
+            "snapshot_full_name": snapshot_full_name,
+            "snapshot_position": snapshot_position,
+            "snapshot_module": snapshot_module,
+            "snapshot_manager_id": snapshot_manager_id,
+            "snapshot_manager_name": snapshot_manager_name,
+        }
+    )
     with _connect() as conn:
-        cur = conn.execute(
-            """
-            INSERT INTO certificates (
-                owner_id, name, issued_at, expires_at,
-                cert_type, topic, workflow_status,
-                required_examiner_id, required_examiner_name,
-                snapshot_full_name, snapshot_position, snapshot_module,
-                snapshot_manager_id, snapshot_manager_name
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                int(owner_id),
-                name,
-                issued_at,
-                expires_at,
-                cert_type,
-                topic,
-                workflow_status,
-                int(required_examiner_id) if required_examiner_id is not None else None,
-                required_examiner_name,
-                snapshot_full_name,
-                snapshot_position,
-                snapshot_module,
-                int(snapshot_manager_id) if snapshot_manager_id is not None else None,
-                snapshot_manager_name,
-            ),
-        )
-        cert_id = int(cur.lastrowid)
-        row = conn.execute("SELECT * FROM certificates WHERE id = ?", (cert_id,)).fetchone()
+        row = conn.execute(_CERT_INSERT + f" RETURNING {_CERT_COLUMNS}", params).fetchone()
+        conn.commit()
+    # публичный кэш мог запомнить этот id как «не найден»
+    invalidate_certificate(int(row["id"]))
+    return dict(row)
+
+
+def add_certificates_bulk(rows: List[Dict[str, Any]]) -> int:
+    """Вставить пачку сертификатов одной транзакцией (executemany). Поля — как у add_certificate."""
+    if not rows:
+        return 0
+    params = [_cert_insert_params(r) for r in rows]
+    with _connect() as conn:
+        # под BEGIN IMMEDIATE id вставленных строк идут подряд после прежнего sqlite_sequence
+        conn.execute("BEGIN IMMEDIATE")
+        first = _max_issued_id(conn) + 1
+        conn.executemany(_CERT_INSERT, params)
+        last = _max_issued_id(conn)
         conn.commit()
-    return dict(row) if row else {"id": cert_id}
+    for cid in range(first, last + 1):
+        invalidate_certificate(cid)
+    return len(params)
+
+
+class VersionConflict(Exception):
+    """Сертификат уже изменён другим запросом (row_version не совпал с ожидаемым)."""
+
+    def __init__(self, current: Dict[str, Any]) -> None:
+        super().__init__("version_conflict")
+        self.current = current
+
+
+# Общие условия для UPDATE/DELETE: модуль HR и ожидаемая версия (NULL — без проверки)
+_GUARD_MODULE = "(? IS NULL OR effective_module = ?)"
+_GUARD_VERSION = "(? IS NULL OR row_version = ?)"
+
+
+def _guard_params(allowed_module: Optional[str], expected_version: Optional[int]) -> Tuple[Any, ...]:
+    module = allowed_module or None
+    version = int(expected_version) if expected_version is not None else None
+    return (module, module, version, version)
+
+
+def _write_failed(
+    conn: sqlite3.Connection,
+    cert_id: int,
+    *,
+    allowed_module: Optional[str] = None,
+    expected_version: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Условная запись не затронула строку — выясняем причину (только на пути ошибки).
+
+    Бросает ValueError / PermissionError / VersionConflict; иначе возвращает текущую строку.
+    """
+    row = conn.execute(_SQL_CERT_BY_ID, (int(cert_id),)).fetchone()
+    if not row:
+        raise ValueError("certificate_not_found")
+    cert = dict(row)
+    if allowed_module:
+        cert_module = cert.get("snapshot_module") or MODULE_CERTIFICATION
+        if cert_module != allowed_module:
+            raise PermissionError("module_mismatch")
+    if expected_version is not None and int(cert["row_version"]) != int(expected_version):
+        raise VersionConflict(cert)
+    return cert
 
 
 def set_exam_result(
@@ -309,35 +1594,44 @@ def set_exam_result(
     exam_grade: str,
     exam_date: str,
     workflow_status: str = "passed",
+    expected_version: Optional[int] = None,
 ) -> Dict[str, Any]:
     """Проставить оценку и дату сдачи. Доступно только назначенному экзаменатору."""
-    with _connect() as conn:
-        row = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
-        if not row:
-            raise ValueError("certificate_not_found")
-        cert = dict(row)
-
-        if cert.get("workflow_status") == "revoked":
-            raise PermissionError("revoked")
-
-        if cert.get("required_examiner_id") is None or int(cert.get("required_examiner_id")) != int(examiner_id):
-            raise PermissionError("not_examiner")
+    wf = str(workflow_status or "passed").strip().lower()
+    if wf not in ("passed", "failed"):
+        wf = "passed"
+    version = int(expected_version) if expected_version is not None else None
 
-        wf = str(workflow_status or "passed").strip().lower()
-        if wf not in ("passed", "failed"):
-            wf = "passed"
-
-        conn.execute(
-            """
+    with _connect() as conn:
+        row = conn.execute(
+            f"""
             UPDATE certificates
-            SET exam_grade = ?, exam_date = ?, workflow_status = ?
+            SET exam_grade = ?, exam_date = ?, workflow_status = ?,
+                award_code = ?,
+                status_base = CASE WHEN cert_type = 'internal' THEN ? ELSE 'dated' END,
+                row_version = row_version + 1
             WHERE id = ?
+              AND workflow_status != 'revoked'
+              AND required_examiner_id = ?
+              AND {_GUARD_VERSION}
+            RETURNING {_CERT_COLUMNS}
             """,
-            (exam_grade, exam_date, wf, int(cert_id)),
-        )
-        row2 = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
+            (
+                exam_grade, exam_date, wf,
+                normalize_award(exam_grade), status_base("internal", wf),
+                int(cert_id), int(examiner_id), version, version,
+            ),
+        ).fetchone()
+        if row is None:
+            cert = _write_failed(conn, cert_id)
+            if cert.get("workflow_status") == "revoked":
+                raise PermissionError("revoked")
+            if cert.get("required_examiner_id") is None or int(cert["required_examiner_id"]) != int(examiner_id):
+                raise PermissionError("not_examiner")
+            raise VersionConflict(cert)
         conn.commit()
-    return dict(row2) if row2 else cert
+    invalidate_certificate(int(cert_id))
+    return dict(row)
 
 
 def revoke_certificate(
@@ -347,35 +1641,56 @@ def revoke_certificate(
     hr_name: str,
     reason: str,
     allowed_module: Optional[str],
+    expected_version: Optional[int] = None,
 ) -> Dict[str, Any]:
-    """Отозвать сертификат (только HR)."""
+    """Отозвать сертификат (только HR, в пределах подконтрольного модуля)."""
     with _connect() as conn:
-        row = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
-        if not row:
-            raise ValueError("certificate_not_found")
-        cert = dict(row)
-
-        # Ограничение по подконтрольному модулю (если задано)
-        if allowed_module:
-            cert_module = cert.get("snapshot_module") or MODULE_CERTIFICATION
-            if cert_module != allowed_module:
-                raise PermissionError("module_mismatch")
-
-        conn.execute(
-            """
+        row = conn.execute(
+            f"""
             UPDATE certificates
             SET workflow_status = 'revoked',
                 revoked_by_id = ?,
                 revoked_by_name = ?,
                 revoked_reason = ?,
-                revoked_at = datetime('now')
-            WHERE id = ?
+                revoked_at = datetime('now'),
+                status_base = 'revoked',
+                row_version = row_version + 1
+            WHERE id = ? AND {_GUARD_MODULE} AND {_GUARD_VERSION}
+            RETURNING {_CERT_COLUMNS}
             """,
-            (int(hr_id), hr_name, reason, int(cert_id)),
-        )
-        row2 = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
+            (int(hr_id), hr_name, reason, int(cert_id), *_guard_params(allowed_module, expected_version)),
+        ).fetchone()
+        if row is None:
+            _write_failed(conn, cert_id, allowed_module=allowed_module, expected_version=expected_version)
+            raise RuntimeError("revoke_failed")
         conn.commit()
-    return dict(row2) if row2 else cert
+    invalidate_certificate(int(cert_id))
+    return dict(row)
+
+
+# Статус после снятия отзыва:
+# internal — passed/failed по оценке, без оценки — pending_exam (если назначен экзаменатор);
+# external — active
+_SQL_UNREVOKED_STATUS = """
+    CASE
+        WHEN cert_type = 'internal' AND COALESCE(exam_grade, '') != ''
+            THEN CASE WHEN exam_grade = 'Не сдан' THEN 'failed' ELSE 'passed' END
+        WHEN cert_type = 'internal' AND COALESCE(required_examiner_id, 0) != 0
+            THEN 'pending_exam'
+        ELSE 'active'
+    END
+"""
+
+# status_base для того же случая: failed -> invalid, pending_exam -> pending, иначе по дате
+_SQL_UNREVOKED_STATUS_BASE = """
+    CASE
+        WHEN cert_type = 'internal' AND COALESCE(exam_grade, '') != ''
+            THEN CASE WHEN exam_grade = 'Не сдан' THEN 'invalid' ELSE 'dated' END
+        WHEN cert_type = 'internal' AND COALESCE(required_examiner_id, 0) != 0
+            THEN 'pending'
+        ELSE 'dated'
+    END
+"""
 
 
 def unrevoke_certificate(
@@ -383,6 +1698,7 @@ def unrevoke_certificate(
     cert_id: int,
     hr_id: int,
     allowed_module: Optional[str],
+    expected_version: Optional[int] = None,
 ) -> Dict[str, Any]:
     """Снять отзыв сертификата (только HR).
 
@@ -391,46 +1707,217 @@ def unrevoke_certificate(
     - external: active
     """
     with _connect() as conn:
-        row = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
-        if not row:
-            raise ValueError("certificate_not_found")
-        cert = dict(row)
-
-        if cert.get("workflow_status") != 'revoked':
-            # нечего снимать — просто возвращаем
-            return cert
-
-        # Ограничение по подконтрольному модулю (если задано)
-        if allowed_module:
-            cert_module = cert.get("snapshot_module") or MODULE_CERTIFICATION
-            if cert_module != allowed_module:
-                raise PermissionError("module_mismatch")
-
-        new_status = 'active'
-        if str(cert.get('cert_type') or '') == 'internal':
-            if cert.get('exam_grade'):
-                new_status = 'failed' if str(cert.get('exam_grade')) == 'Не сдан' else 'passed'
-            else:
-                # если есть экзаменатор — значит ожидание экзамена
-                new_status = 'pending_exam' if cert.get('required_examiner_id') else 'active'
+        row = conn.execute(
+            f"""
+            UPDATE certificates
+            SET workflow_status = {_SQL_UNREVOKED_STATUS},
+                status_base = {_SQL_UNREVOKED_STATUS_BASE},
+                revoked_by_id = NULL,
+                revoked_by_name = NULL,
+                revoked_reason = NULL,
+                revoked_at = NULL,
+                row_version = row_version + 1
+            WHERE id = ? AND workflow_status = 'revoked' AND {_GUARD_MODULE} AND {_GUARD_VERSION}
+            RETURNING {_CERT_COLUMNS}
+            """,
+            (int(cert_id), *_guard_params(allowed_module, expected_version)),
+        ).fetchone()
+        if row is None:
+            cert = _write_failed(conn, cert_id)
+            if cert.get("workflow_status") != "revoked":
+                # нечего снимать — просто возвращаем
+                return cert
+            _write_failed(conn, cert_id, allowed_module=allowed_module, expected_version=expected_version)
+            raise RuntimeError("unrevoke_failed")
+        conn.commit()
+    invalidate_certificate(int(cert_id))
+    return dict(row)
 
-        conn.execute(
+
+# --- Массовые операции ---
+
+BULK_MAX_IDS = int(os.getenv("CERT_BULK_MAX_IDS", "1000"))
+
+
+def _bulk_ids(cert_ids: List[int]) -> List[int]:
+    ids = list(dict.fromkeys(int(x) for x in cert_ids))
+    if len(ids) > BULK_MAX_IDS:
+        raise ValueError("too_many_ids")
+    return ids
+
+
+def _bulk_targets(
+    conn: sqlite3.Connection, ids: List[int], allowed_sql: str, allowed_params: Tuple[Any, ...]
+) -> Dict[int, sqlite3.Row]:
+    """Одним запросом: состояние сертификатов и результат проверки прав (колонка allowed)."""
+    placeholders = ",".join(["?"] * len(ids))
+    rows = conn.execute(
+        f"""
+        SELECT id, workflow_status, ({allowed_sql}) AS allowed
+        FROM certificates
+        WHERE id IN ({placeholders})
+        """,
+        (*allowed_params, *ids),
+    ).fetchall()
+    return {int(r["id"]): r for r in rows}
+
+
+def _bulk_update(conn: sqlite3.Connection, sql: str, params: Tuple[Any, ...], ids: List[int]) -> None:
+    if ids:
+        placeholders = ",".join(["?"] * len(ids))
+        conn.execute(sql.format(ids=placeholders), (*params, *ids))
+
+
+def revoke_certificates(
+    *,
+    cert_ids: List[int],
+    hr_id: int,
+    hr_name: str,
+    reason: str,
+    allowed_module: Optional[str],
+) -> Dict[int, str]:
+    """Отозвать набор сертификатов одной транзакцией.
+
+    Возвращает исход по каждому id: revoked / already_revoked / module_mismatch / not_found.
+    """
+    ids = _bulk_ids(cert_ids)
+    if not ids:
+        return {}
+    out: Dict[int, str] = {}
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        targets = _bulk_targets(conn, ids, "? IS NULL OR effective_module = ?", (allowed_module or None,) * 2)
+        todo: List[int] = []
+        for cid in ids:
+            row = targets.get(cid)
+            if row is None:
+                out[cid] = "not_found"
+            elif not row["allowed"]:
+                out[cid] = "module_mismatch"
+            elif row["workflow_status"] == "revoked":
+                out[cid] = "already_revoked"
+            else:
+                out[cid] = "revoked"
+                todo.append(cid)
+        _bulk_update(
+            conn,
             """
             UPDATE certificates
-            SET workflow_status = ?,
+            SET workflow_status = 'revoked',
+                revoked_by_id = ?,
+                revoked_by_name = ?,
+                revoked_reason = ?,
+                revoked_at = datetime('now'),
+                status_base = 'revoked',
+                row_version = row_version + 1
+            WHERE id IN ({ids})
+            """,
+            (int(hr_id), hr_name, reason),
+            todo,
+        )
+    for cid in todo:
+        invalidate_certificate(cid)
+    return out
+
+
+def unrevoke_certificates(
+    *,
+    cert_ids: List[int],
+    hr_id: int,
+    allowed_module: Optional[str],
+) -> Dict[int, str]:
+    """Снять отзыв с набора сертификатов одной транзакцией.
+
+    Исходы: unrevoked / not_revoked / module_mismatch / not_found.
+    """
+    ids = _bulk_ids(cert_ids)
+    if not ids:
+        return {}
+    out: Dict[int, str] = {}
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        targets = _bulk_targets(conn, ids, "? IS NULL OR effective_module = ?", (allowed_module or None,) * 2)
+        todo: List[int] = []
+        for cid in ids:
+            row = targets.get(cid)
+            if row is None:
+                out[cid] = "not_found"
+            elif row["workflow_status"] != "revoked":
+                out[cid] = "not_revoked"
+            elif not row["allowed"]:
+                out[cid] = "module_mismatch"
+            else:
+                out[cid] = "unrevoked"
+                todo.append(cid)
+        _bulk_update(
+            conn,
+            f"""
+            UPDATE certificates
+            SET workflow_status = {_SQL_UNREVOKED_STATUS},
+                status_base = {_SQL_UNREVOKED_STATUS_BASE},
                 revoked_by_id = NULL,
                 revoked_by_name = NULL,
                 revoked_reason = NULL,
-                revoked_at = NULL
-            WHERE id = ?
+                revoked_at = NULL,
+                row_version = row_version + 1
+            WHERE id IN ({{ids}})
             """,
-            (new_status, int(cert_id)),
+            (),
+            todo,
         )
-        row2 = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
-        conn.commit()
-    return dict(row2) if row2 else cert
+    for cid in todo:
+        invalidate_certificate(cid)
+    return out
 
 
+def set_exam_results(
+    *,
+    examiner_id: int,
+    results: List[Tuple[int, str, str, str]],
+) -> Dict[int, str]:
+    """Проставить оценки пачкой: results — (cert_id, exam_grade, exam_date, workflow_status).
+
+    Права (назначенный экзаменатор) проверяются одним запросом на весь набор.
+    Исходы: updated / revoked / not_examiner / not_found.
+    """
+    by_id = {int(r[0]): r for r in results}
+    ids = _bulk_ids(list(by_id))
+    if not ids:
+        return {}
+    out: Dict[int, str] = {}
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        targets = _bulk_targets(conn, ids, "required_examiner_id = ?", (int(examiner_id),))
+        todo: List[Tuple[Any, ...]] = []
+        for cid in ids:
+            row = targets.get(cid)
+            if row is None:
+                out[cid] = "not_found"
+            elif row["workflow_status"] == "revoked":
+                out[cid] = "revoked"
+            elif not row["allowed"]:
+                out[cid] = "not_examiner"
+            else:
+                _, grade, exam_date, wf = by_id[cid]
+                wf = str(wf or "passed").strip().lower()
+                if wf not in ("passed", "failed"):
+                    wf = "passed"
+                out[cid] = "updated"
+                todo.append((grade, exam_date, wf, normalize_award(grade), status_base("internal", wf), cid))
+        conn.executemany(
+            """
+            UPDATE certificates
+            SET exam_grade = ?, exam_date = ?, workflow_status = ?,
+                award_code = ?,
+                status_base = CASE WHEN cert_type = 'internal' THEN ? ELSE 'dated' END,
+                row_version = row_version + 1
+            WHERE id = ?
+            """,
+            todo,
+        )
+    for *_, cid in todo:
+        invalidate_certificate(cid)
+    return out
 
 
 def update_certificate(
@@ -441,58 +1928,147 @@ def update_certificate(
     expires_at: str,
     topic: Optional[str],
     allowed_module: Optional[str],
+    expected_version: Optional[int] = None,
 ) -> Dict[str, Any]:
     """Редактировать сертификат (для HR).
 
     Ограничиваем редактирование подконтрольным модулем, если он задан.
+    Тема хранится только у внутренних сертификатов.
     """
     with _connect() as conn:
-        row = conn.execute('SELECT * FROM certificates WHERE id = ?', (int(cert_id),)).fetchone()
-        if not row:
-            raise ValueError('certificate_not_found')
-        cert = dict(row)
-
-        if allowed_module:
-            cert_module = cert.get('snapshot_module') or MODULE_CERTIFICATION
-            if cert_module != allowed_module:
-                raise PermissionError('module_mismatch')
-
-        cert_type = str(cert.get('cert_type') or 'external')
-        if cert_type != 'internal':
-            topic = None
-
-        conn.execute(
-            """
+        row = conn.execute(
+            f"""
             UPDATE certificates
-            SET name = ?, issued_at = ?, expires_at = ?, topic = ?
-            WHERE id = ?
+            SET name = ?, issued_at = ?, expires_at = ?, expires_on = ?,
+                topic = CASE WHEN cert_type = 'internal' THEN ? ELSE NULL END,
+                row_version = row_version + 1
+            WHERE id = ? AND {_GUARD_MODULE} AND {_GUARD_VERSION}
+            RETURNING {_CERT_COLUMNS}
             """,
-            (name, issued_at, expires_at, topic, int(cert_id)),
-        )
-        row2 = conn.execute('SELECT * FROM certificates WHERE id = ?', (int(cert_id),)).fetchone()
+            (
+                name, issued_at, expires_at, expires_on(expires_at), topic,
+                int(cert_id), *_guard_params(allowed_module, expected_version),
+            ),
+        ).fetchone()
+        if row is None:
+            _write_failed(conn, cert_id, allowed_module=allowed_module, expected_version=expected_version)
+            raise RuntimeError("update_failed")
         conn.commit()
-    return dict(row2) if row2 else cert
+    invalidate_certificate(int(cert_id))
+    return dict(row)
 
 
-def delete_certificate(*, cert_id: int, allowed_module: Optional[str]) -> None:
+def delete_certificate(
+    *,
+    cert_id: int,
+    allowed_module: Optional[str],
+    expected_version: Optional[int] = None,
+) -> None:
     """Удалить сертификат (для HR).
 
     Ограничиваем удаление подконтрольным модулем, если он задан.
     Удаление необратимо (для прототипа делаем физическое удаление).
     """
     with _connect() as conn:
-        row = conn.execute("SELECT * FROM certificates WHERE id = ?", (int(cert_id),)).fetchone()
-        if not row:
-            raise ValueError("certificate_not_found")
-        cert = dict(row)
+        row = conn.execute(
+            f"""
+            DELETE FROM certificates
+            WHERE id = ? AND {_GUARD_MODULE} AND {_GUARD_VERSION}
+            RETURNING id
+            """,
+            (int(cert_id), *_guard_params(allowed_module, expected_version)),
+        ).fetchone()
+        if row is None:
+            _write_failed(conn, cert_id, allowed_module=allowed_module, expected_version=expected_version)
+            raise RuntimeError("delete_failed")
+        conn.commit()
+    invalidate_certificate(int(cert_id))
 
-        if allowed_module:
-            cert_module = cert.get("snapshot_module") or MODULE_CERTIFICATION
-            if cert_module != allowed_module:
-                raise PermissionError("module_mismatch")
 
-        conn.execute("DELETE FROM certificates WHERE id = ?", (int(cert_id),))
-        conn.commit()
+def normalize_award(grade: Any) -> str | None:
+    """Нормализует оценку/шаблон к одному из: gold/silver/bronze.
+
+    В UI уровни называются: Light | Standart | Hard.
+    Внутри оставляем стабильные коды (gold/silver/bronze) и поддерживаем
+    совместимость со старыми значениями.
+    """
+    g = str(grade or "").strip().lower()
+    if not g:
+        return None
+    # поддержка старых числовых оценок
+    if g in ("5", "5.0"):
+        return "gold"
+    if g in ("4", "4.0"):
+        return "silver"
+    if g in ("3", "3.0", "2", "2.0"):
+        return "bronze"
+
+    # русские/англ варианты + новые уровни
+    if "зол" in g or g == "gold" or "hard" in g:
+        return "gold"
+    if "сереб" in g or g == "silver" or g in ("standart", "standard") or "standart" in g or "standard" in g:
+        return "silver"
+    if "брон" in g or g == "bronze" or "light" in g:
+        return "bronze"
+    return None
+
+
+AWARD_LABELS = {"gold": "Hard", "silver": "Standart", "bronze": "Light"}
+
+
+def award_label(grade: Any) -> str | None:
+    return AWARD_LABELS.get(normalize_award(grade) or "")
+
+
+# Хранимые поля статуса (пишутся вместе с сертификатом, см. _cert_insert_params):
+# status_base — статус по workflow: revoked | pending | invalid | dated («смотри дату»);
+# expires_on  — ISO-дата окончания; бессрочный = PERPETUAL_DATE, нераспознанная = NULL.
+# Итоговый статус: status_base, а для dated — сравнение expires_on с сегодняшней датой в SQL.
+
+PERPETUAL_DATE = "9999-12-31"
+
+STATUS_LABELS = {
+    "valid": "Действителен",
+    "expired": "Просрочен",
+    "unknown": "Неизвестно",
+    "revoked": "Отозван",
+    "pending": "Ожидает экзамен",
+    "invalid": "Недействителен",
+}
+
+
+def status_base(cert_type: Any, workflow_status: Any) -> str:
+    if workflow_status == "revoked":
+        return "revoked"
+    if cert_type == "internal":
+        if workflow_status == "pending_exam":
+            return "pending"
+        if workflow_status == "failed":
+            return "invalid"
+    return "dated"
+
+
+def expires_on(expires_at: Any) -> Optional[str]:
+    value = str(expires_at or "").strip()
+    if not value:
+        return PERPETUAL_DATE
+    try:
+        y, m, d = [int(x) for x in value.split("-")]
+        return date(y, m, d).isoformat()
+    except Exception:
+        return None
+
+
+def certificate_status(cert_type: Any, workflow_status: Any, expires_at: Any) -> Tuple[str, str]:
+    """Итоговый статус (code, label) сертификата с учётом отзыва и экзамена.
+
+    Коды: revoked | pending | invalid | valid | expired | unknown.
+    Для строк из БД то же самое уже посчитано в колонке status.
+    """
+    base = status_base(cert_type, workflow_status)
+    if base != "dated":
+        return base, STATUS_LABELS[base]
+    return compute_status(str(expires_at or ""))
 
 
 def compute_status(expires_at: str) -> Tuple[str, str]:
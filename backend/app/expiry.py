@@ -0,0 +1,84 @@
+"""Планировщик пересборки таблицы expiring_soon.
+
+Запускается одним отдельным процессом на БД (каждый прогон берёт BEGIN IMMEDIATE,
+поэтому запускать его в каждом воркере веб-приложения незачем):
+
+    python -m app.expiry           # пересобирать каждые CERT_EXPIRY_INTERVAL секунд
+    python -m app.expiry --once    # один прогон (например, из cron)
+
+CERT_EXPIRY_SCHEDULER=1 включает ту же задачу внутри приложения — только для
+развёртывания с одним воркером uvicorn.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+from . import adb, db
+
+
+log = logging.getLogger(__name__)
+
+EXPIRY_SCHEDULER = os.getenv("CERT_EXPIRY_SCHEDULER", "0") not in ("0", "false", "no")
+EXPIRY_INTERVAL = float(os.getenv("CERT_EXPIRY_INTERVAL", "3600"))
+
+
+class ExpiryScheduler:
+    """Периодически вызывает db.refresh_expiring_soon в пуле потоков БД."""
+
+    def __init__(self, interval: float = EXPIRY_INTERVAL) -> None:
+        self.interval = max(1.0, float(interval))
+        self._task: Optional[asyncio.Task] = None
+        self.last_count: Optional[int] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="expiry-scheduler")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.last_count = await adb.refresh_expiring_soon()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("expiring_soon refresh failed")
+            await asyncio.sleep(self.interval)
+
+
+EXPIRY_SCHEDULER_TASK = ExpiryScheduler()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.expiry", description="Пересборка expiring_soon")
+    parser.add_argument("--once", action="store_true", help="один прогон и выход")
+    parser.add_argument("--interval", type=float, default=EXPIRY_INTERVAL, help="пауза между прогонами, сек")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db.init_db()
+    while True:
+        count = db.refresh_expiring_soon()
+        log.info("expiring_soon: %d certificates within %s days", count, max(db.EXPIRY_WINDOWS))
+        if args.once:
+            return 0
+        time.sleep(max(1.0, args.interval))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Индекс иерархии подчинения (кто чей руководитель).
+
+Хранит для каждого сотрудника руководителя, прямых подчинённых и
+множество всех руководителей вверх по цепочке. Поэтому «все подчинённые X»
+отвечает за O(результата), а «X — руководитель Y» — за O(1).
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set
+
+from .users import USERS, USERS_BY_ID
+
+
+ORG_INDEX_TTL = float(os.getenv("CERT_ORG_INDEX_TTL", "60"))
+
+
+class OrgIndex:
+    def __init__(self, ttl: Optional[float] = ORG_INDEX_TTL) -> None:
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._parent: Dict[int, Optional[int]] = {}
+        self._children: Dict[int, Set[int]] = {}
+        self._ancestors: Dict[int, FrozenSet[int]] = {}
+        self._loaded_at: Optional[float] = None
+
+    # --- построение ---
+
+    def is_stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        return bool(self.ttl) and time.monotonic() - self._loaded_at > float(self.ttl)
+
+    def load(self, profiles: Iterable[Dict[str, Any]]) -> None:
+        """Полная перестройка по профилям из БД (руководитель из профиля важнее статического)."""
+        by_id = {int(p["user_id"]): p for p in profiles}
+        parent: Dict[int, Optional[int]] = {}
+        for u in USERS:
+            parent[u.id] = _effective_manager(u.id, (by_id.get(u.id) or {}).get("manager_id"))
+
+        with self._lock:
+            self._parent = parent
+            self._children = {}
+            for uid, mid in parent.items():
+                if mid is not None:
+                    self._children.setdefault(mid, set()).add(uid)
+            self._ancestors = {uid: self._walk_up(uid) for uid in parent}
+            self._loaded_at = time.monotonic()
+
+    def set_manager(self, user_id: int, manager_id: Optional[int]) -> None:
+        """Инкрементально перевесить сотрудника (после изменения профиля)."""
+        uid = int(user_id)
+        if uid not in USERS_BY_ID:
+            return
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            new_parent = _effective_manager(uid, manager_id)
+            old_parent = self._parent.get(uid)
+            if old_parent == new_parent:
+                return
+            if old_parent is not None:
+                self._children.get(old_parent, set()).discard(uid)
+            if new_parent is not None:
+                self._children.setdefault(new_parent, set()).add(uid)
+            self._parent[uid] = new_parent
+
+            # цепочка руководителей поменялась только у самого сотрудника и его поддерева
+            for sid in [uid] + self._collect_descendants(uid):
+                self._ancestors[sid] = self._walk_up(sid)
+
+    # --- запросы ---
+
+    def descendants(self, manager_id: int) -> List[int]:
+        """Все подчинённые (прямые и косвенные)."""
+        with self._lock:
+            return self._collect_descendants(int(manager_id))
+
+    def is_ancestor(self, manager_id: int, user_id: int) -> bool:
+        """Является ли manager_id руководителем (прямым или косвенным) user_id."""
+        return int(manager_id) in self._ancestors.get(int(user_id), frozenset())
+
+    # --- внутреннее (вызывается под self._lock) ---
+
+    def _walk_up(self, uid: int) -> FrozenSet[int]:
+        out: Set[int] = set()
+        cur = self._parent.get(uid)
+        while cur is not None and cur not in out:
+            out.add(cur)
+            cur = self._parent.get(cur)
+        return frozenset(out)
+
+    def _collect_descendants(self, uid: int) -> List[int]:
+        out: List[int] = []
+        stack: List[int] = list(self._children.get(uid, ()))
+        seen: Set[int] = set()
+        while stack:
+            cur = stack.pop()
+            if cur in seen:
+                continue
+            seen.add(cur)
+            out.append(cur)
+            stack.extend(self._children.get(cur, ()))
+        return out
+
+
+def _effective_manager(user_id: int, profile_manager_id: Any) -> Optional[int]:
+    if profile_manager_id is not None:
+        try:
+            return int(profile_manager_id)
+        except Exception:
+            return None
+    base = USERS_BY_ID.get(int(user_id))
+    return base.manager_id if base else None
+
+
+ORG_INDEX = OrgIndex()
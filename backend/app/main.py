@@ -1,50 +1,84 @@
 from __future__ import annotations
 
+import asyncio
+import codecs
+import csv
+import hashlib
+import html
+import json
+import logging
+import os
+import threading
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
 from pathlib import Path
 
-from typing import Any, Dict, Optional, List
-
-from io import BytesIO
-from xml.sax.saxutils import escape as xml_escape
-
-import qrcode
-import qrcode.image.svg
-
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.colors import HexColor
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, Optional, List, Set, Tuple
 
 from fastapi import FastAPI, Form, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 
+from . import adb
+from .cache import (
+    DISPLAY_USER_CACHE,
+    PDF_CACHE,
+    PUBLIC_CACHE_TTL,
+    PUBLIC_STATUS_CACHE,
+    QR_CACHE,
+    SVG_CACHE,
+    SVG_CACHE_GZIP,
+    cache_stats,
+    render_fingerprint,
+)
 from .db import (
+    AWARD_LABELS,
+    BULK_MAX_IDS,
     MODULES,
+    EXPIRY_WINDOWS,
     MODULE_CERTIFICATION,
-    add_certificate,
+    SNIPPET_CLOSE,
+    SNIPPET_OPEN,
+    STATUS_LABELS,
+    TEAM_STATUSES,
+    TEAM_WORKFLOW_STATUSES,
+    VERIFY_MAX_IDS,
+    VersionConflict,
+    award_label,
+    certificate_status,
     compute_status,
-    get_certificate,
     get_user_profile,
     init_db,
-    list_certificates,
-    list_certificates_by_module,
-    list_certificates_for_owners,
-    list_exam_requests,
-    list_user_profiles,
-    revoke_certificate,
-    unrevoke_certificate,
-    set_exam_result,
-    upsert_user_profile,
-    update_certificate,
-    delete_certificate,
+    iter_team_certificates,
+    list_recent_certificate_ids,
+    revocation_delta,
+    revocation_epoch,
+    revocation_head,
+    revocation_snapshot,
+    normalize_award,
+    refresh_org_index,
+)
+from .expiry import EXPIRY_SCHEDULER, EXPIRY_SCHEDULER_TASK
+from .hierarchy import ORG_INDEX, OrgIndex
+from .ratelimit import PUBLIC_LIMITER, client_ip
+from .revlist import KIND_DELTA, KIND_SNAPSHOT, encode as encode_revocations
+from .tokens import QR_SIGNED_TOKENS, REVOCATIONS, load_token, sign_token, token_view
+from .render import (
+    CERT_RENDER_FIELDS,
+    RENDERER,
+    RenderQueueFull,
+    certificate_pdf_bytes,
+    certificate_svg_variants,
+    qr_svg,
 )
 from .users import USERS, USERS_BY_ID, DisplayUser, get_user, group_users_for_login, make_display_user
 
 
+log = logging.getLogger(__name__)
+
 app = FastAPI(title="Реестр сертификатов")
 
 # Cookie-based session
@@ -59,9 +93,34 @@ app.mount("/static", StaticFiles(directory=str(BASE_DIR / "static")), name="stat
 @app.on_event("startup")
 def _startup() -> None:
     init_db()
+    refresh_org_index()
+    # с подписанными токенами ссылка в QR зависит от эпохи и ФИО — заранее не прогреть
+    if QR_PUBLIC_BASE_URL and QR_WARM_COUNT > 0 and not QR_SIGNED_TOKENS:
+        threading.Thread(target=warm_qr_cache, name="qr-warmup", daemon=True).start()
+    # начальное состояние журнала отзывов — в фоне, а не в первом запросе с токеном
+    if QR_SIGNED_TOKENS:
+        threading.Thread(target=warm_revocations, name="revocations-warmup", daemon=True).start()
+
+
+@app.on_event("startup")
+async def _start_expiry_scheduler() -> None:
+    # по умолчанию expiring_soon пересобирает отдельный процесс `python -m app.expiry`
+    if EXPIRY_SCHEDULER:
+        EXPIRY_SCHEDULER_TASK.start()
+
+
+@app.on_event("shutdown")
+async def _stop_expiry_scheduler() -> None:
+    await EXPIRY_SCHEDULER_TASK.stop()
+
+
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    RENDERER.shutdown()
+    adb.shutdown()
 
 
-def current_user(request: Request) -> DisplayUser | None:
+async def current_user(request: Request) -> DisplayUser | None:
     uid = request.session.get("user_id")
     if uid is None:
         return None
@@ -69,37 +128,41 @@ def current_user(request: Request) -> DisplayUser | None:
         base = USERS_BY_ID.get(int(uid))
         if base is None:
             return None
-        profile = get_user_profile(base.id)
-        return make_display_user(base, profile)
+        user = DISPLAY_USER_CACHE.get(base.id)
+        if user is None:
+            profile = (await request_profiles(request, [base.id])).get(base.id)
+            user = make_display_user(base, profile)
+            DISPLAY_USER_CACHE.set(base.id, user)
+        return user
     except Exception:
         return None
 
 
-_PDF_FONTS_READY = False
+async def request_profiles(request: Request, user_ids: Iterable[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Профили в рамках запроса (identity map): каждый пользователь загружается один раз.
 
+    Недостающие профили добираются одним пакетным запросом.
+    """
+    known: Optional[Dict[int, Optional[Dict[str, Any]]]] = getattr(request.state, "profiles", None)
+    if known is None:
+        known = {}
+        request.state.profiles = known
 
-def ensure_pdf_fonts() -> None:
-    """Регистрирует шрифты с кириллицей для PDF (best-effort)."""
-    global _PDF_FONTS_READY
-    if _PDF_FONTS_READY:
-        return
-
-    font_pairs = [
-        ("DejaVu", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
-        ("DejaVu-Bold", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
-    ]
+    ids = [int(x) for x in user_ids]
+    missing = [uid for uid in ids if uid not in known]
+    if missing:
+        known.update(await adb.get_user_profiles(missing))
+    return {uid: known.get(uid) for uid in ids}
 
-    for name, fpath in font_pairs:
-        try:
-            if Path(fpath).exists():
-                pdfmetrics.registerFont(TTFont(name, fpath))
-        except Exception:
-            pass
 
-    _PDF_FONTS_READY = True
+async def display_users(request: Request, user_ids: Iterable[int]) -> Dict[int, DisplayUser]:
+    """DisplayUser для известных пользователей (через request_profiles)."""
+    ids = [int(x) for x in user_ids if int(x) in USERS_BY_ID]
+    profiles = await request_profiles(request, ids)
+    return {uid: make_display_user(USERS_BY_ID[uid], profiles.get(uid)) for uid in ids}
 
 
-def can_view_certificate(user: DisplayUser, cert: Dict[str, Any]) -> bool:
+async def can_view_certificate(user: DisplayUser, cert: Dict[str, Any]) -> bool:
     """Доступ к сертификату: владелец / руководитель / HR (по модулю)."""
     try:
         owner_id = int(cert.get("owner_id") or 0)
@@ -114,71 +177,10 @@ def can_view_certificate(user: DisplayUser, cert: Dict[str, Any]) -> bool:
         cert_module = cert.get("snapshot_module") or MODULE_CERTIFICATION
         return cert_module == allowed
 
-    return owner_id in descendant_user_ids(user.id)
+    return (await org_index()).is_ancestor(user.id, owner_id)
 
 
 
-def normalize_award(grade: Any) -> str | None:
-    """Нормализует оценку/шаблон к одному из: gold/silver/bronze.
-
-    В UI уровни называются: Light | Standart | Hard.
-    Внутри оставляем стабильные коды (gold/silver/bronze) и поддерживаем
-    совместимость со старыми значениями.
-    """
-    g = str(grade or "").strip().lower()
-    if not g:
-        return None
-    # поддержка старых числовых оценок
-    if g in ("5", "5.0"):
-        return "gold"
-    if g in ("4", "4.0"):
-        return "silver"
-    if g in ("3", "3.0", "2", "2.0"):
-        return "bronze"
-
-    # русские/англ варианты + новые уровни
-    if "зол" in g or g == "gold" or "hard" in g:
-        return "gold"
-    if "сереб" in g or g == "silver" or g in ("standart", "standard") or "standart" in g or "standard" in g:
-        return "silver"
-    if "брон" in g or g == "bronze" or "light" in g:
-        return "bronze"
-    return None
-
-
-def award_label(grade: Any) -> str | None:
-    a = normalize_award(grade)
-    if a == "gold":
-        return "Hard"
-    if a == "silver":
-        return "Standart"
-    if a == "bronze":
-        return "Light"
-    return None
-
-
-def award_palette(cert: Dict[str, Any]) -> Dict[str, str]:
-    """Цветовая палитра сертификата в зависимости от оценки."""
-    # Если экзамен не сдан — выделяем красным (внутри системы)
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
-        return {
-            "accent": "#d93025",
-            "accent_light": "#FDECEA",
-            "accent_border": "#F6B8B2",
-            "accent_text": "#b3261e",
-        }
-
-    a = normalize_award(cert.get("exam_grade")) if cert.get("workflow_status") == "passed" else None
-    if a == "gold":
-        return {"accent": "#C9A227", "accent_light": "#FFF7D1", "accent_border": "#E2CD6A", "accent_text": "#8A6A00"}
-    if a == "silver":
-        return {"accent": "#7B8794", "accent_light": "#F0F3F7", "accent_border": "#C7D0DA", "accent_text": "#4A5562"}
-    if a == "bronze":
-        return {"accent": "#B87333", "accent_light": "#F6E6D7", "accent_border": "#D7A47A", "accent_text": "#7A3F10"}
-    # default
-    return {"accent": "#2157ff", "accent_light": "#EEF3FF", "accent_border": "#AFC3FF", "accent_text": "#2157ff"}
-
-
 def public_status(cert: Dict[str, Any]) -> Dict[str, str]:
     """Статус для публичного просмотра (без авторизации).
 
@@ -194,7 +196,7 @@ def public_status(cert: Dict[str, Any]) -> Dict[str, str]:
         return {"code": "invalid", "label": "Недействителен"}
 
     # 2) Просрочен по сроку
-    status, _ = compute_status(str(cert.get("expires_at") or ""))
+    status = cert.get("status") or compute_status(str(cert.get("expires_at") or ""))[0]
     if status == "expired":
         return {"code": "invalid", "label": "Недействителен"}
 
@@ -206,269 +208,247 @@ def public_status(cert: Dict[str, Any]) -> Dict[str, str]:
     return {"code": "valid", "label": "Действителен"}
 
 
-def _wf_label(cert: Dict[str, Any]) -> str:
-    if cert.get("workflow_status") == "revoked":
-        return "ОТОЗВАН"
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
-        return "ОЖИДАЕТ ЭКЗАМЕН"
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
-        return "ЭКЗАМЕН СДАН"
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
-        return "ЭКЗАМЕН НЕ СДАН"
-    return "ДЕЙСТВИТЕЛЕН"
-
-
-def certificate_svg(cert: Dict[str, Any]) -> str:
-    """Генерирует SVG-картинку сертификата на лету."""
-    cid = str(cert.get("id", ""))
-    full_name = str(cert.get("snapshot_full_name") or "")
-    position = str(cert.get("snapshot_position") or "")
-    module = str(cert.get("snapshot_module") or MODULE_CERTIFICATION)
-    name = str(cert.get("name") or "Сертификат")
-    cert_type = "Внутренний" if cert.get("cert_type") == "internal" else "Внешний"
-    topic = str(cert.get("topic") or "")
-    issued = str(cert.get("issued_at") or "")
-    expires = str(cert.get("expires_at") or "")
-    expires_label = expires if str(expires).strip() else "Бессрочно"
-
-    pal = award_palette(cert)
-    accent = pal["accent"]
-    accent_light = pal["accent_light"]
-    accent_border = pal["accent_border"]
-    accent_text = pal["accent_text"]
-
-    wf = _wf_label(cert)
-    extra = ""
-    if cert.get("workflow_status") == "revoked":
-        extra = f"HR: {cert.get('revoked_by_name') or '—'} • Причина: {cert.get('revoked_reason') or '—'}"
-    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
-        extra = f"Экзаменатор: {cert.get('required_examiner_name') or '—'}"
-    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
-        g = award_label(cert.get("exam_grade")) or cert.get("exam_grade") or "—"
-        d = cert.get("exam_date") or ""
-        extra = f"Экзамен: {g} {('(' + d + ')') if d else ''}"
-    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
-        d = cert.get("exam_date") or ""
-        extra = f"Экзамен: не сдан {('(' + d + ')') if d else ''}"
-
-    def x(s: str) -> str:
-        return xml_escape(s or "")
-
-    return f"""<?xml version='1.0' encoding='UTF-8'?>
-<svg xmlns='http://www.w3.org/2000/svg' width='1200' height='800' viewBox='0 0 1200 800'>
-  <defs>
-    <linearGradient id='bg' x1='0' y1='0' x2='1' y2='1'>
-      <stop offset='0%' stop-color='{x(accent_light)}'/>
-      <stop offset='100%' stop-color='#ffffff'/>
-    </linearGradient>
-  </defs>
-  <rect x='0' y='0' width='1200' height='800' fill='url(#bg)'/>
-  <rect x='60' y='60' width='1080' height='680' rx='28' fill='#fff' stroke='rgba(0,0,0,0.12)' stroke-width='2'/>
-
-  <text x='600' y='150' text-anchor='middle' font-size='56' font-family='Inter, Arial, sans-serif' font-weight='700'>СЕРТИФИКАТ</text>
-  <text x='600' y='195' text-anchor='middle' font-size='20' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>№ {x(cid)} • {x(module)}</text>
-
-  <text x='600' y='285' text-anchor='middle' font-size='28' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>Подтверждает, что</text>
-  <text x='600' y='350' text-anchor='middle' font-size='44' font-family='Inter, Arial, sans-serif' font-weight='700'>{x(full_name)}</text>
-  <text x='600' y='390' text-anchor='middle' font-size='22' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(position)}</text>
-
-  <text x='600' y='470' text-anchor='middle' font-size='24' font-family='Inter, Arial, sans-serif'>{x(name)}</text>
-  <text x='600' y='505' text-anchor='middle' font-size='18' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(cert_type)}{(' • ' + x(topic)) if topic else ''}</text>
-
-  <text x='600' y='575' text-anchor='middle' font-size='18' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>Выдан: {x(issued)} • Действителен до: {x(expires_label)}</text>
-
-  <g>
-    <rect x='440' y='610' width='320' height='44' rx='14' fill='{x(accent_light)}' stroke='{x(accent_border)}'/>
-    <text x='600' y='640' text-anchor='middle' font-size='16' font-family='Inter, Arial, sans-serif' fill='{x(accent_text)}' font-weight='700'>{x(wf)}</text>
-  </g>
-
-  <text x='600' y='690' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(extra)}</text>
-
-  <line x1='240' y1='720' x2='560' y2='720' stroke='rgba(0,0,0,0.22)'/>
-  <text x='400' y='748' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.55)'>Подпись / Печать</text>
-
-  <line x1='640' y1='720' x2='960' y2='720' stroke='rgba(0,0,0,0.22)'/>
-  <text x='800' y='748' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.55)'>Ответственный</text>
-</svg>
-"""
-
-
-def certificate_pdf_bytes(cert: Dict[str, Any]) -> bytes:
-    """Генерирует PDF сертификата на лету."""
-    ensure_pdf_fonts()
-
-    reg = set(pdfmetrics.getRegisteredFontNames())
-    font = "DejaVu" if "DejaVu" in reg else "Helvetica"
-    font_bold = "DejaVu-Bold" if "DejaVu-Bold" in reg else "Helvetica-Bold"
-
-    buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
-
-    pal = award_palette(cert)
-    accent = HexColor(pal["accent"])
-    accent_light = HexColor(pal["accent_light"])
-
-    # рамка + цветовой акцент (по оценке)
-    c.setLineWidth(1)
-    c.setStrokeColor(accent)
-    c.roundRect(36, 36, width - 72, height - 72, 18, stroke=1, fill=0)
-
-    # верхняя плашка-шаблон
-    c.setFillColor(accent_light)
-    c.roundRect(36, height - 140, width - 72, 70, 18, stroke=0, fill=1)
-    c.setFillColor(HexColor('#000000'))
-
-    c.setFont(font_bold, 26)
-    c.drawCentredString(width / 2, height - 90, "СЕРТИФИКАТ")
-    c.setFont(font, 12)
-    c.drawCentredString(width / 2, height - 115, f"№ {cert.get('id', '')} • {cert.get('snapshot_module') or MODULE_CERTIFICATION}")
-
-    y = height - 170
-
-    lines = [
-        ("ФИО", cert.get("snapshot_full_name") or ""),
-        ("Должность", cert.get("snapshot_position") or ""),
-        ("Название", cert.get("name") or ""),
-        ("Тип", "Внутренний" if cert.get("cert_type") == "internal" else "Внешний"),
-        ("Профиль", cert.get("topic") or "—"),
-        ("Дата выдачи", cert.get("issued_at") or ""),
-        ("Действителен до", cert.get("expires_at") or "Бессрочно"),
-    ]
-
-    if cert.get("cert_type") != "internal":
-        lines[4] = ("Профиль", "—")
-
-    for k, v in lines:
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, f"{k}:")
-        c.setFont(font, 12)
-        c.drawString(190, y, str(v))
-        y -= 18
-
-    y -= 10
-
-    c.setFont(font_bold, 12)
-    c.drawString(70, y, "Статус:")
-    c.setFont(font, 12)
-    c.drawString(190, y, _wf_label(cert))
-    y -= 18
+# --- Публичная проверка (QR): отдельный быстрый путь ---
 
-    if cert.get("workflow_status") == "revoked":
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, "Отозван:")
-        c.setFont(font, 12)
-        c.drawString(190, y, f"{cert.get('revoked_by_name') or '—'}")
-        y -= 18
-
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, "Причина:")
-        c.setFont(font, 12)
-        c.drawString(190, y, f"{cert.get('revoked_reason') or '—'}")
-        y -= 18
-
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, "Экзаменатор:")
-        c.setFont(font, 12)
-        c.drawString(190, y, f"{cert.get('required_examiner_name') or '—'}")
-        y -= 18
-
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, "Экзамен:")
-        c.setFont(font, 12)
-        grade = award_label(cert.get("exam_grade")) or cert.get("exam_grade") or "—"
-        dt = cert.get("exam_date") or ""
-        c.drawString(190, y, f"Оценка {grade} {('(' + dt + ')') if dt else ''}")
-        y -= 18
-
-    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
-        c.setFont(font_bold, 12)
-        c.drawString(70, y, "Экзамен:")
-        c.setFont(font, 12)
-        dt = cert.get("exam_date") or ""
-        c.drawString(190, y, f"Не сдан {('(' + dt + ')') if dt else ''}")
-        y -= 18
-
-    # подписи
-    c.line(70, 110, 270, 110)
-    c.setFont(font, 10)
-    c.drawString(70, 95, "Подпись")
-
-    c.line(width - 270, 110, width - 70, 110)
-    c.drawRightString(width - 70, 95, "Ответственный")
-
-    c.showPage()
-    c.save()
-    buf.seek(0)
-    return buf.getvalue()
+# Сколько публичных запросов к БД может выполняться одновременно (сверх — 503)
+PUBLIC_MAX_INFLIGHT = int(os.getenv("CERT_PUBLIC_MAX_INFLIGHT", "64"))
 
+_public_inflight = 0
 
 
+def public_admit(request: Request) -> None:
+    """Допуск публичного запроса по IP; при превышении — 429 с Retry-After."""
+    ok, retry_after = PUBLIC_LIMITER.acquire(client_ip(request))
+    if not ok:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
 
-def decorate_cert(item: Dict[str, Any]) -> Dict[str, Any]:
-    """Добавляет поля status/status_label, учитывая отзыв HR."""
-    if item.get("workflow_status") == "revoked":
-        item["status"] = "revoked"
-        item["status_label"] = "Отозван"
-        return item
 
-    # Внутренний сертификат не должен считаться действительным,
-    # пока экзамен не сдан (или если экзамен провален)
-    if item.get("cert_type") == "internal":
-        if item.get("workflow_status") == "pending_exam":
-            item["status"] = "pending"
-            item["status_label"] = "Ожидает экзамен"
-            return item
-        if item.get("workflow_status") == "failed":
-            item["status"] = "invalid"
-            item["status_label"] = "Недействителен"
-            return item
+async def public_view(cert_id: int) -> Optional[Dict[str, Any]]:
+    """Публичное представление сертификата (статус, ФИО, сроки) с коротким кэшем.
+
+    Читает через отдельный пул и соединения только для чтения (adb.run_public),
+    чтобы сканы QR не конкурировали с внутренними пользователями.
+    """
+    global _public_inflight
+    view = PUBLIC_STATUS_CACHE.get(int(cert_id))
+    if view is not None:
+        return view or None
+
+    if _public_inflight >= PUBLIC_MAX_INFLIGHT:
+        raise HTTPException(status_code=503, detail="Busy", headers={"Retry-After": "1"})
+    _public_inflight += 1
+    try:
+        cert = await adb.get_public_certificate(int(cert_id))
+        full_name = str((cert or {}).get("snapshot_full_name") or "").strip()
+        owner_id = int((cert or {}).get("owner_id") or 0)
+        if cert is not None and not full_name and owner_id in USERS_BY_ID:
+            profile = await adb.run_public(get_user_profile, owner_id)
+            full_name = make_display_user(USERS_BY_ID[owner_id], profile).full_name
+    finally:
+        _public_inflight -= 1
+
+    if cert is None:
+        # Несуществующий id тоже кэшируем, чтобы перебор не ходил в БД
+        PUBLIC_STATUS_CACHE.set(int(cert_id), {})
+        return None
+
+    st = public_status(cert)
+    expires_at = str(cert.get("expires_at") or "").strip()
+    view = {
+        "id": int(cert["id"]),
+        "status": st["code"],
+        "label": st["label"],
+        "full_name": full_name or "—",
+        "issued_at": str(cert.get("issued_at") or "—"),
+        "expires_at": expires_at or None,
+    }
+    PUBLIC_STATUS_CACHE.set(int(cert_id), view)
+    return view
+
+
+async def token_public_view(token: str) -> Optional[Dict[str, Any]]:
+    """Публичное представление по подписанному токену из QR.
+
+    Ответ строится из токена и журнала отзывов в памяти; только если
+    сертификат менялся после подписи, проверка идёт через public_view().
+    """
+    claims = load_token(token)
+    if claims is None:
+        return None
+    if REVOCATIONS.needs_prepare(claims.cert_id, claims.epoch):
+        await adb.run_public(REVOCATIONS.prepare, claims.cert_id, claims.epoch)
+    view = token_view(claims)
+    if view is None:
+        view = await public_view(claims.cert_id)
+    return view
+
+
+async def share_url_for(request: Request, cert: Dict[str, Any]) -> str:
+    """Ссылка для QR: с подписанным токеном (CERT_QR_SIGNED_TOKENS) для действительных
+    сертификатов, иначе /certificate/{id}."""
+    cert_id = int(cert["id"])
+    if QR_SIGNED_TOKENS and cert.get("status") == "valid":
+        full_name = str(cert.get("snapshot_full_name") or "").strip()
+        owner_id = int(cert.get("owner_id") or 0)
+        if not full_name and owner_id:
+            du = (await display_users(request, [owner_id])).get(owner_id)
+            full_name = du.full_name if du is not None else ""
+        epoch = await adb.run_public(revocation_epoch, cert_id)
+        token = sign_token(cert_id, full_name, str(cert.get("issued_at") or ""), str(cert.get("expires_at") or ""), epoch)
+        return str(request.url_for("token_page", token=token))
+    return str(request.url_for("certificate_page", cert_id=cert_id))
+
+
+QR_BOX_SIZE = 10
+QR_BORDER = 2
+
+# Внешний адрес приложения (например https://certs.example.com) — нужен только
+# для прогрева кэша QR при старте: ссылки должны совпадать с request.url_for().
+QR_PUBLIC_BASE_URL = os.getenv("CERT_PUBLIC_BASE_URL", "").rstrip("/")
+QR_WARM_COUNT = int(os.getenv("CERT_QR_WARM_COUNT", "200"))
+
 
+async def qr_svg_bytes(url: str, box_size: int = QR_BOX_SIZE, border: int = QR_BORDER) -> bytes:
+    """SVG QR-кода для ссылки (мемоизировано: результат зависит только от аргументов)."""
+    key = (url, int(box_size), int(border))
+    data = QR_CACHE.get(key)
+    if data is None:
+        data = await render(qr_svg, url, int(box_size), int(border))
+        QR_CACHE.set(key, data)
+    return data
+
+
+def warm_qr_cache() -> None:
+    """Прогрев кэша QR для последних сертификатов (best-effort, в фоне).
+
+    Ссылки те же, что строит share_url_for() без токенов; с CERT_QR_SIGNED_TOKENS
+    прогрев не запускается.
+    """
+    if QR_SIGNED_TOKENS:
+        return
+    warmed = 0
+    try:
+        for cid in list_recent_certificate_ids(QR_WARM_COUNT):
+            url = f"{QR_PUBLIC_BASE_URL}/certificate/{cid}"
+            QR_CACHE.set((url, QR_BOX_SIZE, QR_BORDER), qr_svg(url, QR_BOX_SIZE, QR_BORDER))
+            warmed += 1
+    except Exception:
+        log.exception("QR cache warm-up stopped after %d certificates", warmed)
+
+
+def warm_revocations() -> None:
+    """Загрузить состояние REVOCATIONS при старте (в фоне)."""
+    try:
+        REVOCATIONS.refresh()
+    except Exception:
+        log.exception("revocation state warm-up failed")
+
+
+async def render(fn: Any, *args: Any) -> Any:
+    """Отрисовка в RENDERER; перегрузка и таймаут превращаются в 503/504."""
+    try:
+        return await RENDERER.run(fn, *args)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503, detail="Rendering queue is full", headers={"Retry-After": "1"})
+    except BrokenProcessPool:
+        # пул перезапущен (упал или завис рабочий процесс) — запрос можно повторить
+        raise HTTPException(status_code=503, detail="Renderer restarted", headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Rendering timed out")
+
+
+async def certificate_pdf(cert: Dict[str, Any], key: Optional[str] = None) -> bytes:
+    """PDF сертификата из PDF_CACHE; при промахе — отрисовка в RENDERER."""
+    key = key or render_fingerprint(cert, CERT_RENDER_FIELDS, salt="pdf")
+    pdf = PDF_CACHE.get(key)
+    if pdf is None:
+        pdf = await render(certificate_pdf_bytes, cert)
+        PDF_CACHE.set(int(cert["id"]), key, pdf)
+    return pdf
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Совпадает ли If-None-Match запроса с ETag (слабое сравнение, как для GET)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    return etag in tags or ("W/" + etag) in tags
+
+
+def decorate_cert(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Добавляет поля status/status_label, учитывая отзыв HR.
+
+    Строки из БД уже содержат status и award_code (посчитаны при записи и в SQL).
+    """
     # Приводим отображаемую оценку к текущим уровням (Light/Standart/Hard)
     # для корректного UI и PDF/SVG, даже если в базе остались старые значения.
     if item.get("workflow_status") == "passed" and item.get("exam_grade") and item.get("exam_grade") != "Не сдан":
-        item["exam_grade"] = award_label(item.get("exam_grade")) or item.get("exam_grade")
+        code = item["award_code"] if "award_code" in item else normalize_award(item.get("exam_grade"))
+        item["exam_grade"] = AWARD_LABELS.get(code or "") or item.get("exam_grade")
 
-    status, label = compute_status(str(item.get("expires_at", "")))
+    # Внутренний сертификат не должен считаться действительным,
+    # пока экзамен не сдан (или если экзамен провален) — см. certificate_status()
+    status = item.get("status")
+    if status in STATUS_LABELS:
+        label = STATUS_LABELS[status]
+    else:
+        status, label = certificate_status(item.get("cert_type"), item.get("workflow_status"), item.get("expires_at"))
     item["status"] = status
     item["status_label"] = label
     return item
 
 
-def descendant_user_ids(manager_id: int) -> List[int]:
-    """Все подчинённые (прямые и косвенные) согласно профилям."""
-    profiles = {int(p["user_id"]): p for p in list_user_profiles()}
-    children: Dict[int, List[int]] = {}
+def cert_etag(cert: Dict[str, Any]) -> str:
+    """ETag JSON-представления сертификата — по row_version."""
+    return f'"v{int(cert.get("row_version") or 1)}"'
 
-    def mgr_of(uid: int) -> Optional[int]:
-        prof = profiles.get(int(uid))
-        if prof is not None and prof.get("manager_id") is not None:
-            try:
-                return int(prof.get("manager_id"))
-            except Exception:
-                return None
-        base = USERS_BY_ID.get(int(uid))
-        return base.manager_id if base else None
 
-    for u in USERS:
-        mid = mgr_of(u.id)
-        if mid is None:
-            continue
-        children.setdefault(int(mid), []).append(int(u.id))
-
-    out: List[int] = []
-    stack: List[int] = list(children.get(int(manager_id), []))
-    seen = set()
-    while stack:
-        uid = stack.pop()
-        if uid in seen:
-            continue
-        seen.add(uid)
-        out.append(uid)
-        stack.extend(children.get(uid, []))
-    return out
+def cert_response(cert: Dict[str, Any]) -> JSONResponse:
+    decorate_cert(cert)
+    return JSONResponse(cert, headers={"ETag": cert_etag(cert)})
+
+
+def if_match_version(request: Request) -> Optional[int]:
+    """Ожидаемая row_version из If-Match (None — заголовка нет или «*»)."""
+    raw = (request.headers.get("if-match") or "").strip()
+    if not raw or raw == "*":
+        return None
+    tag = raw.split(",")[0].strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    try:
+        return int(tag[1:] if tag.startswith("v") else tag)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid If-Match")
+
+
+def version_conflict(current: Dict[str, Any]) -> HTTPException:
+    """409: сертификат изменён с момента чтения; клиент должен перечитать его."""
+    return HTTPException(
+        status_code=409,
+        detail={"error": "version_conflict", "row_version": current.get("row_version")},
+        headers={"ETag": cert_etag(current)},
+    )
+
+
+async def org_index() -> OrgIndex:
+    """Индекс иерархии; целиком перечитывается из БД раз в CERT_ORG_INDEX_TTL секунд."""
+    if ORG_INDEX.is_stale():
+        await adb.refresh_org_index()
+    return ORG_INDEX
+
+
+async def descendant_user_ids(manager_id: int) -> List[int]:
+    """Все подчинённые (прямые и косвенные) согласно профилям."""
+    return (await org_index()).descendants(manager_id)
 
 # -------------------------
 # Auth
@@ -477,7 +457,7 @@ def descendant_user_ids(manager_id: int) -> List[int]:
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
     # Если уже вошли — сразу на реестр
-    if current_user(request) is not None:
+    if await current_user(request) is not None:
         return RedirectResponse("/certification", status_code=303)
 
     grouped = group_users_for_login()
@@ -512,7 +492,7 @@ async def logout(request: Request):
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         return RedirectResponse("/login", status_code=303)
 
@@ -527,7 +507,7 @@ async def home(request: Request):
 
 @app.get("/certification", response_class=HTMLResponse)
 async def certification(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         return RedirectResponse("/login", status_code=303)
 
@@ -542,11 +522,14 @@ async def certification(request: Request):
 
 @app.get("/profile", response_class=HTMLResponse)
 async def profile_page(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         return RedirectResponse("/login", status_code=303)
 
-    profile = get_user_profile(user.id) or {
+    # все профили страницы — одним запросом
+    profiles = await request_profiles(request, [u.id for u in USERS] + [user.id])
+
+    profile = profiles.get(user.id) or {
         "user_id": user.id,
         "full_name": user.full_name,
         "position": user.position,
@@ -556,11 +539,9 @@ async def profile_page(request: Request):
     }
 
     # список пользователей для выбора руководителя
-    users_for_select = []
-    for u in USERS:
-        # имя покажем из профиля, если оно было изменено
-        pu = make_display_user(u, get_user_profile(u.id))
-        users_for_select.append(pu)
+    # (имя покажем из профиля, если оно было изменено)
+    users_by_id = await display_users(request, [u.id for u in USERS])
+    users_for_select = [users_by_id[u.id] for u in USERS]
 
     return templates.TemplateResponse(
         "profile.html",
@@ -583,7 +564,7 @@ async def profile_save(
     manager_id: str = Form(""),
     controlled_module: str = Form(""),
 ):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         return RedirectResponse("/login", status_code=303)
 
@@ -595,7 +576,7 @@ async def profile_save(
 
     cm = controlled_module.strip() or None
 
-    upsert_user_profile(
+    await adb.upsert_user_profile(
         user_id=user.id,
         full_name=full_name.strip(),
         position=position.strip(),
@@ -611,65 +592,56 @@ async def profile_save(
 
 @app.get("/certificate/{cert_id:int}", response_class=HTMLResponse)
 async def certificate_page(request: Request, cert_id: int):
-    cert = get_certificate(int(cert_id))
-    if cert is None:
-        raise HTTPException(status_code=404, detail="Certificate not found")
-
-    user = current_user(request)
+    user = await current_user(request)
 
-    # Публичный просмотр (без авторизации): показываем только статус
+    # Публичный просмотр (без авторизации): показываем только статус.
+    # Быстрый путь: допуск по IP, микрокэш, отдельный пул чтения.
     if user is None:
-        st = public_status(cert)
-
-        # Для публичной страницы показываем минимум: ФИО + сроки + валидность.
-        owner_id = int(cert.get("owner_id") or 0)
-        full_name = str(cert.get("snapshot_full_name") or "").strip()
-        if not full_name and owner_id:
-            base = USERS_BY_ID.get(owner_id)
-            if base is not None:
-                full_name = make_display_user(base, get_user_profile(base.id)).full_name
-
-        issued_at = str(cert.get("issued_at") or "—")
-        expires_at_raw = str(cert.get("expires_at") or "").strip()
-        expires_at = expires_at_raw if expires_at_raw else "Бессрочно"
+        public_admit(request)
+        view = await public_view(int(cert_id))
+        if view is None:
+            raise HTTPException(status_code=404, detail="Certificate not found")
 
         return templates.TemplateResponse(
             "certificate_public.html",
             {
                 "request": request,
                 "cert_id": int(cert_id),
-                "status_code": st["code"],
-                "status_label": st["label"],
-                "full_name": full_name or "—",
-                "issued_at": issued_at,
-                "expires_at": expires_at,
+                "status_code": view["status"],
+                "status_label": view["label"],
+                "full_name": view["full_name"],
+                "issued_at": view["issued_at"],
+                "expires_at": view["expires_at"] or "Бессрочно",
             },
         )
 
+    cert = await adb.get_certificate(int(cert_id))
+    if cert is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+
     # --- приватный просмотр (внутри системы) ---
     # подставим снапшоты если старые записи без них
     owner_id = int(cert.get("owner_id") or 0)
     if not cert.get("snapshot_full_name") and owner_id:
-        base = USERS_BY_ID.get(owner_id)
-        if base:
-            du = make_display_user(base, get_user_profile(base.id))
+        du = (await display_users(request, [owner_id])).get(owner_id)
+        if du is not None:
             cert["snapshot_full_name"] = du.full_name
             cert["snapshot_position"] = du.position
             cert["snapshot_module"] = du.module
             cert["snapshot_manager_id"] = du.manager_id
             mgr_name = None
             if du.manager_id is not None:
-                base_mgr = USERS_BY_ID.get(int(du.manager_id))
-                if base_mgr is not None:
-                    mgr_name = make_display_user(base_mgr, get_user_profile(base_mgr.id)).full_name
+                mgr = (await display_users(request, [int(du.manager_id)])).get(int(du.manager_id))
+                if mgr is not None:
+                    mgr_name = mgr.full_name
             cert["snapshot_manager_name"] = mgr_name
 
-    if not can_view_certificate(user, cert):
+    if not await can_view_certificate(user, cert):
         raise HTTPException(status_code=403, detail="Not allowed")
 
     decorate_cert(cert)
 
-    share_url = str(request.url_for("certificate_page", cert_id=int(cert_id)))
+    share_url = await share_url_for(request, cert)
 
     can_exam = bool(cert.get("cert_type") == "internal" and cert.get("required_examiner_id") is not None and int(cert.get("required_examiner_id")) == int(user.id) and cert.get("workflow_status") != "revoked")
     can_hr = bool(user.role == "hr")
@@ -687,13 +659,43 @@ async def certificate_page(request: Request, cert_id: int):
     )
 
 
+async def token_page(request: Request, token: str):
+    """Проверка по подписанному токену из QR (без чтения certificates)."""
+    claims = load_token(token)
+    if claims is not None and request.session.get("user_id") is not None:
+        return RedirectResponse(str(request.url_for("certificate_page", cert_id=claims.cert_id)), status_code=303)
+
+    public_admit(request)
+    view = await token_public_view(token)
+    if view is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+
+    return templates.TemplateResponse(
+        "certificate_public.html",
+        {
+            "request": request,
+            "cert_id": view["id"],
+            "status_code": view["status"],
+            "status_label": view["label"],
+            "full_name": view["full_name"],
+            "issued_at": view["issued_at"],
+            "expires_at": view["expires_at"] or "Бессрочно",
+        },
+    )
+
+
+# Маршруты токенов есть, только если токены включены (тогда tokens.py требует CERT_TOKEN_SECRET)
+if QR_SIGNED_TOKENS:
+    app.get("/v/{token}", response_class=HTMLResponse)(token_page)
+
+
 # -------------------------
 # API
 # -------------------------
 
 @app.get("/api/users/me")
 async def api_me(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return {
@@ -709,14 +711,167 @@ async def api_me(request: Request):
     }
 
 
+@app.get("/api/cache/stats")
+async def api_cache_stats(request: Request):
+    """Счётчики попаданий/промахов in-process кэшей (диагностика)."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return {
+        **cache_stats(),
+        "renderer": RENDERER.stats(),
+        "public_limiter": PUBLIC_LIMITER.stats(),
+        "revocations": REVOCATIONS.stats(),
+    }
+
+
+@app.get("/api/public/certificates/{cert_id:int}")
+async def api_public_certificate(request: Request, cert_id: int):
+    """Проверка сертификата по QR (без авторизации): компактный JSON."""
+    public_admit(request)
+    view = await public_view(int(cert_id))
+    if view is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+    return JSONResponse(view, headers={"Cache-Control": f"public, max-age={int(PUBLIC_CACHE_TTL)}"})
+
+
+async def api_public_token(request: Request, token: str):
+    """Проверка подписанного токена из QR: тот же компактный JSON, что и по id."""
+    public_admit(request)
+    view = await token_public_view(token)
+    if view is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+    return JSONResponse(view, headers={"Cache-Control": "no-store"})
+
+
+if QR_SIGNED_TOKENS:
+    app.get("/api/public/v/{token}")(api_public_token)
+
+
+# Последний собранный снимок списка недействительных: ((seq, дата), файл)
+_revocation_snapshot: Optional[Tuple[Tuple[int, str], bytes]] = None
+
+
+def build_revocation_snapshot() -> Tuple[Tuple[int, str], bytes]:
+    snap, _ = revocation_snapshot()
+    blob = encode_revocations(
+        KIND_SNAPSHOT, 0, snap.seq, date.fromisoformat(snap.as_of), snap.max_id, snap.invalid, (), snap.missing
+    )
+    return (snap.seq, snap.as_of), blob
+
+
+@app.get("/api/public/revocations/snapshot")
+async def api_revocation_snapshot(request: Request):
+    """Снимок всех недействительных id (формат — app/revlist.py) для узлов проверки.
+
+    Собирается заново, только когда сдвинулся seq журнала или наступил новый день.
+    """
+    global _revocation_snapshot
+    public_admit(request)
+    key = (await adb.run_public(revocation_head), date.today().isoformat())
+    if _revocation_snapshot is None or _revocation_snapshot[0] != key:
+        _revocation_snapshot = await adb.run_public(build_revocation_snapshot)
+    (seq, as_of), blob = _revocation_snapshot
+
+    etag = f'"crl-{seq}-{as_of}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60", "X-Revocation-Seq": str(seq)}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=blob, media_type="application/octet-stream", headers=headers)
+
+
+@app.get("/api/public/revocations/delta")
+async def api_revocation_delta(request: Request, since: int, as_of: str):
+    """Изменения списка недействительных после seq потребителя (since) и его даты (as_of).
+
+    410 — дельта не строится (слишком старый или неизвестный seq): нужен снимок.
+    """
+    public_admit(request)
+    try:
+        as_of_date = date.fromisoformat(as_of)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="as_of must be YYYY-MM-DD")
+
+    delta = await adb.run_public(revocation_delta, int(since), as_of_date.isoformat())
+    if delta is None:
+        raise HTTPException(status_code=410, detail="Snapshot required")
+    blob = encode_revocations(
+        KIND_DELTA,
+        delta.from_seq,
+        delta.seq,
+        date.fromisoformat(delta.as_of),
+        delta.max_id,
+        delta.invalid,
+        delta.valid,
+        delta.missing,
+    )
+    return Response(
+        content=blob,
+        media_type="application/octet-stream",
+        headers={"Cache-Control": "no-store", "X-Revocation-Seq": str(delta.seq)},
+    )
+
+
+@app.post("/api/public/certificates/verify")
+async def api_public_verify(request: Request):
+    """Пакетная проверка сертификатов (для внешних проверяющих, без авторизации).
+
+    Тело: {"ids": [...]} (до VERIFY_MAX_IDS). Ответ — только id по группам
+    valid / invalid / not_found, по тем же правилам, что и public_status().
+    """
+    global _public_inflight
+    public_admit(request)
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    raw = payload.get("ids") if isinstance(payload, dict) else None
+    if not isinstance(raw, list) or not raw:
+        raise HTTPException(status_code=400, detail="ids must be a non-empty list")
+    try:
+        ids = list(dict.fromkeys(int(x) for x in raw))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="ids must be integers")
+    if len(ids) > VERIFY_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"at most {VERIFY_MAX_IDS} ids per request")
+
+    # Что уже есть в микрокэше публичной проверки — без обращения к БД
+    statuses: Dict[int, Optional[str]] = {}
+    missing: List[int] = []
+    for cid in ids:
+        view = PUBLIC_STATUS_CACHE.get(cid)
+        if view is None:
+            missing.append(cid)
+        else:
+            statuses[cid] = view.get("status")
+
+    if missing:
+        if _public_inflight >= PUBLIC_MAX_INFLIGHT:
+            raise HTTPException(status_code=503, detail="Busy", headers={"Retry-After": "1"})
+        _public_inflight += 1
+        try:
+            rows = await adb.get_public_statuses(missing)
+        finally:
+            _public_inflight -= 1
+        for cid in missing:
+            row = rows.get(cid)
+            statuses[cid] = public_status(row)["code"] if row is not None else None
+
+    result: Dict[str, List[int]] = {"valid": [], "invalid": [], "not_found": []}
+    for cid in ids:
+        result[statuses[cid] or "not_found"].append(cid)
+    return JSONResponse(result, headers={"Cache-Control": "no-store"})
+
+
 @app.get("/api/users")
 async def api_users(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     items = []
+    users_by_id = await display_users(request, [u.id for u in USERS])
     for u in USERS:
-        du = make_display_user(u, get_user_profile(u.id))
+        du = users_by_id[u.id]
         items.append(
             {
                 "id": du.id,
@@ -730,11 +885,11 @@ async def api_users(request: Request):
 
 @app.get("/api/certificates")
 async def api_list_certificates(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    items = list_certificates(user.id)
+    items = await adb.list_certificates(user.id)
     for it in items:
         decorate_cert(it)
     return {"items": items}
@@ -742,174 +897,404 @@ async def api_list_certificates(request: Request):
 
 @app.get("/api/certificates/requests")
 async def api_exam_requests(request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    items = list_exam_requests(user.id)
+    items = await adb.list_exam_requests(user.id)
     for it in items:
         decorate_cert(it)
     return {"items": items}
 
 
-@app.post("/api/certificates")
-async def api_add_certificate(request: Request):
-    user = current_user(request)
-    if user is None:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    payload: Dict[str, Any] = await request.json()
+def validate_certificate_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Проверка полей нового сертификата (одиночное добавление и импорт).
 
-    name = str(payload.get("name", "")).strip()
-    issued_at = str(payload.get("issued_at", "")).strip()
-    expires_at = str(payload.get("expires_at", "")).strip()
+    Ошибка — ValueError с текстом для клиента.
+    """
+    name = str(payload.get("name", "") or "").strip()
+    issued_at = str(payload.get("issued_at", "") or "").strip()
+    expires_at = str(payload.get("expires_at", "") or "").strip()
     is_perpetual = bool(payload.get("is_perpetual", False))
-    cert_type = str(payload.get("cert_type", "external")).strip() or "external"
-    topic = str(payload.get("topic", "")).strip() or None
+    cert_type = str(payload.get("cert_type", "external") or "").strip() or "external"
+    topic = str(payload.get("topic", "") or "").strip() or None
 
     if not name or not issued_at:
-        raise HTTPException(status_code=400, detail="name and issued_at are required")
+        raise ValueError("name and issued_at are required")
 
     # По умолчанию сертификаты бессрочные.
     # Если чекбокс выключен — expires_at обязателен.
     if is_perpetual or not expires_at:
         expires_at = ""
-    else:
-        expires_at = str(expires_at).strip()
-        if not expires_at:
-            raise HTTPException(status_code=400, detail="expires_at is required when not perpetual")
     if cert_type not in ("internal", "external"):
-        raise HTTPException(status_code=400, detail="cert_type must be internal or external")
+        raise ValueError("cert_type must be internal or external")
     if cert_type == "internal" and not topic:
-        raise HTTPException(status_code=400, detail="topic is required for internal certificate")
+        raise ValueError("topic is required for internal certificate")
 
-    # берём актуальные данные профиля на момент добавления
-    prof = get_user_profile(user.id) or {}
+    return {
+        "name": name,
+        "issued_at": issued_at,
+        "expires_at": expires_at,
+        "cert_type": cert_type,
+        "topic": topic,
+    }
 
+
+def new_certificate_row(
+    owner: DisplayUser,
+    prof: Dict[str, Any],
+    manager_name: Optional[str],
+    fields: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Строка для вставки: поля сертификата + снимок профиля владельца на момент добавления."""
     manager_id = prof.get("manager_id")
-    manager_name = None
-    if manager_id is not None:
-        base_mgr = USERS_BY_ID.get(int(manager_id))
-        if base_mgr is not None:
-            manager_name = make_display_user(base_mgr, get_user_profile(base_mgr.id)).full_name
 
     workflow_status = "active"
     required_examiner_id = None
     required_examiner_name = None
 
-    if cert_type == "internal":
+    if fields["cert_type"] == "internal":
         workflow_status = "pending_exam"
         required_examiner_id = int(manager_id) if manager_id is not None else None
         required_examiner_name = manager_name
 
-    cert = add_certificate(
-        owner_id=user.id,
-        name=name,
-        issued_at=issued_at,
-        expires_at=expires_at,
-        cert_type=cert_type,
-        topic=topic,
-        workflow_status=workflow_status,
-        required_examiner_id=required_examiner_id,
-        required_examiner_name=required_examiner_name,
-        snapshot_full_name=str(prof.get("full_name") or user.full_name),
-        snapshot_position=str(prof.get("position") or user.position),
-        snapshot_module=str(prof.get("module") or user.module),
-        snapshot_manager_id=int(manager_id) if manager_id is not None else None,
-        snapshot_manager_name=manager_name,
-    )
+    return {
+        "owner_id": owner.id,
+        **fields,
+        "workflow_status": workflow_status,
+        "required_examiner_id": required_examiner_id,
+        "required_examiner_name": required_examiner_name,
+        "snapshot_full_name": str(prof.get("full_name") or owner.full_name),
+        "snapshot_position": str(prof.get("position") or owner.position),
+        "snapshot_module": str(prof.get("module") or owner.module),
+        "snapshot_manager_id": int(manager_id) if manager_id is not None else None,
+        "snapshot_manager_name": manager_name,
+    }
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+
+@app.post("/api/certificates")
+async def api_add_certificate(request: Request):
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    payload: Dict[str, Any] = await request.json()
+
+    try:
+        fields = validate_certificate_payload(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # берём актуальные данные профиля на момент добавления
+    prof = (await request_profiles(request, [user.id])).get(user.id) or {}
+
+    manager_id = prof.get("manager_id")
+    manager_name = None
+    if manager_id is not None:
+        mgr = (await display_users(request, [int(manager_id)])).get(int(manager_id))
+        if mgr is not None:
+            manager_name = mgr.full_name
+
+    cert = await adb.add_certificate(**new_certificate_row(user, prof, manager_name, fields))
+
+    return cert_response(cert)
+
+
+# --- Массовый импорт ---
+
+IMPORT_CHUNK_SIZE = int(os.getenv("CERT_IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_MAX_ERRORS = int(os.getenv("CERT_IMPORT_MAX_ERRORS", "1000"))
+
+_TRUE_STRINGS = ("1", "true", "yes", "y", "да", "on")
+
+
+async def iter_body_lines(request: Request) -> AsyncIterator[str]:
+    """Строки тела запроса по мере получения (без чтения всего файла в память)."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buf = ""
+    async for chunk in request.stream():
+        buf += decoder.decode(chunk)
+        if "\n" not in buf:
+            continue
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buf += decoder.decode(b"", final=True)
+    if buf:
+        yield buf.rstrip("\r")
+
+
+async def iter_import_csv(request: Request) -> AsyncIterator[Tuple[int, Any]]:
+    """CSV с заголовком (разделитель «,» или «;»); значения в кавычках могут содержать переводы строк."""
+    header: Optional[List[str]] = None
+    delimiter = ","
+    pending: Optional[str] = None
+    row_no = 0
+    async for line in iter_body_lines(request):
+        pending = line if pending is None else pending + "\n" + line
+        if pending.count('"') % 2:
+            continue  # запись продолжается на следующей строке
+        record, pending = pending, None
+        if not record.strip():
+            continue
+        if header is None:
+            delimiter = ";" if record.count(";") > record.count(",") else ","
+            header = [h.strip().lower() for h in next(csv.reader([record], delimiter=delimiter))]
+            continue
+        row_no += 1
+        values = next(csv.reader([record], delimiter=delimiter))
+        item: Dict[str, Any] = dict(zip(header, values))
+        if "is_perpetual" in item:
+            item["is_perpetual"] = str(item["is_perpetual"]).strip().lower() in _TRUE_STRINGS
+        yield row_no, item
+    if pending is not None and pending.strip():
+        yield row_no + 1, ValueError("unterminated quoted value")
+
+
+async def iter_import_ndjson(request: Request) -> AsyncIterator[Tuple[int, Any]]:
+    """По одному JSON-объекту на строку."""
+    row_no = 0
+    async for line in iter_body_lines(request):
+        if not line.strip():
+            continue
+        row_no += 1
+        try:
+            yield row_no, json.loads(line)
+        except ValueError:
+            yield row_no, ValueError("invalid JSON")
+
+
+async def import_rows(request: Request) -> AsyncIterator[Tuple[int, Any]]:
+    """Строки импорта в зависимости от Content-Type: (номер строки, dict или ValueError)."""
+    content_type = (request.headers.get("content-type") or "").split(";")[0].strip().lower()
+    if content_type in ("text/csv", "application/csv"):
+        rows = iter_import_csv(request)
+    elif content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"):
+        rows = iter_import_ndjson(request)
+    elif content_type == "application/json":
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid JSON")
+        items = payload.get("items") if isinstance(payload, dict) else payload
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="expected a JSON array or {\"items\": [...]}")
+        for i, item in enumerate(items, start=1):
+            yield i, item
+        return
+    else:
+        raise HTTPException(status_code=415, detail="expected text/csv, application/x-ndjson or application/json")
+    async for row in rows:
+        yield row
+
+
+async def import_chunk(
+    request: Request,
+    user: DisplayUser,
+    batch: List[Tuple[int, Any]],
+    errors: List[Dict[str, Any]],
+) -> Tuple[int, int]:
+    """Проверить и вставить пачку строк одной транзакцией. Возвращает (вставлено, ошибок)."""
+    allowed_module = user.controlled_module or MODULE_CERTIFICATION
+    failed = 0
+
+    def fail(row_no: int, message: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"row": row_no, "error": message})
+
+    checked: List[Tuple[int, int, Dict[str, Any]]] = []
+    for row_no, item in batch:
+        if isinstance(item, ValueError):
+            fail(row_no, str(item))
+            continue
+        if not isinstance(item, dict):
+            fail(row_no, "row must be an object")
+            continue
+        try:
+            owner_id = int(str(item.get("owner_id", "")).strip())
+        except ValueError:
+            fail(row_no, "owner_id is required")
+            continue
+        if owner_id not in USERS_BY_ID:
+            fail(row_no, "unknown owner_id")
+            continue
+        try:
+            checked.append((row_no, owner_id, validate_certificate_payload(item)))
+        except ValueError as e:
+            fail(row_no, str(e))
+
+    # профили владельцев и их руководителей — пакетно, один раз на запрос
+    owner_ids = {owner_id for _, owner_id, _ in checked}
+    profiles = await request_profiles(request, owner_ids)
+    owners = await display_users(request, owner_ids)
+    manager_ids = {int(p["manager_id"]) for p in profiles.values() if p and p.get("manager_id") is not None}
+    managers = await display_users(request, manager_ids)
+
+    rows: List[Dict[str, Any]] = []
+    for row_no, owner_id, fields in checked:
+        prof = profiles.get(owner_id) or {}
+        owner = owners[owner_id]
+        if (prof.get("module") or owner.module or MODULE_CERTIFICATION) != allowed_module:
+            fail(row_no, "owner is outside of your module")
+            continue
+        manager_id = prof.get("manager_id")
+        mgr = managers.get(int(manager_id)) if manager_id is not None else None
+        rows.append(new_certificate_row(owner, prof, mgr.full_name if mgr else None, fields))
+
+    inserted = await adb.add_certificates_bulk(rows) if rows else 0
+    return inserted, failed
+
+
+@app.post("/api/certificates/import")
+async def api_import_certificates(request: Request):
+    """Массовый импорт сертификатов (для HR): CSV, NDJSON или JSON-массив.
+
+    Каждая строка — как тело POST /api/certificates плюс owner_id. Строки
+    вставляются пачками по IMPORT_CHUNK_SIZE, каждая пачка — одна транзакция;
+    ошибочные строки пропускаются и попадают в отчёт.
+    """
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if user.role != "hr":
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+    total = inserted = failed = 0
+    errors: List[Dict[str, Any]] = []
+    batch: List[Tuple[int, Any]] = []
+    chunk_size = max(1, IMPORT_CHUNK_SIZE)
+
+    async for row in import_rows(request):
+        total += 1
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            ok, bad = await import_chunk(request, user, batch, errors)
+            inserted, failed, batch = inserted + ok, failed + bad, []
+    if batch:
+        ok, bad = await import_chunk(request, user, batch, errors)
+        inserted, failed = inserted + ok, failed + bad
+
+    return {
+        "total": total,
+        "inserted": inserted,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+    }
 
 
 @app.get("/api/certificates/{cert_id:int}")
 async def api_get_certificate(cert_id: int, request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    cert = get_certificate(int(cert_id))
+    cert = await adb.get_certificate(int(cert_id))
     if cert is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    if not can_view_certificate(user, cert):
+    if not await can_view_certificate(user, cert):
         raise HTTPException(status_code=403, detail="Not allowed")
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+    return cert_response(cert)
 
 
 @app.get("/api/certificates/{cert_id:int}/image")
 async def api_certificate_image(cert_id: int, request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    cert = get_certificate(int(cert_id))
+    cert = await adb.get_certificate(int(cert_id))
     if cert is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    if not can_view_certificate(user, cert):
+    if not await can_view_certificate(user, cert):
         raise HTTPException(status_code=403, detail="Not allowed")
 
     # важно: не используем HTML-шаблоны, а отдаём "картинку" на лету
-    svg = certificate_svg(cert)
-    return Response(content=svg, media_type="image/svg+xml")
+    # (с кэшем по отпечатку полей сертификата)
+    key = render_fingerprint(cert, CERT_RENDER_FIELDS, salt="svg")
+    use_gzip = SVG_CACHE_GZIP and "gzip" in request.headers.get("accept-encoding", "").lower()
+    etag = f'"{key}-gz"' if use_gzip else f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = SVG_CACHE.get(key)
+    if entry is None:
+        entry = await render(certificate_svg_variants, cert, SVG_CACHE_GZIP)
+        SVG_CACHE.set(int(cert_id), key, entry)
+    raw, gz = entry
+
+    if use_gzip and gz is not None:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gz, media_type="image/svg+xml", headers=headers)
+    return Response(content=raw, media_type="image/svg+xml", headers=headers)
 
 
 @app.get("/api/certificates/{cert_id:int}/qr")
 async def api_certificate_qr(cert_id: int, request: Request):
     """QR-код (SVG) со ссылкой на карточку сертификата."""
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    cert = get_certificate(int(cert_id))
+    cert = await adb.get_certificate(int(cert_id))
     if cert is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    if not can_view_certificate(user, cert):
+    if not await can_view_certificate(user, cert):
         raise HTTPException(status_code=403, detail="Not allowed")
 
     # Полная ссылка на карточку сертификата (под доменом/портом текущего запроса)
-    share_url = str(request.url_for("certificate_page", cert_id=int(cert_id)))
+    share_url = await share_url_for(request, cert)
+
+    # QR для одной и той же ссылки не меняется — можно кэшировать «навсегда».
+    # С токенами ссылка меняется вместе с сертификатом, поэтому — по ETag.
+    etag = '"' + hashlib.sha256(f"{share_url}|{QR_BOX_SIZE}|{QR_BORDER}".encode("utf-8")).hexdigest()[:32] + '"'
+    cache_control = "private, no-cache" if QR_SIGNED_TOKENS else "private, max-age=31536000, immutable"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
 
-    factory = qrcode.image.svg.SvgImage
-    img = qrcode.make(share_url, image_factory=factory, box_size=10, border=2)
-    buf = BytesIO()
-    img.save(buf)
-    return Response(content=buf.getvalue(), media_type="image/svg+xml")
+    return Response(content=await qr_svg_bytes(share_url), media_type="image/svg+xml", headers=headers)
 
 
 @app.get("/api/certificates/{cert_id:int}/pdf")
 async def api_certificate_pdf(cert_id: int, request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    cert = get_certificate(int(cert_id))
+    cert = await adb.get_certificate(int(cert_id))
     if cert is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    if not can_view_certificate(user, cert):
+    if not await can_view_certificate(user, cert):
         raise HTTPException(status_code=403, detail="Not allowed")
 
-    pdf = certificate_pdf_bytes(cert)
+    key = render_fingerprint(cert, CERT_RENDER_FIELDS, salt="pdf")
+    etag = f'"{key}"'
+    # PDF меняется вместе со строкой сертификата — всегда перепроверяем по ETag
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+
+    pdf = await certificate_pdf(cert, key)
+
     filename = f"certificate_{int(cert_id)}.pdf"
     return Response(
         content=pdf,
         media_type="application/pdf",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', **cache_headers},
     )
 
-@app.post("/api/certificates/{cert_id:int}/exam")
-async def api_set_exam_result(cert_id: int, request: Request):
-    user = current_user(request)
-    if user is None:
-        raise HTTPException(status_code=401, detail="Not authenticated")
 
-    payload: Dict[str, Any] = await request.json()
+def exam_result_payload(payload: Dict[str, Any]) -> Tuple[str, str, str]:
+    """Оценка, дата и итоговый workflow_status из тела запроса (ValueError — ошибка для клиента)."""
     grade = str(payload.get("exam_grade", "")).strip()
     exam_date = str(payload.get("exam_date", "")).strip()
 
@@ -922,60 +1307,538 @@ async def api_set_exam_result(cert_id: int, request: Request):
     allowed_grades = {"Hard", "Standart", "Light", "Не сдан"}
 
     if not grade or not exam_date:
-        raise HTTPException(status_code=400, detail="exam_grade and exam_date are required")
+        raise ValueError("exam_grade and exam_date are required")
     if grade not in allowed_grades:
-        raise HTTPException(status_code=400, detail="exam_grade must be one of: Hard, Standart, Light, Не сдан")
+        raise ValueError("exam_grade must be one of: Hard, Standart, Light, Не сдан")
+
+    wf = "failed" if grade == "Не сдан" else "passed"
+    return grade, exam_date, wf
+
 
+@app.post("/api/certificates/{cert_id:int}/exam")
+async def api_set_exam_result(cert_id: int, request: Request):
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    payload: Dict[str, Any] = await request.json()
     try:
-        wf = "failed" if grade == "Не сдан" else "passed"
-        cert = set_exam_result(
+        grade, exam_date, wf = exam_result_payload(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        cert = await adb.set_exam_result(
             cert_id=cert_id,
+            expected_version=if_match_version(request),
             examiner_id=user.id,
             exam_grade=grade,
             exam_date=exam_date,
             workflow_status=wf,
         )
+    except VersionConflict as e:
+        raise version_conflict(e.current)
     except PermissionError:
         raise HTTPException(status_code=403, detail="Not allowed")
     except ValueError:
         raise HTTPException(status_code=404, detail="Not found")
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+    return cert_response(cert)
 
 
-@app.get("/api/certificates/team")
-async def api_team_certificates(request: Request):
-    """Сертификаты сотрудников по подчинённости, либо по модулю для HR."""
-    user = current_user(request)
+# --- Массовые операции (отзыв / снятие отзыва / оценки) ---
+
+
+def bulk_ids(payload: Dict[str, Any]) -> List[int]:
+    raw = payload.get("ids")
+    if not isinstance(raw, list) or not raw:
+        raise HTTPException(status_code=400, detail="ids must be a non-empty list")
+    try:
+        ids = list(dict.fromkeys(int(x) for x in raw))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="ids must be integers")
+    if len(ids) > BULK_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"at most {BULK_MAX_IDS} ids per request")
+    return ids
+
+
+def bulk_response(outcomes: Dict[int, str], ok: str, extra: Optional[Dict[int, str]] = None) -> Dict[str, Any]:
+    results = [{"id": cid, "outcome": outcome} for cid, outcome in {**(extra or {}), **outcomes}.items()]
+    return {
+        "results": results,
+        "changed": sum(1 for r in results if r["outcome"] == ok),
+    }
+
+
+@app.post("/api/certificates/bulk/revoke")
+async def api_bulk_revoke(request: Request):
+    """Отозвать набор сертификатов (HR) одной транзакцией; исход — по каждому id."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if user.role != "hr":
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+    payload: Dict[str, Any] = await request.json()
+    ids = bulk_ids(payload)
+    reason = str(payload.get("reason", "")).strip()
+    if not reason:
+        raise HTTPException(status_code=400, detail="reason is required")
+
+    outcomes = await adb.revoke_certificates(
+        cert_ids=ids,
+        hr_id=user.id,
+        hr_name=user.full_name,
+        reason=reason,
+        allowed_module=user.controlled_module,
+    )
+    return bulk_response(outcomes, "revoked")
+
+
+@app.post("/api/certificates/bulk/unrevoke")
+async def api_bulk_unrevoke(request: Request):
+    """Снять отзыв с набора сертификатов (HR)."""
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    if user.role != "hr":
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+    payload: Dict[str, Any] = await request.json()
+    outcomes = await adb.unrevoke_certificates(
+        cert_ids=bulk_ids(payload),
+        hr_id=user.id,
+        allowed_module=user.controlled_module,
+    )
+    return bulk_response(outcomes, "unrevoked")
+
+
+@app.post("/api/certificates/bulk/exam")
+async def api_bulk_exam(request: Request):
+    """Проставить оценки пачкой (экзаменатор).
+
+    Тело: {"ids": [...], "exam_grade": ..., "exam_date": ...} — одна оценка для всех,
+    или {"items": [{"id": ..., "exam_grade": ..., "exam_date": ...}, ...]}.
+    """
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    payload: Dict[str, Any] = await request.json()
+    results: List[Tuple[int, str, str, str]] = []
+    invalid: Dict[int, str] = {}
+
+    if "items" in payload:
+        items = payload.get("items")
+        if not isinstance(items, list) or not items:
+            raise HTTPException(status_code=400, detail="items must be a non-empty list")
+        if len(items) > BULK_MAX_IDS:
+            raise HTTPException(status_code=400, detail=f"at most {BULK_MAX_IDS} items per request")
+        for item in items:
+            try:
+                cid = int(item.get("id"))
+            except (AttributeError, TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="each item needs an integer id")
+            try:
+                results.append((cid, *exam_result_payload(item)))
+            except ValueError:
+                invalid[cid] = "invalid_grade"
+    else:
+        ids = bulk_ids(payload)
+        try:
+            grade, exam_date, wf = exam_result_payload(payload)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        results = [(cid, grade, exam_date, wf) for cid in ids]
+
+    outcomes = await adb.set_exam_results(examiner_id=user.id, results=results)
+    return bulk_response(outcomes, "updated", invalid)
+
+
+def team_filters(request: Request) -> Dict[str, Any]:
+    """Фильтры вкладки сотрудников из query-параметров (проверяются здесь, применяются в SQL)."""
+    q = request.query_params
+    filters: Dict[str, Any] = {}
+
+    status = (q.get("status") or "").strip()
+    if status and status != "all":
+        if status not in TEAM_STATUSES:
+            raise HTTPException(status_code=400, detail="status must be one of: " + ", ".join(TEAM_STATUSES))
+        filters["status"] = status
+
+    wf = (q.get("workflow_status") or "").strip()
+    if wf and wf != "all":
+        if wf not in TEAM_WORKFLOW_STATUSES:
+            raise HTTPException(status_code=400, detail="unknown workflow_status")
+        filters["workflow_status"] = wf
+
+    cert_type = (q.get("cert_type") or "").strip()
+    if cert_type and cert_type != "all":
+        if cert_type not in ("internal", "external"):
+            raise HTTPException(status_code=400, detail="cert_type must be internal or external")
+        filters["cert_type"] = cert_type
+
+    award = (q.get("award") or "").strip()
+    if award and award != "all":
+        code = normalize_award(award)
+        if code is None:
+            raise HTTPException(status_code=400, detail="award must be one of: Hard, Standart, Light")
+        filters["award"] = code
+
+    owner_id = (q.get("owner_id") or "").strip()
+    if owner_id:
+        try:
+            filters["owner_id"] = int(owner_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="owner_id must be an integer")
+
+    for key in ("expires_from", "expires_to"):
+        value = (q.get(key) or "").strip()
+        if value:
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{key} must be YYYY-MM-DD")
+            filters[key] = value
+
+    for key in ("module", "position"):
+        value = (q.get(key) or "").strip()
+        if value and value != "all":
+            filters[key] = value
+
+    expiry = (q.get("expiry") or "").strip()
+    if expiry and expiry != "all":
+        if expiry not in ("perpetual", "dated"):
+            raise HTTPException(status_code=400, detail="expiry must be perpetual or dated")
+        filters["expiry"] = expiry
+
+    text = (q.get("q") or "").strip()
+    if text:
+        filters["q"] = text
+
+    return filters
 
+
+async def team_scope(user: DisplayUser) -> Dict[str, Any]:
+    """Область вкладки сотрудников: модуль (HR) или все подчинённые."""
     # HR видит сертификаты подконтрольного модуля
     if user.role == "hr":
         module = user.controlled_module or MODULE_CERTIFICATION
-        items = list_certificates_by_module(module)
-        for it in items:
-            decorate_cert(it)
         return {
-            "items": items,
+            "module": module,
+            "owner_ids": None,
             "scope": f"Подконтрольный модуль: {module}",
             "can_revoke": True,
         }
 
     # Руководители видят всех подчинённых (прямых и косвенных)
-    subs = descendant_user_ids(user.id)
-    items = list_certificates_for_owners(subs)
+    subs = await descendant_user_ids(user.id)
+    return {
+        "module": None,
+        "owner_ids": subs,
+        "scope": "У вас нет подчинённых." if not subs else f"Подчинённых: {len(subs)}",
+        "can_revoke": False,
+    }
+
+
+def stream_certificates(chunks: Iterator[List[Dict[str, Any]]], fmt: str, meta: Dict[str, Any]) -> Iterator[bytes]:
+    """Сериализует пачки сертификатов по мере чтения из БД (NDJSON или JSON-объект)."""
+    if fmt == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(decorate_cert(it), ensure_ascii=False) + "\n" for it in chunk).encode("utf-8")
+        return
+
+    # {"scope": ..., "can_revoke": ..., "items": [ ... ]}
+    yield (json.dumps(meta, ensure_ascii=False)[:-1] + ', "items": [').encode("utf-8")
+    sep = ""
+    for chunk in chunks:
+        body = ",".join(json.dumps(decorate_cert(it), ensure_ascii=False) for it in chunk)
+        yield (sep + body).encode("utf-8")
+        sep = ","
+    yield b"]}"
+
+
+@app.get("/api/certificates/team")
+async def api_team_certificates(request: Request):
+    """Сертификаты сотрудников по подчинённости, либо по модулю для HR.
+
+    Без limit/cursor отдаёт весь список (как раньше); с limit — страницу
+    (keyset по id, следующая страница — cursor=next_cursor).
+    stream=ndjson|json — потоковая отдача без накопления списка в памяти.
+    """
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    scope = await team_scope(user)
+    filters = team_filters(request)
+
+    stream = (request.query_params.get("stream") or "").strip().lower()
+    if stream:
+        if stream not in ("ndjson", "json"):
+            raise HTTPException(status_code=400, detail="stream must be ndjson or json")
+        chunks = iter_team_certificates(module=scope["module"], owner_ids=scope["owner_ids"], filters=filters)
+        meta = {"scope": scope["scope"], "can_revoke": scope["can_revoke"]}
+        # синхронный генератор Starlette продвигает в пуле потоков — event loop не блокируется
+        return StreamingResponse(
+            stream_certificates(chunks, stream, meta),
+            media_type="application/x-ndjson" if stream == "ndjson" else "application/json",
+        )
+
+    limit: Optional[int] = None
+    cursor: Optional[int] = None
+    try:
+        if request.query_params.get("limit"):
+            limit = int(request.query_params["limit"])
+        if request.query_params.get("cursor"):
+            cursor = int(request.query_params["cursor"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="limit and cursor must be integers")
+    if cursor is not None and limit is None:
+        limit = 50
+
+    items, next_cursor = await adb.list_team_certificates(
+        module=scope["module"],
+        owner_ids=scope["owner_ids"],
+        filters=filters,
+        cursor=cursor,
+        limit=limit,
+    )
+    for it in items:
+        decorate_cert(it)
+
+    out: Dict[str, Any] = {"items": items, "scope": scope["scope"], "can_revoke": scope["can_revoke"]}
+    if limit is not None:
+        out["next_cursor"] = next_cursor
+    return out
+
+
+# Сколько PDF рисуется одновременно при выгрузке архива (остальное место
+# в очереди RENDERER остаётся обычным запросам)
+EXPORT_CONCURRENCY = int(os.getenv("CERT_EXPORT_CONCURRENCY", str(RENDERER.workers)))
+# Сколько раз повторять PDF при переполненной очереди RENDERER (пауза растёт до 5 с)
+EXPORT_BUSY_RETRIES = int(os.getenv("CERT_EXPORT_BUSY_RETRIES", "8"))
+
+
+class _ZipSink:
+    """Файлоподобный приёмник для zipfile без seek: записанное забирается через take()."""
+
+    def __init__(self) -> None:
+        self._parts: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+async def stream_pdf_zip(chunks: Iterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """ZIP с PDF сертификатов: файлы дописываются и отдаются по мере готовности.
+
+    Строки читаются из БД пачками, PDF рисуются параллельно (не больше
+    EXPORT_CONCURRENCY), архив целиком в памяти не собирается.
+
+    В errors.txt попадают только ошибки отрисовки конкретного сертификата.
+    Переполненная очередь (503) повторяется с паузой, таймаут (504) — один раз;
+    если не помогло, поток обрывается с ошибкой, а не отдаёт неполный архив.
+    """
+    sink = _ZipSink()
+    zf = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED)  # PDF уже сжаты
+    pending: Set["asyncio.Task[Any]"] = set()
+    failed: List[int] = []
+
+    async def one(cert: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[bytes]]:
+        busy = timeouts = 0
+        while True:
+            try:
+                return cert, await certificate_pdf(cert)
+            except HTTPException as e:
+                if e.status_code == 503 and busy < EXPORT_BUSY_RETRIES:
+                    await asyncio.sleep(min(5.0, 0.25 * 2 ** busy))
+                    busy += 1
+                    continue
+                if e.status_code == 504 and timeouts < 1:
+                    timeouts += 1
+                    continue
+                raise
+            except Exception:
+                return cert, None
+
+    def write_done(done: Iterable["asyncio.Task[Any]"]) -> None:
+        for task in sorted(done, key=lambda t: -int(t.result()[0]["id"])):
+            cert, pdf = task.result()
+            if pdf is None:
+                failed.append(int(cert["id"]))
+                continue
+            info = zipfile.ZipInfo(f"certificate_{int(cert['id'])}.pdf", date_time=stamp)
+            zf.writestr(info, pdf)
+
+    stamp = datetime.now().timetuple()[:6]
+    try:
+        while True:
+            chunk = await adb.run(next, chunks, None)
+            if chunk is None:
+                break
+            for cert in chunk:
+                if len(pending) >= max(1, EXPORT_CONCURRENCY):
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    write_done(done)
+                    data = sink.take()
+                    if data:
+                        yield data
+                pending.add(asyncio.ensure_future(one(cert)))
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            write_done(done)
+            data = sink.take()
+            if data:
+                yield data
+
+        if failed:
+            zf.writestr(
+                zipfile.ZipInfo("errors.txt", date_time=stamp),
+                "Не удалось сформировать PDF для сертификатов: " + ", ".join(str(x) for x in sorted(failed)) + "\n",
+            )
+        zf.close()
+        yield sink.take()
+    finally:
+        for task in pending:
+            task.cancel()
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+@app.get("/api/certificates/team/export.zip")
+async def api_team_export_zip(request: Request):
+    """Выгрузка PDF всех сертификатов вкладки сотрудников одним ZIP (те же область и фильтры)."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    scope = await team_scope(user)
+    chunks = iter_team_certificates(module=scope["module"], owner_ids=scope["owner_ids"], filters=team_filters(request))
+
+    filename = f"certificates_{datetime.now():%Y%m%d_%H%M}.zip"
+    return StreamingResponse(
+        stream_pdf_zip(chunks),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/certificates/team/count")
+async def api_team_certificates_count(request: Request):
+    """Количество сертификатов сотрудников с теми же фильтрами, что и /api/certificates/team."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    scope = await team_scope(user)
+    total = await adb.count_team_certificates(
+        module=scope["module"],
+        owner_ids=scope["owner_ids"],
+        filters=team_filters(request),
+    )
+    return {"total": total}
+
+
+@app.get("/api/certificates/team/facets")
+async def api_team_facets(request: Request):
+    """Модули и грейды в области вкладки сотрудников (варианты для фильтров)."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    scope = await team_scope(user)
+    return await adb.team_facets(module=scope["module"], owner_ids=scope["owner_ids"])
+
+
+@app.get("/api/certificates/stats")
+async def api_certificate_stats(request: Request):
+    """Счётчики сертификатов области (для плиток на дашборде): по статусу, типу и награде."""
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    scope = await team_scope(user)
+    stats = await adb.certificate_stats(module=scope["module"], owner_ids=scope["owner_ids"])
+    return {"scope": scope["scope"], "module": scope["module"], **stats}
+
+
+def snippet_html(snippet: str) -> str:
+    """Фрагмент из поиска -> безопасный HTML с <mark> вокруг совпадений."""
+    return html.escape(snippet or "").replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>")
+
+
+@app.get("/api/certificates/search")
+async def api_search_certificates(request: Request):
+    """Полнотекстовый поиск по названию, теме, ФИО, должности и причине отзыва.
+
+    Видимость — как в can_view_certificate(): свои, модуль (HR) или подчинённые.
+    """
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    q = (request.query_params.get("q") or "").strip()
+    try:
+        limit = int(request.query_params.get("limit") or 20)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="limit must be an integer")
+    if not q:
+        return {"q": q, "items": []}
+
+    if user.role == "hr":
+        module, owner_ids = user.controlled_module or MODULE_CERTIFICATION, None
+    else:
+        module, owner_ids = None, await descendant_user_ids(user.id)
+
+    items = await adb.search_certificates(q, viewer_id=user.id, module=module, owner_ids=owner_ids, limit=limit)
     for it in items:
         decorate_cert(it)
+        it["snippet"] = snippet_html(it.get("snippet") or "")
+    return {"q": q, "items": items}
 
-    scope = "У вас нет подчинённых." if not subs else f"Подчинённых: {len(subs)}"
-    return {"items": items, "scope": scope, "can_revoke": False}
+
+@app.get("/api/certificates/expiring")
+async def api_expiring_certificates(request: Request):
+    """Сертификаты области, истекающие в ближайшие дни (из expiring_soon).
+
+    ?within=<дней> — только окна не шире указанного (окна: CERT_EXPIRY_WINDOWS).
+    """
+    user = await current_user(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    within = request.query_params.get("within")
+    try:
+        within_days = int(within) if within else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="within must be an integer")
+
+    scope = await team_scope(user)
+    items = await adb.list_expiring_soon(
+        module=scope["module"],
+        owner_ids=scope["owner_ids"],
+        within_days=within_days,
+    )
+    for it in items:
+        decorate_cert(it)
+    return {"scope": scope["scope"], "windows": EXPIRY_WINDOWS, "items": items}
 
 
 @app.post("/api/certificates/{cert_id:int}/revoke")
 async def api_revoke_certificate(cert_id: int, request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     if user.role != "hr":
@@ -987,49 +1850,53 @@ async def api_revoke_certificate(cert_id: int, request: Request):
         raise HTTPException(status_code=400, detail="reason is required")
 
     try:
-        cert = revoke_certificate(
+        cert = await adb.revoke_certificate(
             cert_id=int(cert_id),
+            expected_version=if_match_version(request),
             hr_id=user.id,
             hr_name=user.full_name,
             reason=reason,
             allowed_module=user.controlled_module,
         )
+    except VersionConflict as e:
+        raise version_conflict(e.current)
     except PermissionError:
         raise HTTPException(status_code=403, detail="Not allowed")
     except ValueError:
         raise HTTPException(status_code=404, detail="Not found")
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+    return cert_response(cert)
 
 
 @app.post("/api/certificates/{cert_id:int}/unrevoke")
 async def api_unrevoke_certificate(cert_id: int, request: Request):
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     if user.role != "hr":
         raise HTTPException(status_code=403, detail="Not allowed")
 
     try:
-        cert = unrevoke_certificate(
+        cert = await adb.unrevoke_certificate(
             cert_id=int(cert_id),
+            expected_version=if_match_version(request),
             hr_id=user.id,
             allowed_module=user.controlled_module,
         )
+    except VersionConflict as e:
+        raise version_conflict(e.current)
     except PermissionError:
         raise HTTPException(status_code=403, detail="Not allowed")
     except ValueError:
         raise HTTPException(status_code=404, detail="Not found")
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+    return cert_response(cert)
 
 
 @app.post("/api/certificates/{cert_id:int}/edit")
 async def api_edit_certificate(cert_id: int, request: Request):
     """Редактирование сертификата (для HR)."""
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     if user.role != "hr":
@@ -1050,37 +1917,42 @@ async def api_edit_certificate(cert_id: int, request: Request):
         expires_at = ""
 
     try:
-        cert = update_certificate(
+        cert = await adb.update_certificate(
             cert_id=int(cert_id),
+            expected_version=if_match_version(request),
             name=name,
             issued_at=issued_at,
             expires_at=expires_at,
             topic=topic,
             allowed_module=user.controlled_module or MODULE_CERTIFICATION,
         )
+    except VersionConflict as e:
+        raise version_conflict(e.current)
     except PermissionError:
         raise HTTPException(status_code=403, detail="Not allowed")
     except ValueError:
         raise HTTPException(status_code=404, detail="Not found")
 
-    decorate_cert(cert)
-    return JSONResponse(cert)
+    return cert_response(cert)
 
 
 @app.delete("/api/certificates/{cert_id:int}")
 async def api_delete_certificate(cert_id: int, request: Request):
     """Удаление сертификата (для курирующего HR)."""
-    user = current_user(request)
+    user = await current_user(request)
     if user is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
     if user.role != "hr":
         raise HTTPException(status_code=403, detail="Not allowed")
 
     try:
-        delete_certificate(
+        await adb.delete_certificate(
             cert_id=int(cert_id),
+            expected_version=if_match_version(request),
             allowed_module=user.controlled_module or MODULE_CERTIFICATION,
         )
+    except VersionConflict as e:
+        raise version_conflict(e.current)
     except PermissionError:
         raise HTTPException(status_code=403, detail="Not allowed")
     except ValueError:
@@ -0,0 +1,49 @@
+"""Офлайн-миграция схемы БД.
+
+    python -m app.migrate           # применить все миграции и засеять профили
+    python -m app.migrate --check   # код возврата 1, если схема устарела
+    python -m app.migrate --list    # список миграций
+
+Удобно запускать один раз перед раскаткой, а воркерам выставить
+CERT_DB_AUTO_MIGRATE=0 — тогда они не конкурируют за DDL при старте.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import List, Optional
+
+from . import db
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.migrate", description="Миграции схемы БД реестра сертификатов")
+    parser.add_argument("--check", action="store_true", help="только проверить версию схемы")
+    parser.add_argument("--list", action="store_true", help="показать миграции")
+    parser.add_argument("--target", type=int, default=None, help="мигрировать до указанной версии")
+    args = parser.parse_args(argv)
+
+    current = db.schema_version()
+
+    if args.list:
+        for number, title, _step in db.MIGRATIONS:
+            mark = "x" if number <= current else " "
+            print(f"[{mark}] {number:3d}  {title}")
+        return 0
+
+    if args.check:
+        print(f"{db.DB_PATH}: schema version {current}, expected {db.SCHEMA_VERSION}")
+        return 0 if current >= db.SCHEMA_VERSION else 1
+
+    applied = db.migrate(args.target)
+    db.seed_user_profiles()
+    if applied:
+        print(f"{db.DB_PATH}: applied {', '.join(map(str, applied))}; schema version {db.schema_version()}")
+    else:
+        print(f"{db.DB_PATH}: schema is up to date (version {current})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Ограничение частоты запросов (token bucket) для публичных эндпоинтов."""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Tuple
+
+
+# Допуск по IP: в среднем PUBLIC_RATE запросов в секунду, всплеск до PUBLIC_BURST
+PUBLIC_RATE = float(os.getenv("CERT_PUBLIC_RATE", "5"))
+PUBLIC_BURST = int(os.getenv("CERT_PUBLIC_BURST", "20"))
+# Брать IP клиента из X-Forwarded-For (только за доверенным прокси)
+TRUST_PROXY = os.getenv("CERT_TRUST_PROXY", "0") not in ("0", "false", "no")
+
+
+class TokenBucketLimiter:
+    """Token bucket на ключ (обычно IP): rate токенов в секунду, не больше burst в запасе.
+
+    Число ключей ограничено max_keys (LRU), поэтому поток запросов с
+    разных адресов не раздувает память.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000) -> None:
+        self.rate = max(0.0, float(rate))
+        self.burst = max(1, int(burst))
+        self.max_keys = max(1, int(max_keys))
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, key: Hashable) -> Tuple[bool, float]:
+        """Взять токен. Возвращает (разрешено, через сколько секунд появится токен)."""
+        if self.rate <= 0:
+            return True, 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+            if tokens >= 1.0:
+                tokens -= 1.0
+                ok, retry_after = True, 0.0
+                self.allowed += 1
+            else:
+                ok, retry_after = False, (1.0 - tokens) / self.rate
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return ok, retry_after
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "keys": len(self._buckets),
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+            }
+
+
+def client_ip(request: Any) -> str:
+    """IP клиента запроса (Starlette Request): с учётом X-Forwarded-For, если TRUST_PROXY."""
+    if TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else ""
+
+
+# Один лимитер на процесс (основное приложение или отдельный verifier)
+PUBLIC_LIMITER = TokenBucketLimiter(PUBLIC_RATE, PUBLIC_BURST)
@@ -0,0 +1,444 @@
+"""Отрисовка сертификатов (SVG, PDF, QR) и исполнитель для неё.
+
+Функции отрисовки чистые (зависят только от аргументов), поэтому их можно
+выполнять в отдельных процессах: RENDERER отправляет задачи в пул процессов
+(или потоков) с ограниченной очередью и таймаутом на задачу.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import gzip
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+from xml.sax.saxutils import escape as xml_escape
+
+import qrcode
+import qrcode.image.svg
+
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.colors import HexColor
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from .db import MODULE_CERTIFICATION, award_label, normalize_award
+
+
+# Поля сертификата, от которых зависят PDF и SVG (ключ кэша и ETag)
+CERT_RENDER_FIELDS = (
+    "id", "snapshot_module", "snapshot_full_name", "snapshot_position",
+    "name", "cert_type", "topic", "issued_at", "expires_at",
+    "workflow_status", "revoked_by_name", "revoked_reason",
+    "required_examiner_name", "exam_grade", "exam_date",
+)
+
+
+_PDF_FONTS_READY = False
+
+
+def ensure_pdf_fonts() -> None:
+    """Регистрирует шрифты с кириллицей для PDF (best-effort)."""
+    global _PDF_FONTS_READY
+    if _PDF_FONTS_READY:
+        return
+
+    font_pairs = [
+        ("DejaVu", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
+        ("DejaVu-Bold", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ]
+
+    for name, fpath in font_pairs:
+        try:
+            if Path(fpath).exists():
+                pdfmetrics.registerFont(TTFont(name, fpath))
+        except Exception:
+            pass
+
+    _PDF_FONTS_READY = True
+
+
+def award_palette(cert: Dict[str, Any]) -> Dict[str, str]:
+    """Цветовая палитра сертификата в зависимости от оценки."""
+    # Если экзамен не сдан — выделяем красным (внутри системы)
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
+        return {
+            "accent": "#d93025",
+            "accent_light": "#FDECEA",
+            "accent_border": "#F6B8B2",
+            "accent_text": "#b3261e",
+        }
+
+    a = normalize_award(cert.get("exam_grade")) if cert.get("workflow_status") == "passed" else None
+    if a == "gold":
+        return {"accent": "#C9A227", "accent_light": "#FFF7D1", "accent_border": "#E2CD6A", "accent_text": "#8A6A00"}
+    if a == "silver":
+        return {"accent": "#7B8794", "accent_light": "#F0F3F7", "accent_border": "#C7D0DA", "accent_text": "#4A5562"}
+    if a == "bronze":
+        return {"accent": "#B87333", "accent_light": "#F6E6D7", "accent_border": "#D7A47A", "accent_text": "#7A3F10"}
+    # default
+    return {"accent": "#2157ff", "accent_light": "#EEF3FF", "accent_border": "#AFC3FF", "accent_text": "#2157ff"}
+
+
+def _wf_label(cert: Dict[str, Any]) -> str:
+    if cert.get("workflow_status") == "revoked":
+        return "ОТОЗВАН"
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
+        return "ОЖИДАЕТ ЭКЗАМЕН"
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
+        return "ЭКЗАМЕН СДАН"
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
+        return "ЭКЗАМЕН НЕ СДАН"
+    return "ДЕЙСТВИТЕЛЕН"
+
+
+def certificate_svg(cert: Dict[str, Any]) -> str:
+    """Генерирует SVG-картинку сертификата на лету."""
+    cid = str(cert.get("id", ""))
+    full_name = str(cert.get("snapshot_full_name") or "")
+    position = str(cert.get("snapshot_position") or "")
+    module = str(cert.get("snapshot_module") or MODULE_CERTIFICATION)
+    name = str(cert.get("name") or "Сертификат")
+    cert_type = "Внутренний" if cert.get("cert_type") == "internal" else "Внешний"
+    topic = str(cert.get("topic") or "")
+    issued = str(cert.get("issued_at") or "")
+    expires = str(cert.get("expires_at") or "")
+    expires_label = expires if str(expires).strip() else "Бессрочно"
+
+    pal = award_palette(cert)
+    accent = pal["accent"]
+    accent_light = pal["accent_light"]
+    accent_border = pal["accent_border"]
+    accent_text = pal["accent_text"]
+
+    wf = _wf_label(cert)
+    extra = ""
+    if cert.get("workflow_status") == "revoked":
+        extra = f"HR: {cert.get('revoked_by_name') or '—'} • Причина: {cert.get('revoked_reason') or '—'}"
+    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
+        extra = f"Экзаменатор: {cert.get('required_examiner_name') or '—'}"
+    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
+        g = award_label(cert.get("exam_grade")) or cert.get("exam_grade") or "—"
+        d = cert.get("exam_date") or ""
+        extra = f"Экзамен: {g} {('(' + d + ')') if d else ''}"
+    elif cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
+        d = cert.get("exam_date") or ""
+        extra = f"Экзамен: не сдан {('(' + d + ')') if d else ''}"
+
+    def x(s: str) -> str:
+        return xml_escape(s or "")
+
+    return f"""<?xml version='1.0' encoding='UTF-8'?>
+<svg xmlns='http://www.w3.org/2000/svg' width='1200' height='800' viewBox='0 0 1200 800'>
+  <defs>
+    <linearGradient id='bg' x1='0' y1='0' x2='1' y2='1'>
+      <stop offset='0%' stop-color='{x(accent_light)}'/>
+      <stop offset='100%' stop-color='#ffffff'/>
+    </linearGradient>
+  </defs>
+  <rect x='0' y='0' width='1200' height='800' fill='url(#bg)'/>
+  <rect x='60' y='60' width='1080' height='680' rx='28' fill='#fff' stroke='rgba(0,0,0,0.12)' stroke-width='2'/>
+
+  <text x='600' y='150' text-anchor='middle' font-size='56' font-family='Inter, Arial, sans-serif' font-weight='700'>СЕРТИФИКАТ</text>
+  <text x='600' y='195' text-anchor='middle' font-size='20' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>№ {x(cid)} • {x(module)}</text>
+
+  <text x='600' y='285' text-anchor='middle' font-size='28' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>Подтверждает, что</text>
+  <text x='600' y='350' text-anchor='middle' font-size='44' font-family='Inter, Arial, sans-serif' font-weight='700'>{x(full_name)}</text>
+  <text x='600' y='390' text-anchor='middle' font-size='22' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(position)}</text>
+
+  <text x='600' y='470' text-anchor='middle' font-size='24' font-family='Inter, Arial, sans-serif'>{x(name)}</text>
+  <text x='600' y='505' text-anchor='middle' font-size='18' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(cert_type)}{(' • ' + x(topic)) if topic else ''}</text>
+
+  <text x='600' y='575' text-anchor='middle' font-size='18' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>Выдан: {x(issued)} • Действителен до: {x(expires_label)}</text>
+
+  <g>
+    <rect x='440' y='610' width='320' height='44' rx='14' fill='{x(accent_light)}' stroke='{x(accent_border)}'/>
+    <text x='600' y='640' text-anchor='middle' font-size='16' font-family='Inter, Arial, sans-serif' fill='{x(accent_text)}' font-weight='700'>{x(wf)}</text>
+  </g>
+
+  <text x='600' y='690' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.65)'>{x(extra)}</text>
+
+  <line x1='240' y1='720' x2='560' y2='720' stroke='rgba(0,0,0,0.22)'/>
+  <text x='400' y='748' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.55)'>Подпись / Печать</text>
+
+  <line x1='640' y1='720' x2='960' y2='720' stroke='rgba(0,0,0,0.22)'/>
+  <text x='800' y='748' text-anchor='middle' font-size='14' font-family='Inter, Arial, sans-serif' fill='rgba(0,0,0,0.55)'>Ответственный</text>
+</svg>
+"""
+
+
+def certificate_svg_variants(cert: Dict[str, Any], with_gzip: bool) -> Tuple[bytes, Optional[bytes]]:
+    """SVG в UTF-8 и (опционально) его gzip-вариант — одной задачей для пула."""
+    raw = certificate_svg(cert).encode("utf-8")
+    return raw, gzip.compress(raw, compresslevel=6) if with_gzip else None
+
+
+def certificate_pdf_bytes(cert: Dict[str, Any]) -> bytes:
+    """Генерирует PDF сертификата на лету."""
+    ensure_pdf_fonts()
+
+    reg = set(pdfmetrics.getRegisteredFontNames())
+    font = "DejaVu" if "DejaVu" in reg else "Helvetica"
+    font_bold = "DejaVu-Bold" if "DejaVu-Bold" in reg else "Helvetica-Bold"
+
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    width, height = A4
+
+    pal = award_palette(cert)
+    accent = HexColor(pal["accent"])
+    accent_light = HexColor(pal["accent_light"])
+
+    # рамка + цветовой акцент (по оценке)
+    c.setLineWidth(1)
+    c.setStrokeColor(accent)
+    c.roundRect(36, 36, width - 72, height - 72, 18, stroke=1, fill=0)
+
+    # верхняя плашка-шаблон
+    c.setFillColor(accent_light)
+    c.roundRect(36, height - 140, width - 72, 70, 18, stroke=0, fill=1)
+    c.setFillColor(HexColor('#000000'))
+
+    c.setFont(font_bold, 26)
+    c.drawCentredString(width / 2, height - 90, "СЕРТИФИКАТ")
+    c.setFont(font, 12)
+    c.drawCentredString(width / 2, height - 115, f"№ {cert.get('id', '')} • {cert.get('snapshot_module') or MODULE_CERTIFICATION}")
+
+    y = height - 170
+
+    lines = [
+        ("ФИО", cert.get("snapshot_full_name") or ""),
+        ("Должность", cert.get("snapshot_position") or ""),
+        ("Название", cert.get("name") or ""),
+        ("Тип", "Внутренний" if cert.get("cert_type") == "internal" else "Внешний"),
+        ("Профиль", cert.get("topic") or "—"),
+        ("Дата выдачи", cert.get("issued_at") or ""),
+        ("Действителен до", cert.get("expires_at") or "Бессрочно"),
+    ]
+
+    if cert.get("cert_type") != "internal":
+        lines[4] = ("Профиль", "—")
+
+    for k, v in lines:
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, f"{k}:")
+        c.setFont(font, 12)
+        c.drawString(190, y, str(v))
+        y -= 18
+
+    y -= 10
+
+    c.setFont(font_bold, 12)
+    c.drawString(70, y, "Статус:")
+    c.setFont(font, 12)
+    c.drawString(190, y, _wf_label(cert))
+    y -= 18
+
+    if cert.get("workflow_status") == "revoked":
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, "Отозван:")
+        c.setFont(font, 12)
+        c.drawString(190, y, f"{cert.get('revoked_by_name') or '—'}")
+        y -= 18
+
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, "Причина:")
+        c.setFont(font, 12)
+        c.drawString(190, y, f"{cert.get('revoked_reason') or '—'}")
+        y -= 18
+
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "pending_exam":
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, "Экзаменатор:")
+        c.setFont(font, 12)
+        c.drawString(190, y, f"{cert.get('required_examiner_name') or '—'}")
+        y -= 18
+
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "passed":
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, "Экзамен:")
+        c.setFont(font, 12)
+        grade = award_label(cert.get("exam_grade")) or cert.get("exam_grade") or "—"
+        dt = cert.get("exam_date") or ""
+        c.drawString(190, y, f"Оценка {grade} {('(' + dt + ')') if dt else ''}")
+        y -= 18
+
+    if cert.get("cert_type") == "internal" and cert.get("workflow_status") == "failed":
+        c.setFont(font_bold, 12)
+        c.drawString(70, y, "Экзамен:")
+        c.setFont(font, 12)
+        dt = cert.get("exam_date") or ""
+        c.drawString(190, y, f"Не сдан {('(' + dt + ')') if dt else ''}")
+        y -= 18
+
+    # подписи
+    c.line(70, 110, 270, 110)
+    c.setFont(font, 10)
+    c.drawString(70, 95, "Подпись")
+
+    c.line(width - 270, 110, width - 70, 110)
+    c.drawRightString(width - 70, 95, "Ответственный")
+
+    c.showPage()
+    c.save()
+    buf.seek(0)
+    return buf.getvalue()
+
+
+def qr_svg(url: str, box_size: int, border: int) -> bytes:
+    """SVG QR-кода со ссылкой."""
+    factory = qrcode.image.svg.SvgImage
+    img = qrcode.make(url, image_factory=factory, box_size=box_size, border=border)
+    buf = BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+# -------------------------
+# Executor
+# -------------------------
+
+
+RENDER_MODE = os.getenv("CERT_RENDER_MODE", "process")  # process | thread | inline
+RENDER_WORKERS = int(os.getenv("CERT_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE = int(os.getenv("CERT_RENDER_QUEUE", "64"))  # задач в работе + в ожидании
+RENDER_TIMEOUT = float(os.getenv("CERT_RENDER_TIMEOUT", "30"))
+
+T = TypeVar("T")
+
+
+class RenderQueueFull(Exception):
+    """Очередь отрисовки переполнена — запрос лучше отклонить, чем копить."""
+
+
+class RenderExecutor:
+    def __init__(self, mode: str, workers: int, queue: int, timeout: float) -> None:
+        self.mode = mode if mode in ("process", "thread", "inline") else "process"
+        self.workers = max(1, int(workers))
+        self.queue = max(1, int(queue))
+        self.timeout = float(timeout) if timeout else None
+        self._pool: Optional[Executor] = None
+        self._in_flight = 0
+        self._recycled = 0
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.mode == "process":
+                # spawn: дочерние процессы не наследуют потоки и соединения БД родителя;
+                # шрифты регистрируются один раз при старте каждого процесса
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=ensure_pdf_fonts,
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cert-render")
+        return self._pool
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self._in_flight >= self.queue:
+                raise RenderQueueFull()
+            self._in_flight += 1
+
+    def _release(self, _fut: Any = None) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _slot(self) -> Callable[..., None]:
+        """Освобождение места в очереди, срабатывающее один раз (done-callback или таймаут)."""
+        held = [True]
+
+        def release(_fut: Any = None) -> None:
+            with self._lock:
+                if held[0]:
+                    held[0] = False
+                    self._in_flight -= 1
+
+        return release
+
+    def _reset_pool(self, pool: Executor, terminate: bool = False) -> None:
+        # Упавший рабочий процесс (OOM, segfault) ломает весь ProcessPoolExecutor —
+        # следующий вызов создаст новый пул. terminate — завершить процессы
+        # зависшего пула: их задачи закончатся BrokenProcessPool.
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._recycled += 1
+        processes = list((getattr(pool, "_processes", None) or {}).values()) if terminate else []
+        pool.shutdown(wait=False, cancel_futures=True)
+        for proc in processes:
+            proc.terminate()
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Выполнить функцию отрисовки вне event loop.
+
+        RenderQueueFull — если задач больше RENDER_QUEUE; asyncio.TimeoutError —
+        если задача не уложилась в RENDER_TIMEOUT. Место в очереди освобождается,
+        только когда задача в пуле действительно завершилась (или отменена до
+        старта), поэтому таймауты не копят работу сверх RENDER_QUEUE.
+
+        Задача, которая к таймауту уже выполняется, считается зависшей: пул
+        заменяется новым. Процессы старого пула завершаются (их задачи — и чужие
+        тоже — получают BrokenProcessPool); поток завершить нельзя, поэтому в
+        режиме thread он брошен, а его место в очереди освобождается сразу.
+        """
+        self._acquire()
+        if self.mode == "inline":
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+
+        release = self._slot()
+        with self._lock:
+            pool = self._get_pool()
+        try:
+            fut: Future = pool.submit(functools.partial(fn, *args))
+        except BaseException as e:
+            release()
+            if isinstance(e, BrokenProcessPool):
+                self._reset_pool(pool)
+            raise
+        fut.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), self.timeout)
+        except BrokenProcessPool:
+            self._reset_pool(pool)
+            raise
+        except asyncio.TimeoutError:
+            # не начатая задача уже отменена wait_for; выполняющаяся держит рабочего
+            if not fut.done():
+                self._reset_pool(pool, terminate=self.mode == "process")
+                if self.mode != "process":
+                    release()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = self._in_flight
+            recycled = self._recycled
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue": self.queue,
+            "in_flight": in_flight,
+            "recycled": recycled,
+        }
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+RENDERER = RenderExecutor(RENDER_MODE, RENDER_WORKERS, RENDER_QUEUE, RENDER_TIMEOUT)
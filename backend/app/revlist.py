@@ -0,0 +1,256 @@
+"""Компактный список недействительных сертификатов для внешних проверяющих.
+
+Снимок — все недействительные и удалённые id на момент (seq, дата) и
+наибольший выданный id; дельта — что изменилось после seq потребителя
+(выданы, стали недействительны / снова действительны, удалены), включая
+истёкшие по дате. seq — номер записи revocation_log.
+
+Формат файла (одинаковый для снимка и дельты):
+
+    заголовок  struct "<4sBQQIQ": b"CRL1", kind (0 — снимок, 1 — дельта),
+               from_seq, to_seq, дата (date.toordinal()), max_id
+    тело       zlib(список invalid, список valid, список missing)
+    список     varint(количество), затем разности соседних отсортированных id (varint)
+
+id выдаются подряд (AUTOINCREMENT), поэтому «не найден» — это id вне 1..max_id
+или из списка missing (удалённые).
+
+Кодек и RevocationList не зависят от остального приложения — модуль можно
+скопировать на узел проверки как есть. Публикация файлами:
+
+    python -m app.revlist DIR    # snapshot.crl, delta-<from>-<to>.crl, latest.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+from datetime import date
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+
+MAGIC = b"CRL1"
+KIND_SNAPSHOT = 0
+KIND_DELTA = 1
+_HEADER = struct.Struct("<4sBQQIQ")
+
+PUBLIC_LABELS = {"valid": "Действителен", "invalid": "Недействителен", "not_found": "Не найден"}
+
+
+class RevocationFile(NamedTuple):
+    kind: int
+    from_seq: int
+    to_seq: int
+    as_of: date
+    max_id: int
+    invalid: List[int]
+    valid: List[int]
+    missing: List[int]
+
+
+def _put_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _put_ids(out: bytearray, ids: Iterable[int]) -> None:
+    ids = sorted(set(int(x) for x in ids))
+    _put_varint(out, len(ids))
+    prev = 0
+    for cid in ids:
+        _put_varint(out, cid - prev)
+        prev = cid
+
+
+def _get_ids(data: bytes, pos: int) -> Tuple[List[int], int]:
+    count, pos = _get_varint(data, pos)
+    ids: List[int] = []
+    prev = 0
+    for _ in range(count):
+        delta, pos = _get_varint(data, pos)
+        prev += delta
+        ids.append(prev)
+    return ids, pos
+
+
+def encode(
+    kind: int,
+    from_seq: int,
+    to_seq: int,
+    as_of: date,
+    max_id: int,
+    invalid: Iterable[int],
+    valid: Iterable[int] = (),
+    missing: Iterable[int] = (),
+) -> bytes:
+    body = bytearray()
+    _put_ids(body, invalid)
+    _put_ids(body, valid)
+    _put_ids(body, missing)
+    header = _HEADER.pack(MAGIC, int(kind), int(from_seq), int(to_seq), as_of.toordinal(), int(max_id))
+    return header + zlib.compress(bytes(body), 9)
+
+
+def decode(blob: bytes) -> RevocationFile:
+    if len(blob) < _HEADER.size:
+        raise ValueError("truncated revocation file")
+    magic, kind, from_seq, to_seq, ordinal, max_id = _HEADER.unpack_from(blob)
+    if magic != MAGIC or kind not in (KIND_SNAPSHOT, KIND_DELTA):
+        raise ValueError("not a revocation file")
+    body = zlib.decompress(blob[_HEADER.size:])
+    invalid, pos = _get_ids(body, 0)
+    valid, pos = _get_ids(body, pos)
+    missing, _ = _get_ids(body, pos)
+    return RevocationFile(kind, from_seq, to_seq, date.fromordinal(ordinal), max_id, invalid, valid, missing)
+
+
+class RevocationList:
+    """Локальная копия списка недействительных: снимок + дельты по seq.
+
+    Проверка — поиск в множестве; синхронизация — только изменения с
+    последнего seq (и истёкшие по дате с последней синхронизации).
+    """
+
+    def __init__(self) -> None:
+        self.seq: Optional[int] = None
+        self.as_of: Optional[date] = None
+        self.max_id = 0
+        self._invalid: Set[int] = set()
+        self._missing: Set[int] = set()
+
+    def load(self, blob: bytes) -> RevocationFile:
+        """Применить снимок или дельту; дельта должна начинаться с текущего seq."""
+        f = decode(blob)
+        if f.kind == KIND_SNAPSHOT:
+            self._invalid = set(f.invalid)
+            self._missing = set(f.missing)
+        else:
+            if self.seq is None or f.from_seq != self.seq:
+                raise ValueError(f"delta from seq {f.from_seq} does not apply to seq {self.seq}")
+            self._invalid.difference_update(f.valid)
+            self._invalid.difference_update(f.missing)
+            self._invalid.update(f.invalid)
+            self._missing.update(f.missing)
+        self.seq, self.as_of, self.max_id = f.to_seq, f.as_of, f.max_id
+        return f
+
+    def status_code(self, cert_id: int) -> str:
+        """valid | invalid | not_found (не выдавался или удалён)."""
+        cert_id = int(cert_id)
+        if cert_id < 1 or cert_id > self.max_id or cert_id in self._missing:
+            return "not_found"
+        return "invalid" if cert_id in self._invalid else "valid"
+
+    def is_invalid(self, cert_id: int) -> bool:
+        """Не подтверждён как действительный (в том числе не найден)."""
+        return self.status_code(cert_id) != "valid"
+
+    def public_status(self, cert_id: int) -> dict:
+        """Как public_status() в приложении, плюс not_found (там — ответ 404)."""
+        code = self.status_code(cert_id)
+        return {"code": code, "label": PUBLIC_LABELS[code]}
+
+    def sync(self, base_url: str, timeout: float = 10.0) -> int:
+        """Догнать опубликованный список по HTTP (эндпоинты /api/public/revocations/*).
+
+        Возвращает число применённых изменений; если дельта недоступна (410),
+        загружает снимок целиком.
+        """
+        base = base_url.rstrip("/") + "/api/public/revocations"
+        if self.seq is not None and self.as_of is not None:
+            query = urlencode({"since": self.seq, "as_of": self.as_of.isoformat()})
+            try:
+                with urlopen(f"{base}/delta?{query}", timeout=timeout) as resp:
+                    f = self.load(resp.read())
+                return len(f.invalid) + len(f.valid) + len(f.missing)
+            except HTTPError as e:
+                if e.code != 410:
+                    raise
+        with urlopen(f"{base}/snapshot", timeout=timeout) as resp:
+            self.load(resp.read())
+        return len(self._invalid)
+
+    def __len__(self) -> int:
+        return len(self._invalid)
+
+
+def publish(out_dir: str) -> dict:
+    """Записать снимок и дельту от предыдущей публикации в out_dir; вернуть манифест."""
+    from . import db
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "latest.json")
+    try:
+        with open(manifest_path, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        manifest = {"deltas": []}
+
+    prev_seq, prev_as_of = manifest.get("seq"), manifest.get("as_of")
+    delta_from = (int(prev_seq), str(prev_as_of)) if prev_seq is not None and prev_as_of else None
+    # снимок и дельта читаются в одной транзакции до одного seq — цепочка без разрывов и наложений
+    snap, delta = db.revocation_snapshot(delta_from=delta_from)
+    today = date.fromisoformat(snap.as_of)
+    if delta_from is not None and delta_from != (snap.seq, snap.as_of):
+        if delta is not None:
+            name = f"delta-{delta.from_seq}-{delta.seq}.crl"
+            blob = encode(
+                KIND_DELTA, delta.from_seq, delta.seq, today, delta.max_id, delta.invalid, delta.valid, delta.missing
+            )
+            _write(os.path.join(out_dir, name), blob)
+            manifest["deltas"].append(
+                {"file": name, "from_seq": delta.from_seq, "to_seq": delta.seq, "as_of": snap.as_of}
+            )
+        else:
+            # цепочка дельт прервана — потребители начнут со снимка
+            manifest["deltas"] = []
+
+    blob = encode(KIND_SNAPSHOT, 0, snap.seq, today, snap.max_id, snap.invalid, (), snap.missing)
+    _write(os.path.join(out_dir, "snapshot.crl"), blob)
+    manifest.update(
+        {"seq": snap.seq, "as_of": snap.as_of, "snapshot": "snapshot.crl", "invalid": len(snap.invalid)}
+    )
+    _write(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+    return manifest
+
+
+def _write(path: str, data: bytes) -> None:
+    # через временный файл: читатели не видят недописанный снимок
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.revlist", description="Публикация списка недействительных")
+    parser.add_argument("out_dir", help="каталог для snapshot.crl, delta-*.crl и latest.json")
+    args = parser.parse_args(argv)
+
+    manifest = publish(args.out_dir)
+    print(f"seq={manifest['seq']} as_of={manifest['as_of']} invalid={manifest['invalid']} deltas={len(manifest['deltas'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -188,6 +188,9 @@
     var teamExpiryFilter = document.getElementById('teamExpiryFilter');
     var teamScopeHint = document.getElementById('teamScopeHint');
     var exportTeamCsvBtn = document.getElementById('exportTeamCsvBtn');
+    var teamMore = document.getElementById('teamMore');
+    var teamMoreHint = document.getElementById('teamMoreHint');
+    var teamMoreBtn = document.getElementById('teamMoreBtn');
 
     // сортировка таблицы сертификатов сотрудников
     var teamSortKey = 'id';
@@ -221,9 +224,14 @@
 
     var cachedMe = null;
     var myAll = [];
-    var teamAll = [];
+    var teamAll = [];           // загруженные страницы (keyset по id, новые сверху)
+    var teamNextCursor = null;  // null — загружено всё
+    var teamTotal = 0;          // всего по текущим фильтрам (/api/certificates/team/count)
+    var teamLoadSeq = 0;        // ответы на устаревшие фильтры отбрасываются
+    var teamSearchTimer = null;
     var teamCanRevoke = false;
     var teamScopeText = '';
+    var TEAM_PAGE_SIZE = 100;
 
     setExportEnabled(false);
 
@@ -728,21 +736,6 @@
       selectEl.value = has ? selected : 'all';
     }
 
-    function buildTeamFilterOptions() {
-      var mods = {};
-      var grades = {};
-      (teamAll || []).forEach(function (c) {
-        var m = c.snapshot_module || 'Модуль Сертификации';
-        if (m) mods[m] = true;
-        var g = c.snapshot_position || '';
-        if (g) grades[g] = true;
-      });
-      var modList = Object.keys(mods).sort();
-      var gradeList = Object.keys(grades).sort();
-      setSelectOptions(teamModuleFilter, modList, 'Все модули');
-      setSelectOptions(teamGradeFilter, gradeList, 'Все грейды');
-    }
-
     function setSelectOptions(selectEl, values, allLabel) {
       if (!selectEl) return;
       var current = selectEl.value || 'all';
@@ -763,72 +756,41 @@
       selectEl.value = current;
     }
 
-    function buildTeamFilterOptions() {
+    function buildTeamFilterOptions(facets) {
       if (!teamModuleFilter && !teamGradeFilter) return;
-      var mods = {};
-      var grades = {};
-      (teamAll || []).forEach(function (c) {
-        var mod = c.snapshot_module || 'Модуль Сертификации';
-        if (mod) mods[mod] = true;
-        var gr = c.snapshot_position || '';
-        if (gr) grades[gr] = true;
-      });
-      var modList = Object.keys(mods).sort();
-      var gradeList = Object.keys(grades).sort();
-      setSelectOptions(teamModuleFilter, modList, 'Все модули');
-      setSelectOptions(teamGradeFilter, gradeList, 'Все грейды');
+      setSelectOptions(teamModuleFilter, (facets && facets.modules) || [], 'Все модули');
+      setSelectOptions(teamGradeFilter, (facets && facets.positions) || [], 'Все грейды');
     }
 
-    function applyTeamFilters(items) {
-      var q = safeLower(teamSearch && teamSearch.value);
+    function isoDate(t) {
+      var d = new Date(t);
+      return d.getFullYear() + '-' + String(d.getMonth() + 1).padStart(2, '0') + '-' + String(d.getDate()).padStart(2, '0');
+    }
+
+    // фильтры таблицы сотрудников -> query-параметры /api/certificates/team (фильтрует SQL)
+    function teamQueryParams() {
+      var p = new URLSearchParams();
+      var q = String((teamSearch && teamSearch.value) || '').trim();
       var f = (teamFilter && teamFilter.value) || 'all';
       var m = (teamModuleFilter && teamModuleFilter.value) || 'all';
       var g = (teamGradeFilter && teamGradeFilter.value) || 'all';
       var e = (teamExpiryFilter && teamExpiryFilter.value) || 'all';
 
-      return (items || []).filter(function (c) {
-        // status filter
-        if (f === 'pending_exam' && c.workflow_status !== 'pending_exam') return false;
-        if (f === 'passed' && c.workflow_status !== 'passed') return false;
-        if (f === 'failed' && c.workflow_status !== 'failed') return false;
-        if (f === 'revoked' && c.workflow_status !== 'revoked') return false;
-        if (f === 'valid' && c.status !== 'valid') return false;
-        if (f === 'expired' && c.status !== 'expired') return false;
-
-        // module filter
-        if (m !== 'all') {
-          var cm = c.snapshot_module || 'Модуль Сертификации';
-          if (cm !== m) return false;
-        }
-
-        // grade filter
-        if (g !== 'all') {
-          var cg = c.snapshot_position || '';
-          if (cg !== g) return false;
-        }
-
-
-        // expiry filter
-        if (e === 'perpetual') {
-          var ex = String(c.expires_at || '').trim();
-          if (ex) return false;
-        } else if (e === 'with_expiry') {
-          var ex2 = String(c.expires_at || '').trim();
-          if (!ex2) return false;
-        } else if (e === 'expiring_soon') {
-          var ex3 = String(c.expires_at || '').trim();
-          if (!ex3) return false;
-          var ts = parseExpiry(ex3);
-          var now = Date.now();
-          var horizon = now + 30 * 24 * 60 * 60 * 1000;
-          if (ts < now || ts > horizon) return false;
-          if (c.status === 'expired') return false;
-        }
+      if (f === 'valid' || f === 'expired') p.set('status', f);
+      else if (f !== 'all') p.set('workflow_status', f);
+      if (m !== 'all') p.set('module', m);
+      if (g !== 'all') p.set('position', g);
+
+      if (e === 'perpetual') p.set('expiry', 'perpetual');
+      else if (e === 'with_expiry') p.set('expiry', 'dated');
+      else if (e === 'expiring_soon') {
+        var now = Date.now();
+        p.set('expires_from', isoDate(now));
+        p.set('expires_to', isoDate(now + 30 * 24 * 60 * 60 * 1000));
+      }
 
-        if (!q) return true;
-        var hay = safeLower(c.name) + ' ' + safeLower(c.topic) + ' ' + safeLower(c.snapshot_full_name) + ' ' + safeLower(c.snapshot_position) + ' ' + safeLower(c.snapshot_manager_name) + ' ' + safeLower(c.snapshot_module);
-        return hay.indexOf(q) !== -1;
-      });
+      if (q) p.set('q', q);
+      return p;
     }
 
     function parseISO(d) {
@@ -863,51 +825,6 @@
       return yyyy + mm + dd + '_' + hh + mi;
     }
 
-    function exportTeamCSV() {
-      var rows = sortTeamItems(applyTeamFilters(teamAll));
-      if (!rows || rows.length === 0) return;
-
-      var delim = ';';
-      var header = ['№', 'Тип', 'Сотрудник', 'Руководитель', 'Грейд', 'Модуль', 'Сертификат', 'Профиль', 'Дата выдачи', 'Действителен до', 'Статус', 'Оценка'];
-      var lines = [];
-      lines.push(header.map(csvEscape).join(delim));
-
-      rows.forEach(function (c) {
-        var expRaw = String(c.expires_at || '').trim();
-        var expLabel = expRaw ? expRaw : 'Бессрочно';
-        var st = teamStatusBadge(c).text;
-        var grade = teamGradeText(c);
-        var topic = (c.cert_type === 'internal') ? (c.topic || '') : '';
-        var row = [
-          c.id,
-          certTypeLabel(c.cert_type),
-          (c.snapshot_full_name || ''),
-          (c.snapshot_manager_name || ''),
-          (c.snapshot_position || ''),
-          (c.snapshot_module || 'Модуль Сертификации'),
-          (c.name || ''),
-          topic,
-          (c.issued_at || ''),
-          expLabel,
-          st,
-          grade
-        ];
-        lines.push(row.map(csvEscape).join(delim));
-      });
-
-      // BOM для корректного открытия в Excel
-      var csv = '\ufeff' + lines.join('\r\n');
-      var blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
-      var url = URL.createObjectURL(blob);
-      var a = document.createElement('a');
-      a.href = url;
-      a.download = 'сертификаты_сотрудников_' + nowStamp() + '.csv';
-      document.body.appendChild(a);
-      a.click();
-      a.remove();
-      setTimeout(function () { try { URL.revokeObjectURL(url); } catch (e) {} }, 1000);
-    }
-
     function normStatusKey(c) {
       if (c.workflow_status === 'revoked') return 'revoked';
       if (c.status === 'expired') return 'expired';
@@ -982,8 +899,26 @@
       return yyyy + mm + dd + '_' + hh + mi;
     }
 
+    // все строки текущих фильтров (не только загруженные страницы) — потоком NDJSON
+    function fetchTeamRows() {
+      var p = teamQueryParams();
+      p.set('stream', 'ndjson');
+      return fetch('/api/certificates/team?' + p.toString(), { credentials: 'same-origin' })
+        .then(function (r) { if (!r.ok) throw new Error(); return r.text(); })
+        .then(function (text) {
+          return text.split('\n').filter(Boolean).map(function (line) { return JSON.parse(line); });
+        });
+    }
+
     function exportTeamCSV() {
-      var rows = sortTeamItems(applyTeamFilters(teamAll));
+      setExportEnabled(false);
+      return fetchTeamRows()
+        .then(function (rows) { writeTeamCSV(sortTeamItems(rows)); })
+        .catch(function () { alert('Не удалось выгрузить список.'); })
+        .then(function () { setExportEnabled(teamTotal > 0); });
+    }
+
+    function writeTeamCSV(rows) {
       if (!rows || rows.length === 0) return;
 
       var delim = ';';
@@ -1208,10 +1143,17 @@
     function renderTeam() {
       if (!teamTableBody) return;
 
-      var filtered = sortTeamItems(applyTeamFilters(teamAll));
+      // сортировка по колонкам — в пределах загруженных строк
+      var filtered = sortTeamItems(teamAll);
+
+      // экспорт доступен только если по фильтрам есть строки
+      setExportEnabled(teamTotal > 0);
 
-      // экспорт доступен только если есть строки в текущем представлении
-      setExportEnabled(!!(filtered && filtered.length));
+      if (teamMore) {
+        teamMore.style.display = filtered.length ? 'flex' : 'none';
+        if (teamMoreHint) teamMoreHint.textContent = 'Показано ' + filtered.length + ' из ' + Math.max(teamTotal, filtered.length);
+        if (teamMoreBtn) teamMoreBtn.style.display = teamNextCursor !== null ? '' : 'none';
+      }
 
       if (teamScopeHint) {
         var msg = teamScopeText || '';
@@ -1227,7 +1169,9 @@
 
       if (teamTableBody) teamTableBody.innerHTML = '';
 
-      var emptyText = teamCanRevoke ? 'Нет сертификатов в модуле.' : 'Нет сертификатов сотрудников.';
+      var emptyText = teamQueryParams().toString()
+        ? 'Нет сертификатов по выбранным фильтрам.'
+        : (teamCanRevoke ? 'Нет сертификатов в модуле.' : 'Нет сертификатов сотрудников.');
       if (!filtered || filtered.length === 0) {
         if (teamTableWrap) teamTableWrap.style.display = 'none';
         if (teamTableEmpty) {
@@ -1411,12 +1355,32 @@
         });
     }
 
-    function loadTeam() {
+    function fetchTeamPage(params, cursor) {
+      var p = new URLSearchParams(params);
+      p.set('limit', String(TEAM_PAGE_SIZE));
+      if (cursor !== null && cursor !== undefined) p.set('cursor', String(cursor));
+      return fetch('/api/certificates/team?' + p.toString(), { credentials: 'same-origin' })
+        .then(function (r) { if (!r.ok) throw new Error(); return r.json(); });
+    }
+
+    function fetchTeamJSON(url) {
+      return fetch(url, { credentials: 'same-origin' })
+        .then(function (r) { if (!r.ok) throw new Error(); return r.json(); });
+    }
+
+    // первая страница по текущим фильтрам + общее количество (и варианты фильтров при полной перезагрузке)
+    function loadTeam(withFacets) {
       if (!teamTableBody) return Promise.resolve();
-      return fetch('/api/certificates/team', { credentials: 'same-origin' })
-        .then(function (r) { if (!r.ok) throw new Error(); return r.json(); })
-        .then(function (data) {
+      var seq = ++teamLoadSeq;
+      var params = teamQueryParams();
+      var facets = withFacets === false ? Promise.resolve(null) : fetchTeamJSON('/api/certificates/team/facets');
+      return Promise.all([fetchTeamPage(params, null), fetchTeamJSON('/api/certificates/team/count?' + params.toString()), facets])
+        .then(function (res) {
+          if (seq !== teamLoadSeq) return;
+          var data = res[0];
           teamAll = (data && data.items) || [];
+          teamNextCursor = (data && data.next_cursor !== undefined) ? data.next_cursor : null;
+          teamTotal = (res[1] && res[1].total) || 0;
           teamCanRevoke = !!(data && data.can_revoke);
           teamScopeText = (data && data.scope) || '';
 
@@ -1425,11 +1389,14 @@
             teamEmpty.textContent = '';
           }
 
-          buildTeamFilterOptions();
+          if (res[2]) buildTeamFilterOptions(res[2]);
           renderTeam();
         })
         .catch(function () {
+          if (seq !== teamLoadSeq) return;
           teamAll = [];
+          teamNextCursor = null;
+          teamTotal = 0;
           teamCanRevoke = false;
           teamScopeText = '';
           setExportEnabled(false);
@@ -1437,6 +1404,7 @@
           if (teamTableWrap) teamTableWrap.style.display = 'none';
           if (teamTableEmpty) teamTableEmpty.style.display = 'none';
           if (teamScopeHint) teamScopeHint.style.display = 'none';
+          if (teamMore) teamMore.style.display = 'none';
           if (teamEmpty) {
             teamEmpty.style.display = 'block';
             teamEmpty.textContent = 'Не удалось загрузить список.';
@@ -1444,6 +1412,21 @@
         });
     }
 
+    function loadMoreTeam() {
+      if (teamNextCursor === null) return Promise.resolve();
+      var seq = teamLoadSeq;
+      if (teamMoreBtn) teamMoreBtn.disabled = true;
+      return fetchTeamPage(teamQueryParams(), teamNextCursor)
+        .then(function (data) {
+          if (seq !== teamLoadSeq) return;
+          teamAll = teamAll.concat((data && data.items) || []);
+          teamNextCursor = (data && data.next_cursor !== undefined) ? data.next_cursor : null;
+          renderTeam();
+        })
+        .catch(function () { alert('Не удалось загрузить следующую страницу.'); })
+        .then(function () { if (teamMoreBtn) teamMoreBtn.disabled = false; });
+    }
+
     function loadAll() {
       return fetchMe().then(function (me) {
         cachedMe = me;
@@ -1521,11 +1504,15 @@
     else setActiveTab('my');
 
     // Team filter bindings
-    if (teamSearch) teamSearch.addEventListener('input', function () { renderTeam(); });
-    if (teamFilter) teamFilter.addEventListener('change', function () { renderTeam(); });
-    if (teamModuleFilter) teamModuleFilter.addEventListener('change', function () { renderTeam(); });
-    if (teamGradeFilter) teamGradeFilter.addEventListener('change', function () { renderTeam(); });
-    if (teamExpiryFilter) teamExpiryFilter.addEventListener('change', function () { renderTeam(); });
+    // фильтры применяет сервер: при изменении загружаем первую страницу заново
+    if (teamSearch) teamSearch.addEventListener('input', function () {
+      clearTimeout(teamSearchTimer);
+      teamSearchTimer = setTimeout(function () { loadTeam(false); }, 300);
+    });
+    [teamFilter, teamModuleFilter, teamGradeFilter, teamExpiryFilter].forEach(function (sel) {
+      if (sel) sel.addEventListener('change', function () { loadTeam(false); });
+    });
+    if (teamMoreBtn) teamMoreBtn.addEventListener('click', function () { loadMoreTeam(); });
     if (exportTeamCsvBtn) exportTeamCsvBtn.addEventListener('click', function () { exportTeamCSV(); });
 
     bindTeamSorting();
@@ -0,0 +1,234 @@
+"""Подписанные токены проверки сертификата для QR.
+
+Токен (itsdangerous, HMAC) несёт id, ФИО, дату выдачи, дату окончания и эпоху —
+seq последней записи revocation_log по сертификату на момент подписи.
+Проверка идёт по токену и состоянию журнала отзывов в памяти (RevocationState),
+без чтения certificates; журнал догоняется по seq не чаще REVOCATION_REFRESH,
+эпоха id читается из журнала при первой проверке и кэшируется.
+
+Если сертификат менялся после подписи (эпоха в журнале больше, чем в токене)
+или его id нет в журнале (в журнал пишется каждая выдача), токен по нему не
+принимается — такой скан проверяется обычным путём по id.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from . import db
+
+
+# Класть ли подписанный токен в QR вместо ссылки /certificate/{id} (и принимать ли токены)
+QR_SIGNED_TOKENS = os.getenv("CERT_QR_SIGNED_TOKENS", "0") not in ("0", "false", "no")
+
+# Через запятую; подписывает последний ключ, проверяются все (ротация ключей)
+_SECRETS_ENV = os.getenv("CERT_TOKEN_SECRET", "")
+if QR_SIGNED_TOKENS and not _SECRETS_ENV.strip():
+    raise RuntimeError("CERT_QR_SIGNED_TOKENS is on but CERT_TOKEN_SECRET is not set")
+# Без токенов — случайный ключ процесса: подписать что-либо, что примут, нельзя
+TOKEN_SECRETS = [s.strip() for s in _SECRETS_ENV.split(",") if s.strip()] or [secrets.token_urlsafe(32)]
+# Как часто (сек) догонять revocation_log при проверке токенов
+REVOCATION_REFRESH = float(os.getenv("CERT_REVOCATION_REFRESH", "2"))
+# Сколько эпох сертификатов держать в памяти (LRU; промах — один запрос к БД)
+REVOCATION_EPOCH_CACHE = int(os.getenv("CERT_REVOCATION_EPOCH_CACHE", "100000"))
+
+PUBLIC_LABELS = {"valid": "Действителен", "invalid": "Недействителен"}
+
+
+class _CompactJSON:
+    """JSON без \\u-экранирования: кириллица в ФИО не раздувает токен в 6 раз."""
+
+    @staticmethod
+    def dumps(obj: Any, **kwargs: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def loads(payload: Any, **kwargs: Any) -> Any:
+        return json.loads(payload)
+
+
+_serializer = URLSafeSerializer(TOKEN_SECRETS, salt="cert-qr", serializer=_CompactJSON)
+
+
+class TokenClaims(NamedTuple):
+    cert_id: int
+    full_name: str
+    issued_at: str
+    expires_on: str  # ISO-дата или "" (бессрочный)
+    epoch: int
+
+
+def sign_token(cert_id: int, full_name: str, issued_at: str, expires_at: str, epoch: int) -> str:
+    """Подписать токен. Выдаётся только для действительного сертификата (status == 'valid')."""
+    expires_on = db.expires_on(expires_at)
+    if expires_on is None:
+        raise ValueError("expires_at is not a date")
+    if expires_on == db.PERPETUAL_DATE:
+        expires_on = ""
+    return _serializer.dumps([int(cert_id), full_name, issued_at, expires_on, int(epoch)])
+
+
+def load_token(token: str) -> Optional[TokenClaims]:
+    """Проверить подпись и разобрать токен; None — подпись или формат неверны."""
+    try:
+        cert_id, full_name, issued_at, expires_on, epoch = _serializer.loads(token)
+        return TokenClaims(int(cert_id), str(full_name), str(issued_at), str(expires_on), int(epoch))
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+
+class RevocationState:
+    """Состояние revocation_log в памяти: недействительные id и эпохи проверявшихся id.
+
+    Полного зеркала журнала нет. Первый refresh() загружает только id,
+    недействительные сейчас (load, по умолчанию db.revocation_invalid_ids), дальше
+    журнал догоняется по seq (fetch(after_seq, limit) -> [(seq, cert_id, invalid), ...],
+    по умолчанию db.revocation_changes). Эпоха id читается из БД при первой проверке
+    его токена (epoch_of, по умолчанию db.revocation_epoch) и держится в LRU на
+    epoch_cache записей; записи журнала обновляют эпохи, уже лежащие в LRU.
+
+    Методы потокобезопасны; refresh() и prepare() обращаются к БД, из async-кода
+    их вызывают через пул потоков.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int, int], List[Tuple[int, int, bool]]] = db.revocation_changes,
+        load: Callable[[], Tuple[int, List[int]]] = db.revocation_invalid_ids,
+        epoch_of: Callable[[int], int] = db.revocation_epoch,
+        refresh_interval: float = REVOCATION_REFRESH,
+        batch: int = 10000,
+        epoch_cache: int = REVOCATION_EPOCH_CACHE,
+    ) -> None:
+        self._fetch = fetch
+        self._load = load
+        self._epoch_of = epoch_of
+        self.refresh_interval = max(0.0, float(refresh_interval))
+        self.batch = max(1, int(batch))
+        self.epoch_cache = max(1, int(epoch_cache))
+        self.seq = 0
+        self._loaded = False
+        self._invalid: Set[int] = set()
+        self._epochs: "OrderedDict[int, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.RLock()
+        self._refreshed = float("-inf")
+
+    def apply(self, changes: List[Tuple[int, int, bool]]) -> None:
+        with self._lock:
+            for seq, cert_id, invalid in changes:
+                if seq <= self.seq:
+                    continue
+                if invalid:
+                    self._invalid.add(cert_id)
+                else:
+                    self._invalid.discard(cert_id)
+                if cert_id in self._epochs:
+                    self._epochs[cert_id] = seq
+                self.seq = seq
+
+    def refresh(self) -> int:
+        """Догнать журнал до конца; возвращает число применённых записей."""
+        with self._refresh_lock:
+            if not self._loaded:
+                seq, ids = self._load()
+                with self._lock:
+                    self._invalid = set(ids)
+                    self.seq = max(self.seq, seq)
+                    self._loaded = True
+            applied = 0
+            while True:
+                changes = self._fetch(self.seq, self.batch)
+                self.apply(changes)
+                applied += len(changes)
+                if len(changes) < self.batch:
+                    break
+            self._refreshed = time.monotonic()
+            return applied
+
+    def maybe_refresh(self, min_seq: int = 0) -> int:
+        """refresh(), если пора; одновременные вызовы не дублируют запрос к БД."""
+        if not self.needs_refresh(min_seq):
+            return 0
+        with self._refresh_lock:
+            if not self.needs_refresh(min_seq):
+                return 0
+            return self.refresh()
+
+    def needs_refresh(self, min_seq: int = 0) -> bool:
+        """Пора ли догонять журнал: истёк интервал или токен новее нашего состояния."""
+        return self.seq < min_seq or time.monotonic() - self._refreshed >= self.refresh_interval
+
+    def needs_prepare(self, cert_id: int, min_seq: int = 0) -> bool:
+        """Нужен ли prepare() (обращение к БД) перед check()."""
+        if self.needs_refresh(min_seq):
+            return True
+        with self._lock:
+            return cert_id not in self._epochs
+
+    def prepare(self, cert_id: int, min_seq: int = 0) -> None:
+        """Догнать журнал, если пора, и загрузить эпоху cert_id в LRU, если её там нет."""
+        self.maybe_refresh(min_seq)
+        # под _refresh_lock журнал не продвигается, пока читаем эпоху: запись,
+        # добавленная в LRU, дальше обновляется в apply()
+        with self._refresh_lock:
+            with self._lock:
+                if cert_id in self._epochs:
+                    return
+            epoch = int(self._epoch_of(cert_id))
+            with self._lock:
+                # эпоха новее нашего состояния — не кэшируем, check() ответит 'stale'
+                if epoch > self.seq:
+                    return
+                self._epochs[cert_id] = epoch
+                while len(self._epochs) > self.epoch_cache:
+                    self._epochs.popitem(last=False)
+
+    def check(self, cert_id: int, epoch: int) -> str:
+        """'invalid' — сертификат сейчас недействителен; 'stale' — менялся после подписи,
+        неизвестен (нет в журнале — не выдавался) или эпоха не загружена prepare(); иначе 'ok'."""
+        with self._lock:
+            if cert_id in self._invalid:
+                return "invalid"
+            known = self._epochs.get(cert_id)
+            if not known or epoch <= 0 or known > epoch or self.seq < epoch:
+                return "stale"
+            self._epochs.move_to_end(cert_id)
+            return "ok"
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"seq": self.seq, "invalid": len(self._invalid), "tracked": len(self._epochs)}
+
+
+REVOCATIONS = RevocationState()
+
+
+def token_view(
+    claims: TokenClaims, state: RevocationState = REVOCATIONS, today: Optional[date] = None
+) -> Optional[Dict[str, Any]]:
+    """Публичное представление по токену (как public_view в main); None — токену нельзя
+    верить без БД (устарел или id неизвестен)."""
+    verdict = state.check(claims.cert_id, claims.epoch)
+    if verdict == "stale":
+        return None
+    today_iso = (today or date.today()).isoformat()
+    expired = bool(claims.expires_on) and claims.expires_on < today_iso
+    code = "invalid" if verdict == "invalid" or expired else "valid"
+    return {
+        "id": claims.cert_id,
+        "status": code,
+        "label": PUBLIC_LABELS[code],
+        "full_name": claims.full_name or "—",
+        "issued_at": claims.issued_at or "—",
+        "expires_at": claims.expires_on or None,
+    }
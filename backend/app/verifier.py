@@ -0,0 +1,107 @@
+"""Отдельный лёгкий процесс проверки подписанных QR-токенов.
+
+    uvicorn app.verifier:app --host 0.0.0.0 --port 8001
+
+Не тянет основное приложение (сессии, рендер PDF): только токены, журнал
+отзывов в памяти и публичная страница. certificates не читает; если токен
+устарел (сертификат менялся после подписи) или id неизвестен, перенаправляет на
+/certificate/{id} основного приложения (CERT_PUBLIC_BASE_URL).
+Нужны CERT_QR_SIGNED_TOKENS=1, тот же CERT_TOKEN_SECRET и доступ на чтение к той же БД.
+"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+
+from . import adb
+from .ratelimit import PUBLIC_LIMITER, client_ip
+from .tokens import QR_SIGNED_TOKENS, REVOCATIONS, load_token, token_view
+
+
+MAIN_BASE_URL = os.getenv("CERT_PUBLIC_BASE_URL", "").rstrip("/")
+
+app = FastAPI(title="Проверка сертификатов")
+
+BASE_DIR = Path(__file__).resolve().parent
+
+templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+app.mount("/static", StaticFiles(directory=str(BASE_DIR / "static")), name="static")
+
+
+@app.on_event("startup")
+async def _startup() -> None:
+    await adb.run_public(REVOCATIONS.refresh)
+
+
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    adb.shutdown()
+
+
+def admit(request: Request) -> None:
+    ok, retry_after = PUBLIC_LIMITER.acquire(client_ip(request))
+    if not ok:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+
+
+async def verify(token: str) -> Tuple[Optional[Dict[str, Any]], int]:
+    """(представление, cert_id) по токену; представление None — токен устарел."""
+    claims = load_token(token)
+    if claims is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+    if REVOCATIONS.needs_prepare(claims.cert_id, claims.epoch):
+        await adb.run_public(REVOCATIONS.prepare, claims.cert_id, claims.epoch)
+    return token_view(claims), claims.cert_id
+
+
+def fallback(cert_id: int) -> RedirectResponse:
+    return RedirectResponse(f"{MAIN_BASE_URL}/certificate/{int(cert_id)}", status_code=307)
+
+
+async def token_page(request: Request, token: str):
+    admit(request)
+    view, cert_id = await verify(token)
+    if view is None:
+        return fallback(cert_id)
+    return templates.TemplateResponse(
+        "certificate_public.html",
+        {
+            "request": request,
+            "cert_id": view["id"],
+            "status_code": view["status"],
+            "status_label": view["label"],
+            "full_name": view["full_name"],
+            "issued_at": view["issued_at"],
+            "expires_at": view["expires_at"] or "Бессрочно",
+        },
+    )
+
+
+async def api_token(request: Request, token: str):
+    admit(request)
+    view, cert_id = await verify(token)
+    if view is None:
+        return RedirectResponse(f"{MAIN_BASE_URL}/api/public/certificates/{int(cert_id)}", status_code=307)
+    return JSONResponse(view, headers={"Cache-Control": "no-store"})
+
+
+# Без CERT_QR_SIGNED_TOKENS процесс не принимает токены (остаётся только /healthz)
+if QR_SIGNED_TOKENS:
+    app.get("/v/{token}", response_class=HTMLResponse)(token_page)
+    app.get("/api/public/v/{token}")(api_token)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"ok": True, "revocations": REVOCATIONS.stats(), "limiter": PUBLIC_LIMITER.stats()}